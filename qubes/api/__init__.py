@@ -20,15 +20,20 @@
 # License along with this library; if not, see <https://www.gnu.org/licenses/>.
 
 import asyncio
+import collections
 import errno
 import functools
 import io
+import itertools
 import os
 import shutil
 import socket
 import struct
+import time
 import traceback
+import types
 
+import qubes.config
 import qubes.exc
 
 class ProtocolError(AssertionError):
@@ -145,20 +150,28 @@ class AbstractQubesAPI:
         #: is this operation cancellable?
         self.cancellable = False
 
-        candidates = list(self.list_methods(self.method))
-
-        if not candidates:
+        try:
+            handler, endpoint, _ = self.get_routing_table()[self.method]
+        except KeyError:
             raise ProtocolError('no such method: {!r}'.format(self.method))
 
-        assert len(candidates) == 1, \
-            'multiple candidates for method {!r}'.format(self.method)
-
         #: the method to execute
-        self._handler = candidates[0]
+        self._handler = (handler, self.method, endpoint)
         self._running_handler = None
 
     @classmethod
-    def list_methods(cls, select_method=None):
+    def get_routing_table(cls):
+        '''Get mapping of API method names to ``(handler, endpoint,
+        classifiers)`` tuples.
+
+        The table is built once for each class, on the first use.
+        '''
+        try:
+            return cls.__dict__['_routing_table']
+        except KeyError:
+            pass
+
+        routing_table = {}
         for attr in dir(cls):
             func = getattr(cls, attr)
             if not callable(func):
@@ -171,8 +184,25 @@ class AbstractQubesAPI:
                 continue
 
             for mname, endpoint in rpcnames:
-                if select_method is None or mname == select_method:
-                    yield (func, mname, endpoint)
+                assert mname not in routing_table, \
+                    'multiple candidates for method {!r}'.format(mname)
+                routing_table[mname] = (func, endpoint, func.classifiers)
+
+        cls._routing_table = types.MappingProxyType(routing_table)
+        return cls._routing_table
+
+    @classmethod
+    def list_methods(cls, select_method=None):
+        routing_table = cls.get_routing_table()
+        if select_method is not None:
+            try:
+                func, endpoint, _ = routing_table[select_method]
+            except KeyError:
+                return
+            yield (func, select_method, endpoint)
+            return
+        for mname, (func, endpoint, _) in routing_table.items():
+            yield (func, mname, endpoint)
 
     def execute(self, *, untrusted_payload):
         '''Execute management operation.
@@ -211,22 +241,80 @@ class AbstractQubesAPI:
 
 
 class QubesDaemonProtocol(asyncio.Protocol):
+    '''Protocol of qubesd sockets.
+
+    By default, a connection carries a single request, terminated by EOF, and
+    the reply is terminated by closing the connection.
+
+    If the client starts the connection with :py:attr:`framed_magic`, it can
+    send multiple requests over the same connection instead, without waiting
+    for replies. Each request is then sent as a frame: a
+    :py:attr:`frame_header` (request id chosen by the client and body
+    length) followed by the body, in the same format as in the single request
+    mode. Messages of the reply (response, exception or events) are sent in
+    frames with the same request id, one message per frame. Response or
+    exception ends the reply; an empty frame is sent instead if the request
+    failed without a reply (when the connection would be closed in the single
+    request mode). Sending an empty frame with request id of a pending
+    request cancels it.
+    '''
     buffer_size = 65536
     header = struct.Struct('Bx')
+    #: beginning of connection requesting multiple requests mode
+    framed_magic = b'\0framed\0'
+    #: request id and body length
+    frame_header = struct.Struct('!II')
+    #: maximum number of pending requests on a single connection
+    max_pending_requests = 256
     # keep track of connections, to gracefully close them at server exit
     # (including cleanup of integration test)
     connections = set()
+    #: counters of events sent by all the connections: ``queued``, ``sent``,
+    #: ``coalesced``, ``dropped`` and ``disconnected`` (clients disconnected
+    #: for not reading events)
+    event_counters = collections.Counter()
 
-    def __init__(self, handler, *args, app, debug=False, **kwargs):
+    def __init__(self, handler, *args, app, debug=False, read_workers=None,
+            **kwargs):
         super().__init__(*args, **kwargs)
         self.handler = handler
         self.app = app
+        #: pool of processes serving read-only calls, see
+        #: :py:class:`qubes.api.workers.ReadWorkerPool`
+        self.read_workers = read_workers
         self.untrusted_buffer = io.BytesIO()
         self.len_untrusted_buffer = 0
         self.transport = None
         self.debug = debug
         self.event_sent = False
-        self.mgmt = None
+        #: pending requests (API objects): request id -> object; in single
+        #: request mode, the request id is :py:obj:`None`
+        self.requests = {}
+        #: :py:obj:`True` in multiple requests mode, :py:obj:`None` until the
+        #: first data is received
+        self.framed = None
+        self._eof_received = False
+
+        #: maximum number of queued events, see
+        #: :py:data:`qubes.config.events_queue_limit`
+        self.event_queue_limit = qubes.config.events_queue_limit
+        #: see :py:data:`qubes.config.events_overflow_policy`
+        self.event_overflow_policy = qubes.config.events_overflow_policy
+        #: encoded events waiting to be sent: token -> (key, frame)
+        self._event_queue = collections.OrderedDict()
+        #: (request id, subject, event) -> token of the last queued such event
+        self._event_queue_index = {}
+        self._event_tokens = itertools.count()
+        #: number of events dropped since the last ``events-lost`` event,
+        #: by request id
+        self._events_lost = collections.Counter()
+        self._events_flush_handle = None
+        self._writing_paused = False
+
+    @property
+    def mgmt(self):
+        '''API object handling the request in single request mode'''
+        return self.requests.get(None)
 
     def connection_made(self, transport):
         self.transport = transport
@@ -234,13 +322,25 @@ class QubesDaemonProtocol(asyncio.Protocol):
 
     def connection_lost(self, exc):
         self.untrusted_buffer.close()
+        if self._events_flush_handle is not None:
+            self._events_flush_handle.cancel()
+            self._events_flush_handle = None
+        self._event_queue.clear()
+        self._event_queue_index.clear()
         # for cancellable operation, interrupt it, otherwise it will do nothing
-        if self.mgmt is not None:
-            self.mgmt.cancel()
+        for mgmt in list(self.requests.values()):
+            if mgmt is not None:
+                mgmt.cancel()
         self.transport = None
         self.connections.remove(self)
 
     def data_received(self, untrusted_data):  # pylint: disable=arguments-differ
+        if self.framed is None:
+            self.framed = untrusted_data[:1] == self.framed_magic[:1]
+        if self.framed:
+            self._framed_data_received(untrusted_data)
+            return
+
         if self.len_untrusted_buffer + len(untrusted_data) > self.buffer_size:
             self.app.log.warning('request too long')
             self.transport.abort()
@@ -250,22 +350,104 @@ class QubesDaemonProtocol(asyncio.Protocol):
         self.len_untrusted_buffer += \
             self.untrusted_buffer.write(untrusted_data)
 
+    def _framed_data_received(self, untrusted_data):
+        if self.untrusted_buffer.closed:
+            return
+        self.len_untrusted_buffer += \
+            self.untrusted_buffer.write(untrusted_data)
+        untrusted_buffer = self.untrusted_buffer.getbuffer()
+        try:
+            offset = 0
+            if self.len_untrusted_buffer <= len(self.framed_magic) \
+                    and self.framed_magic.startswith(
+                        bytes(untrusted_buffer)):
+                return
+            if untrusted_buffer[:len(self.framed_magic)] \
+                    != self.framed_magic:
+                raise ValueError('invalid magic')
+            offset = len(self.framed_magic)
+
+            while True:
+                if len(untrusted_buffer) - offset < self.frame_header.size:
+                    break
+                request_id, untrusted_length = \
+                    self.frame_header.unpack_from(untrusted_buffer, offset)
+                if untrusted_length > self.buffer_size:
+                    self.app.log.warning('request too long')
+                    raise ValueError('request too long')
+                frame_end = offset + self.frame_header.size + untrusted_length
+                if len(untrusted_buffer) < frame_end:
+                    break
+                self._frame_received(request_id, bytes(untrusted_buffer[
+                    offset + self.frame_header.size:frame_end]))
+                offset = frame_end
+        except ValueError:
+            self.app.log.warning('framing error')
+            untrusted_buffer.release()
+            self.untrusted_buffer.close()
+            self.transport.abort()
+            return
+
+        # keep only the unprocessed data, but still the magic, to have it
+        # checked above
+        remaining = bytes(untrusted_buffer[offset:])
+        untrusted_buffer.release()
+        if offset:
+            self.untrusted_buffer = io.BytesIO()
+            self.len_untrusted_buffer = self.untrusted_buffer.write(
+                self.framed_magic + remaining)
+
+    def _frame_received(self, request_id, untrusted_data):
+        if not untrusted_data:
+            # cancel the request
+            if self.requests.get(request_id) is not None:
+                self.requests[request_id].cancel()
+            return
+        if request_id in self.requests:
+            raise ValueError('duplicated request id')
+        if len(self.requests) >= self.max_pending_requests:
+            raise ValueError('too many pending requests')
+
+        src, meth, dest, arg, untrusted_payload = \
+            self.parse_request(untrusted_data)
+        # reserve the id until the request is started
+        self.requests[request_id] = None
+        asyncio.ensure_future(self.respond_framed(request_id,
+            src, meth, dest, arg, untrusted_payload=untrusted_payload,
+            received=time.monotonic()))
+
+    @staticmethod
+    def parse_request(untrusted_data):
+        '''Parse request into (src, meth, dest, arg, untrusted_payload).
+
+        :raise ValueError: on invalid request
+        '''
+        connection_params, untrusted_payload = untrusted_data.split(b'\0', 1)
+        meth_arg, src, dest_type, dest = \
+            connection_params.split(b' ', 3)
+        if dest_type == b'keyword' and dest == b'adminvm':
+            dest_type, dest = b'name', b'dom0'
+        if dest_type != b'name':
+            raise ValueError(
+                'got {} destination type, '
+                'while only explicit name supported'.format(dest_type))
+        if b'+' in meth_arg:
+            meth, arg = meth_arg.split(b'+', 1)
+        else:
+            meth, arg = meth_arg, b''
+        return src, meth, dest, arg, untrusted_payload
+
     def eof_received(self):
+        if self.framed:
+            # finish pending requests, then close the connection
+            self._eof_received = True
+            if not self.requests:
+                return None
+            return True
+
         try:
-            connection_params, untrusted_payload = \
-                self.untrusted_buffer.getvalue().split(b'\0', 1)
-            meth_arg, src, dest_type, dest = \
-                connection_params.split(b' ', 3)
-            if dest_type == b'keyword' and dest == b'adminvm':
-                dest_type, dest = b'name', b'dom0'
-            if dest_type != b'name':
-                raise ValueError(
-                    'got {} destination type, '
-                    'while only explicit name supported'.format(dest_type))
-            if b'+' in meth_arg:
-                meth, arg = meth_arg.split(b'+', 1)
-            else:
-                meth, arg = meth_arg, b''
+            src, meth, dest, arg, untrusted_payload = \
+                self.parse_request(self.untrusted_buffer.getvalue())
         except ValueError:
             self.app.log.warning('framing error')
             self.transport.abort()
@@ -274,22 +456,77 @@ class QubesDaemonProtocol(asyncio.Protocol):
             self.untrusted_buffer.close()
 
         asyncio.ensure_future(self.respond(
-            src, meth, dest, arg, untrusted_payload=untrusted_payload))
+            src, meth, dest, arg, untrusted_payload=untrusted_payload,
+            received=time.monotonic()))
 
         return True
 
     @asyncio.coroutine
-    def respond(self, src, meth, dest, arg, *, untrusted_payload):
+    def call(self, src, meth, dest, arg, *, untrusted_payload, send_event,
+            request_id=None, received=None):
+        '''Execute a single request.
+
+        If the application has :py:class:`qubes.api.metrics.CallMetrics`
+        attached, the call is recorded there.
+
+        :param float received: :py:func:`time.monotonic` time of receiving \
+            the request
+        :return: encoded response or exception, or :py:obj:`None` if the \
+            request failed in a way not reported to the client
+        '''
+        metrics = getattr(self.app, 'api_metrics', None)
+        if metrics is None:
+            return (yield from self._call(src, meth, dest, arg,
+                untrusted_payload=untrusted_payload, send_event=send_event,
+                request_id=request_id))
+
+        started = time.monotonic()
+        reply = None
         try:
-            self.mgmt = self.handler(self.app, src, meth, dest, arg,
-                self.send_event)
-            response = yield from self.mgmt.execute(
-                untrusted_payload=untrusted_payload)
-            assert not (self.event_sent and response)
-            if self.transport is None:
-                return
+            reply = yield from self._call(src, meth, dest, arg,
+                untrusted_payload=untrusted_payload, send_event=send_event,
+                request_id=request_id)
+            return reply
+        finally:
+            metrics.record(self.handler, src, meth, dest, arg,
+                queue_wait=started - received if received is not None else 0.,
+                execute_time=time.monotonic() - started,
+                bytes_in=len(untrusted_payload),
+                bytes_out=len(reply) if reply else 0,
+                error=not reply or reply[:self.header.size]
+                    == self.header.pack(0x32))
+
+    @asyncio.coroutine
+    def _call(self, src, meth, dest, arg, *, untrusted_payload, send_event,
+            request_id):
+        if self.read_workers is not None \
+                and self.read_workers.can_serve(self.handler, meth):
+            reply = yield from self.read_workers.call(src, meth, dest, arg,
+                untrusted_payload)
+            if reply is not None:
+                if self.framed:
+                    self.requests.pop(request_id, None)
+                return reply or None
 
-        # except clauses will fall through to transport.abort() below
+        try:
+            mgmt = self.handler(self.app, src, meth, dest, arg, send_event)
+            self.requests[request_id] = mgmt
+            # reply only after changes done by the call are saved
+            try:
+                response = yield from mgmt.execute(
+                    untrusted_payload=untrusted_payload)
+            except Exception:
+                # report the call failure, not a failure to save what the
+                # call changed before failing
+                try:
+                    yield from self.app.wait_saved()
+                except Exception:  # pylint: disable=broad-except
+                    self.app.log.exception(
+                        'failed to save changes of failed call %s+%s',
+                        meth, arg)
+                raise
+            yield from self.app.wait_saved()
+            return self.encode_response(response)
 
         except PermissionDenied:
             self.app.log.warning(
@@ -311,11 +548,7 @@ class QubesDaemonProtocol(asyncio.Protocol):
                 self.app.log.debug(msg,
                     err, src, meth, dest, arg, len(untrusted_payload),
                     exc_info=1)
-            if self.transport is not None:
-                self.send_exception(err)
-                self.transport.write_eof()
-                self.transport.close()
-            return
+            return self.encode_exception(err)
 
         except Exception:  # pylint: disable=broad-except
             self.app.log.exception(
@@ -323,57 +556,225 @@ class QubesDaemonProtocol(asyncio.Protocol):
                 'src=%r meth=%r dest=%r arg=%r len(untrusted_payload)=%d',
                     src, meth, dest, arg, len(untrusted_payload))
 
-        else:
-            if not self.event_sent:
-                self.send_response(response)
+        finally:
+            if self.framed:
+                self.requests.pop(request_id, None)
+
+        return None
+
+    @asyncio.coroutine
+    def respond(self, src, meth, dest, arg, *, untrusted_payload,
+            received=None):
+        try:
+            reply = yield from self.call(src, meth, dest, arg,
+                untrusted_payload=untrusted_payload,
+                send_event=self.send_event, received=received)
+        except asyncio.CancelledError:
+            # not an Exception, so not handled by call(); don't leave the
+            # client waiting
+            if self.transport is not None:
+                self.transport.abort()
+            raise
+        if self.transport is None:
+            return
+
+        if reply is None:
+            self.transport.abort()
+            return
+
+        self.flush_events()
+        if reply[:self.header.size] == self.header.pack(0x30):
+            if self.event_sent:
+                assert reply == self.header.pack(0x30)
+            else:
+                self.transport.write(reply)
             try:
                 self.transport.write_eof()
             except NotImplementedError:
                 pass
-            self.transport.close()
+        else:
+            self.transport.write(reply)
+            self.transport.write_eof()
+        self.transport.close()
+
+    @asyncio.coroutine
+    def respond_framed(self, request_id, src, meth, dest, arg, *,
+            untrusted_payload, received=None):
+        def send_event(subject, event, **kwargs):
+            self.queue_event(request_id, subject, event, kwargs)
+
+        try:
+            reply = yield from self.call(src, meth, dest, arg,
+                untrusted_payload=untrusted_payload, send_event=send_event,
+                request_id=request_id, received=received)
+        except asyncio.CancelledError:
+            # not an Exception, so not handled by call(); still finish the
+            # request, for the client not to wait for it forever
+            self._send_frame_reply(request_id, None)
+            raise
+        self._send_frame_reply(request_id, reply)
+
+    def _send_frame_reply(self, request_id, reply):
+        '''Send the final frame of a request, and close the connection if
+        it was the last one after EOF'''
+        self.requests.pop(request_id, None)
+        if self.transport is None or self.transport.is_closing():
             return
 
-        # this is reached if from except: blocks; do not put it in finally:,
-        # because this will prevent the good case from sending the reply
-        if self.transport:
-            self.transport.abort()
+        self.flush_events()
+        self.transport.write(self.encode_frame(request_id, reply or b''))
+        if self._eof_received and not self.requests:
+            self.transport.close()
+
+    def encode_frame(self, request_id, message):
+        '''Encode a message in multiple requests mode'''
+        return self.frame_header.pack(request_id, len(message)) + message
 
     def send_header(self, *args):
         self.transport.write(self.header.pack(*args))
 
+    def encode_response(self, content):
+        '''Encode response message'''
+        if content is None:
+            return self.header.pack(0x30)
+        return self.header.pack(0x30) + content.encode('utf-8')
+
     def send_response(self, content):
         assert not self.event_sent
-        self.send_header(0x30)
-        if content is not None:
-            self.transport.write(content.encode('utf-8'))
+        self.transport.write(self.encode_response(content))
+
+    def encode_event(self, subject, event, **kwargs):
+        '''Encode event into a single frame, as sent by :py:meth:`send_event`
+        '''
+        return b''.join(itertools.chain(
+            (self.header.pack(0x31),
+             b'' if subject is self.app else str(subject).encode('ascii'),
+             b'\0',
+             event.encode('ascii'),
+             b'\0'),
+            ('{}\0{}\0'.format(k, str(v)).encode('ascii')
+                for k, v in kwargs.items()),
+            (b'\0',)))
 
     def send_event(self, subject, event, **kwargs):
-        if self.transport is None:
+        '''Queue event to be sent to the client.
+
+        Events are sent asynchronously, all events queued in one event loop
+        iteration in a single write. If the client doesn't read them fast
+        enough (transport's write buffer is full), they are kept queued, up to
+        :py:attr:`event_queue_limit`; after that
+        :py:attr:`event_overflow_policy` applies.
+        '''
+        self.queue_event(None, subject, event, kwargs)
+
+    def queue_event(self, request_id, subject, event, kwargs):
+        '''Queue event to be sent as a part of reply to given request.
+
+        See :py:meth:`send_event`.
+        '''
+        if self.transport is None or self.transport.is_closing():
             return
-        self.event_sent = True
-        self.send_header(0x31)
+        frame = self.encode_event(subject, event, **kwargs)
+        if request_id is None:
+            self.event_sent = True
+        else:
+            frame = self.encode_frame(request_id, frame)
+        key = (request_id,
+            None if subject is self.app else str(subject), event)
+
+        if len(self._event_queue) >= self.event_queue_limit:
+            if not self._handle_event_queue_overflow(key):
+                return
 
-        if subject is not self.app:
-            self.transport.write(str(subject).encode('ascii'))
-        self.transport.write(b'\0')
+        token = next(self._event_tokens)
+        self._event_queue[token] = (key, frame)
+        self._event_queue_index[key] = token
+        self.event_counters['queued'] += 1
 
-        self.transport.write(event.encode('ascii') + b'\0')
+        if not self._writing_paused and self._events_flush_handle is None:
+            self._events_flush_handle = \
+                asyncio.get_event_loop().call_soon(self.flush_events)
 
-        for k, v in kwargs.items():
-            self.transport.write('{}\0{}\0'.format(k, str(v)).encode('ascii'))
-        self.transport.write(b'\0')
+    def _handle_event_queue_overflow(self, key):
+        '''Make space for an event in full queue.
 
-    def send_exception(self, exc):
-        self.send_header(0x32)
+        :return: :py:obj:`True` if the event should be queued
+        '''
+        if self.event_overflow_policy == 'disconnect':
+            self.app.log.warning(
+                'client does not read events, disconnecting (%d queued)',
+                len(self._event_queue))
+            self.event_counters['disconnected'] += 1
+            self._event_queue.clear()
+            self._event_queue_index.clear()
+            self.transport.abort()
+            return False
+
+        if self.event_overflow_policy == 'coalesce' \
+                and key in self._event_queue_index:
+            del self._event_queue[self._event_queue_index.pop(key)]
+            if not self._events_lost:
+                self.app.log.warning(
+                    'client does not read events, coalescing them')
+            # the replaced event may carry information the newer one
+            # doesn't (like device-attach:* of a different device), so let
+            # the client know it needs to refresh its state
+            self._events_lost[key[0]] += 1
+            self.event_counters['coalesced'] += 1
+            return True
+
+        old_token, (old_key, _) = self._event_queue.popitem(last=False)
+        if self._event_queue_index.get(old_key) == old_token:
+            del self._event_queue_index[old_key]
+        if not self._events_lost:
+            self.app.log.warning(
+                'client does not read events, dropping the oldest ones')
+        self._events_lost[old_key[0]] += 1
+        self.event_counters['dropped'] += 1
+        return True
+
+    def pause_writing(self):
+        self._writing_paused = True
 
-        self.transport.write(type(exc).__name__.encode() + b'\0')
+    def resume_writing(self):
+        self._writing_paused = False
+        self.flush_events()
 
+    def flush_events(self):
+        '''Write all queued events to the transport.'''
+        if self._events_flush_handle is not None:
+            self._events_flush_handle.cancel()
+            self._events_flush_handle = None
+        if self.transport is None:
+            return
+        frames = []
+        for request_id, count in self._events_lost.items():
+            frame = self.encode_event(self.app, 'events-lost', count=count)
+            if request_id is not None:
+                frame = self.encode_frame(request_id, frame)
+            frames.append(frame)
+        self._events_lost.clear()
+        frames.extend(frame for _, frame in self._event_queue.values())
+        if not frames:
+            return
+        self.event_counters['sent'] += len(self._event_queue)
+        self._event_queue.clear()
+        self._event_queue_index.clear()
+        self.transport.write(b''.join(frames))
+
+    def encode_exception(self, exc):
+        '''Encode exception message'''
+        parts = [self.header.pack(0x32),
+            type(exc).__name__.encode() + b'\0']
         if self.debug:
-            self.transport.write(''.join(traceback.format_exception(
+            parts.append(''.join(traceback.format_exception(
                 type(exc), exc, exc.__traceback__)).encode('utf-8'))
-        self.transport.write(b'\0')
+        parts.append(b'\0')
+        parts.append(str(exc).encode('utf-8') + b'\0')
+        return b''.join(parts)
 
-        self.transport.write(str(exc).encode('utf-8') + b'\0')
+    def send_exception(self, exc):
+        self.transport.write(self.encode_exception(exc))
 
 
 def cleanup_socket(sockpath, force):
@@ -27,6 +27,7 @@ import itertools
 import os
 import string
 import subprocess
+import time
 import pathlib
 
 import libvirt
@@ -84,6 +85,189 @@ class QubesMgmtEventsDispatcher:
         vm.remove_handler('*', self.vm_handler)
 
 
+class ResponseCache:
+    '''Responses of read-only Admin API calls, kept until an event changing
+    the data they are based on.
+
+    Only :py:attr:`cached_methods` are cached, which return data changed
+    only together with an event. Responses are keyed by (method, source,
+    destination, argument) and grouped by subject: the destination qube, or
+    the application for :py:attr:`global_methods`. Any event fired on a qube
+    (other than :py:attr:`ignored_events`) drops responses about it and
+    about qubes referring to it (see
+    :py:meth:`qubes.app.VMCollection.get_references_to`), as their default
+    property values and template features may depend on it. Change of a
+    global property drops all the responses, and :py:attr:`global_events`
+    drop responses of global methods.
+
+    The permission check is not cached - it is done on every call. A
+    response is stored only if the check returned no filters, and is used
+    only as long as it still does. Without events enabled on the
+    application, nothing is cached.
+
+    Attach it to the application as :py:attr:`qubes.Qubes.api_response_cache`.
+    :py:attr:`hits` and :py:attr:`misses` count lookups, for tuning; they are
+    published by :py:meth:`format_prometheus`.
+    '''
+
+    #: methods whose responses are cached
+    cached_methods = frozenset((
+        'admin.vm.property.Get',
+        'admin.vm.property.GetAll',
+        'admin.vm.property.GetDefault',
+        'admin.property.Get',
+        'admin.property.GetAll',
+        'admin.property.GetDefault',
+        'admin.vm.feature.List',
+        'admin.vm.feature.Get',
+        'admin.vm.feature.CheckWithTemplate',
+        'admin.vm.tag.List',
+        'admin.vm.tag.Get',
+        'admin.label.List',
+        'admin.pool.List',
+        'admin.vmclass.List',
+    ))
+
+    #: methods returning data about the whole system, not the destination
+    global_methods = frozenset((
+        'admin.property.Get',
+        'admin.property.GetAll',
+        'admin.property.GetDefault',
+        'admin.label.List',
+        'admin.pool.List',
+        'admin.vmclass.List',
+    ))
+
+    #: events on the application changing data of global methods
+    global_events = ('label-add', 'label-delete', 'pool-add', 'pool-delete')
+
+    #: events not changing the state
+    ignored_events = ('admin-permission:', 'device-get:', 'device-list:',
+        'device-list-attached:', 'domain-is-fully-usable')
+
+    #: maximum number of cached responses
+    max_size = 4096
+
+    def __init__(self, app):
+        self.app = app
+        #: subject -> {(method, source, destination, argument): response}
+        self._responses = {}
+        self._size = 0
+        #: incremented on each invalidation, to not store a response
+        #: computed from data changed in the meantime
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+        app.add_handler('*', self._on_app_event)
+        for domain in app.domains:
+            domain.add_handler('*', self._on_domain_event)
+
+    def _on_app_event(self, app, event, vm=None, **kwargs):
+        # pylint: disable=unused-argument
+        if event == 'domain-add':
+            vm.add_handler('*', self._on_domain_event)
+        elif event == 'domain-delete':
+            vm.remove_handler('*', self._on_domain_event)
+            self.invalidate(vm)
+        elif event.startswith(('property-set:', 'property-reset:',
+                'property-del:')):
+            # app-wide defaults may be used by any domain
+            self.invalidate()
+        elif event in self.global_events:
+            self.invalidate(app)
+
+    def _on_domain_event(self, vm, event, **kwargs):
+        # pylint: disable=unused-argument
+        if event.startswith(self.ignored_events):
+            return
+        self.invalidate(vm)
+
+    def invalidate(self, subject=None):
+        '''Drop cached responses about a subject, or all of them.
+
+        :param subject: qube (responses about qubes referring to it are \
+            dropped too), the application (for global methods), or \
+            :py:obj:`None` for everything
+        '''
+        self.generation += 1
+        if subject is None:
+            self._responses.clear()
+            self._size = 0
+            return
+        pending = [subject]
+        seen = set()
+        while pending:
+            subject = pending.pop()
+            if subject in seen:
+                continue
+            seen.add(subject)
+            self._size -= len(self._responses.pop(subject, ()))
+            if subject is not self.app and subject in self.app.domains:
+                pending.extend(domain for domain, _
+                    in self.app.domains.get_references_to(subject))
+
+    def can_cache(self, method):
+        '''Check if responses of *method* are cached'''
+        return method in self.cached_methods
+
+    @staticmethod
+    def _key(mgmt):
+        return (mgmt.method, mgmt.src.name, mgmt.dest.name, mgmt.arg)
+
+    def _subject(self, mgmt):
+        return self.app if mgmt.method in self.global_methods else mgmt.dest
+
+    def get(self, mgmt):
+        '''Get cached response of a call.
+
+        :param qubes.api.AbstractQubesAPI mgmt: the call
+        :raise KeyError: when not cached
+        '''
+        if not self.app.events_enabled:
+            # nothing keeps the cache up to date
+            self.invalidate()
+        try:
+            response = self._responses[self._subject(mgmt)][self._key(mgmt)]
+        except KeyError:
+            self.misses += 1
+            raise
+        self.hits += 1
+        return response
+
+    def store(self, mgmt, response, generation):
+        '''Store response of a call.
+
+        :param qubes.api.AbstractQubesAPI mgmt: the call
+        :param response: the response
+        :param int generation: :py:attr:`generation` from before the call \
+            was executed
+        '''
+        if generation != self.generation or not self.app.events_enabled:
+            return
+        if self._size >= self.max_size:
+            self.invalidate()
+        responses = self._responses.setdefault(self._subject(mgmt), {})
+        key = self._key(mgmt)
+        if key not in responses:
+            self._size += 1
+        responses[key] = response
+
+    def format_prometheus(self):
+        '''Format statistics in Prometheus text format'''
+        yield '# HELP qubesd_api_response_cache_lookups_total Lookups in ' \
+            'the cache of read-only API calls responses, by result\n'
+        yield '# TYPE qubesd_api_response_cache_lookups_total counter\n'
+        yield 'qubesd_api_response_cache_lookups_total{{result="hit"}} ' \
+            '{}\n'.format(self.hits)
+        yield 'qubesd_api_response_cache_lookups_total{{result="miss"}} ' \
+            '{}\n'.format(self.misses)
+        yield '# HELP qubesd_api_response_cache_size Number of cached ' \
+            'API calls responses\n'
+        yield '# TYPE qubesd_api_response_cache_size gauge\n'
+        yield 'qubesd_api_response_cache_size {}\n'.format(self._size)
+
+
 class QubesAdminAPI(qubes.api.AbstractQubesAPI):
     """Implementation of Qubes Management API calls
 
@@ -95,6 +279,44 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
 
     SOCKNAME = '/var/run/qubesd.sock'
 
+    #: results of permission checks done by the call, when it is to be
+    #: cached
+    _permission_checks = None
+
+    def execute(self, *, untrusted_payload):
+        cache = getattr(self.app, 'api_response_cache', None)
+        if cache is None or untrusted_payload \
+                or not cache.can_cache(self.method):
+            return super().execute(untrusted_payload=untrusted_payload)
+        return asyncio.ensure_future(self._execute_cached(cache,
+            untrusted_payload=untrusted_payload))
+
+    @asyncio.coroutine
+    def _execute_cached(self, cache, *, untrusted_payload):
+        try:
+            response = cache.get(self)
+        except KeyError:
+            pass
+        else:
+            # response cached for a call without filters is valid only as
+            # long as the permission check still returns none
+            if not self.fire_event_for_permission():
+                return response
+
+        generation = cache.generation
+        self._permission_checks = []
+        response = yield from super().execute(
+            untrusted_payload=untrusted_payload)
+        if self._permission_checks == [({}, [])]:
+            cache.store(self, response, generation)
+        return response
+
+    def fire_event_for_permission(self, **kwargs):
+        result = super().fire_event_for_permission(**kwargs)
+        if self._permission_checks is not None:
+            self._permission_checks.append((kwargs, list(result)))
+        return result
+
     @qubes.api.method('admin.vmclass.List', no_payload=True,
         scope='global', read=True)
     @asyncio.coroutine
@@ -120,12 +342,272 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
             domains = self.fire_event_for_filter(self.app.domains)
         else:
             domains = self.fire_event_for_filter([self.dest])
+        domains = sorted(domains)
+        yield from self._fetch_libvirt_states(domains)
 
         return ''.join('{} class={} state={}\n'.format(
                 vm.name,
                 vm.__class__.__name__,
                 vm.get_power_state())
-            for vm in sorted(domains))
+            for vm in domains)
+
+    @staticmethod
+    @asyncio.coroutine
+    def _fetch_libvirt_states(domains):
+        '''Get libvirt state of *domains* (concurrently, outside of the event
+        loop thread), for their power state'''
+        if domains:
+            yield from asyncio.gather(*(vm.fetch_libvirt_state()
+                for vm in domains))
+
+    @qubes.api.method('admin.vm.GetAllData', no_payload=True,
+        scope='global', read=True)
+    @asyncio.coroutine
+    def vm_get_all_data(self):
+        """Get properties, features, tags and volumes info of all the domains
+        in a single call.
+
+        The response consists of a record for each domain: a ``vm <name>
+        class=<class> state=<power state>`` line (as in ``admin.vm.List``),
+        followed by ``property <name> <value>`` (with value as in
+        ``admin.vm.property.GetAll``), ``feature <name> <value>``, ``tag
+        <name>`` and ``volume <name> <key>=<value>`` lines. Backslashes and
+        new lines in values are escaped.
+
+        Each part is included only if the corresponding call
+        (``admin.vm.property.GetAll``, ``admin.vm.feature.List`` and
+        ``admin.vm.feature.Get``, ``admin.vm.tag.List``,
+        ``admin.vm.volume.List`` and ``admin.vm.volume.Info``) would be
+        allowed by its ``admin-permission`` event and by qrexec policy for
+        that call (with the feature or volume name as the argument), see
+        :py:mod:`qubes.ext.admin`.
+        """
+        self.enforce(not self.arg)
+
+        if self.dest.name == 'dom0':
+            domains = self.fire_event_for_filter(self.app.domains)
+        else:
+            domains = self.fire_event_for_filter([self.dest])
+        domains = sorted(domains)
+        yield from self._fetch_libvirt_states(domains)
+
+        return ''.join(self._vm_get_all_data_single(vm)
+            for vm in domains)
+
+    def _fire_event_for_permission_as(self, method, dest, arg=''):
+        '''Fire permission event as if *method* was called on *dest*, as a
+        part of ``admin.vm.GetAllData`` (the event has ``get_all_data``
+        argument set, so handlers know qrexec didn't check that call).
+
+        :return: filters, or :py:obj:`None` if the call would be denied
+        '''
+        try:
+            return self.src.fire_event('admin-permission:' + method,
+                pre_event=True, dest=dest, arg=arg, get_all_data=True)
+        except qubes.api.PermissionDenied:
+            return None
+
+    def _vm_get_all_data_single(self, vm):
+        def escape(value):
+            return str(value).replace('\\', '\\\\').replace('\n', '\\n')
+
+        lines = ['vm {} class={} state={}\n'.format(
+            vm.name, vm.__class__.__name__, vm.get_power_state())]
+
+        filters = self._fire_event_for_permission_as(
+            'admin.vm.property.GetAll', vm)
+        if filters is not None:
+            lines.extend('property {} {}\n'.format(prop,
+                    escape(self._serialize_property(vm, prop)))
+                for prop in sorted(qubes.api.apply_filters(
+                    vm.property_list(), filters)))
+
+        filters = self._fire_event_for_permission_as(
+            'admin.vm.feature.List', vm)
+        if filters is not None:
+            for feature in qubes.api.apply_filters(
+                    list(vm.features.keys()), filters):
+                if self._fire_event_for_permission_as(
+                        'admin.vm.feature.Get', vm, feature) is not None:
+                    lines.append('feature {} {}\n'.format(
+                        feature, escape(vm.features[feature])))
+
+        filters = self._fire_event_for_permission_as('admin.vm.tag.List', vm)
+        if filters is not None:
+            lines.extend('tag {}\n'.format(tag)
+                for tag in sorted(qubes.api.apply_filters(vm.tags, filters)))
+
+        filters = self._fire_event_for_permission_as(
+            'admin.vm.volume.List', vm)
+        if filters is not None:
+            for volume_name in qubes.api.apply_filters(
+                    list(vm.volumes.keys()), filters):
+                if self._fire_event_for_permission_as(
+                        'admin.vm.volume.Info', vm, volume_name) is None:
+                    continue
+                lines.extend('volume {} {}={}\n'.format(
+                        volume_name, key, escape(value))
+                    for key, value in self._volume_info(
+                        vm.volumes[volume_name]))
+
+        return ''.join(lines)
+
+    @qubes.api.method('admin.vm.SetMany',
+        scope='local', write=True)
+    @asyncio.coroutine
+    def vm_set_many(self, untrusted_payload):
+        """Change properties, features and tags of a qube in a single call.
+
+        The payload consists of ``property <name> <value>``, ``property-reset
+        <name>``, ``feature <name> <value>``, ``feature-remove <name>``,
+        ``tag <name>`` and ``tag-remove <name>`` lines. Backslashes and new
+        lines in values are escaped, as in ``admin.vm.GetAllData``.
+
+        All the values are validated, and permission for each change is
+        checked (with ``admin-permission`` event of the corresponding
+        single change call, like ``admin.vm.property.Set``, and against
+        qrexec policy for that call with the property, feature or tag name
+        as the argument, see :py:mod:`qubes.ext.admin`) before anything
+        is changed. Then the changes are applied in order; if any of them
+        fails, those already applied are reverted. The configuration is saved
+        once, at the end.
+        """
+        self.enforce(not self.arg)
+
+        try:
+            untrusted_lines = untrusted_payload.decode(
+                'ascii', errors='strict').splitlines()
+        except UnicodeDecodeError:
+            raise qubes.api.ProtocolError('Invalid payload')
+        del untrusted_payload
+        self.enforce(untrusted_lines)
+
+        changes = [self._parse_set_many_line(untrusted_line)
+            for untrusted_line in untrusted_lines]
+        del untrusted_lines
+
+        # all the changes must pass the filters
+        self.enforce(len(list(self.fire_event_for_filter(changes)))
+            == len(changes))
+        for method, arg, kwargs in changes:
+            self.src.fire_event('admin-permission:' + method,
+                pre_event=True, dest=self.dest, arg=arg, **kwargs)
+
+        undo = []
+        try:
+            for method, arg, kwargs in changes:
+                undo.append(self._apply_set_many_change(method, arg, kwargs))
+        except Exception:
+            for undo_change in reversed(undo):
+                try:
+                    undo_change()
+                except Exception:  # pylint: disable=broad-except
+                    self.dest.log.exception(
+                        'Failed to revert a change of admin.vm.SetMany')
+            raise
+
+        self.app.save()
+
+    def _parse_set_many_line(self, untrusted_line):
+        '''Parse and validate a line of ``admin.vm.SetMany`` payload.
+
+        :return: tuple (single change method, its argument, keyword
+            arguments of its ``admin-permission`` event)
+        '''
+        untrusted_kind, _, untrusted_rest = untrusted_line.partition(' ')
+        untrusted_name, _, untrusted_value = untrusted_rest.partition(' ')
+        self.enforce(untrusted_name)
+
+        if untrusted_kind in ('property', 'property-reset'):
+            self.enforce(untrusted_name in self.dest.property_list())
+            name = untrusted_name
+            if untrusted_kind == 'property-reset':
+                self.enforce(not untrusted_value)
+                return 'admin.vm.property.Reset', name, {}
+            property_def = self.dest.property_get_def(name)
+            newvalue = property_def.sanitize(untrusted_newvalue=
+                self._unescape_value(untrusted_value).encode('ascii'))
+            return 'admin.vm.property.Set', name, {'newvalue': newvalue}
+
+        if untrusted_kind in ('feature', 'feature-remove'):
+            # the same characters as allowed in qrexec argument, where
+            # feature name is given in admin.vm.feature.Set
+            allowed_chars = string.ascii_letters + string.digits + '-_.+'
+            self.enforce(all(c in allowed_chars for c in untrusted_name))
+            name = untrusted_name
+            if untrusted_kind == 'feature-remove':
+                self.enforce(not untrusted_value)
+                return 'admin.vm.feature.Remove', name, {}
+            value = self._unescape_value(untrusted_value)
+            return 'admin.vm.feature.Set', name, {'value': value}
+
+        if untrusted_kind in ('tag', 'tag-remove'):
+            self.enforce(not untrusted_value)
+            qubes.vm.Tags.validate_tag(untrusted_name)
+            name = untrusted_name
+            if untrusted_kind == 'tag-remove':
+                return 'admin.vm.tag.Remove', name, {}
+            return 'admin.vm.tag.Set', name, {}
+
+        raise qubes.api.ProtocolError('Invalid change')
+
+    @staticmethod
+    def _unescape_value(untrusted_value):
+        untrusted_parts = untrusted_value.split('\\\\')
+        for untrusted_part in untrusted_parts:
+            if '\\' in untrusted_part.replace('\\n', ''):
+                raise qubes.api.ProtocolError('Invalid escape sequence')
+        return '\\'.join(untrusted_part.replace('\\n', '\n')
+            for untrusted_part in untrusted_parts)
+
+    def _apply_set_many_change(self, method, arg, kwargs):
+        '''Apply a single change of ``admin.vm.SetMany``.
+
+        :return: function reverting the change
+        '''
+        dest = self.dest
+        if method in ('admin.vm.property.Set', 'admin.vm.property.Reset'):
+            if dest.property_is_default(arg):
+                undo = functools.partial(delattr, dest, arg)
+            else:
+                undo = functools.partial(setattr, dest, arg,
+                    getattr(dest, arg))
+            if method == 'admin.vm.property.Set':
+                setattr(dest, arg, kwargs['newvalue'])
+            else:
+                delattr(dest, arg)
+            return undo
+
+        if method in ('admin.vm.feature.Set', 'admin.vm.feature.Remove'):
+            if arg in dest.features:
+                undo = functools.partial(dest.features.__setitem__, arg,
+                    dest.features[arg])
+            else:
+                def remove_feature():
+                    if arg in dest.features:
+                        del dest.features[arg]
+                undo = remove_feature
+            if method == 'admin.vm.feature.Set':
+                dest.features[arg] = kwargs['value']
+            else:
+                try:
+                    del dest.features[arg]
+                except KeyError:
+                    raise qubes.exc.QubesFeatureNotFoundError(dest, arg)
+            return undo
+
+        if arg in dest.tags:
+            undo = functools.partial(dest.tags.add, arg)
+        else:
+            undo = functools.partial(dest.tags.discard, arg)
+        if method == 'admin.vm.tag.Set':
+            dest.tags.add(arg)
+        else:
+            try:
+                dest.tags.remove(arg)
+            except KeyError:
+                raise qubes.exc.QubesTagNotFoundError(dest, arg)
+        return undo
 
     @qubes.api.method('admin.vm.property.List', no_payload=True,
         scope='local', read=True)
@@ -369,6 +851,12 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
         self.fire_event_for_permission()
 
         volume = self.dest.volumes[self.arg]
+        return ''.join('{}={}\n'.format(key, value)
+            for key, value in self._volume_info(volume))
+
+    @staticmethod
+    def _volume_info(volume):
+        '''Get volume info as (key, value) pairs'''
         # properties defined in API
         volume_properties = [
             'pool', 'vid', 'size', 'usage', 'rw', 'source', 'path',
@@ -380,10 +868,10 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
             if value is None:
                 value = ''
             return str(value)
-        info = ''.join('{}={}\n'.format(key, _serialize(getattr(volume, key)))
-            for key in volume_properties)
+        info = [(key, _serialize(getattr(volume, key)))
+            for key in volume_properties]
         try:
-            info += 'is_outdated={}\n'.format(volume.is_outdated())
+            info.append(('is_outdated', str(volume.is_outdated())))
         except NotImplementedError:
             pass
         return info
@@ -416,6 +904,7 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
 
         self.fire_event_for_permission(volume=volume, revision=revision)
         yield from qubes.utils.coro_maybe(volume.revert(revision))
+        self.app.mark_dirty(vm=self.dest)
         self.app.save()
 
     # write=True because this allow to clone VM - and most likely modify that
@@ -466,6 +955,7 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
             dst_volume=dst_volume)
         self.dest.volumes[self.arg] = yield from qubes.utils.coro_maybe(
             dst_volume.import_volume(src_volume))
+        self.app.mark_dirty(vm=self.dest)
         self.app.save()
 
     @qubes.api.method('admin.vm.volume.Resize',
@@ -485,6 +975,7 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
         try:
             yield from self.dest.storage.resize(self.arg, size)
         finally:  # even if calling qubes.ResizeDisk inside the VM failed
+            self.app.mark_dirty(vm=self.dest)
             self.app.save()
 
     @qubes.api.method('admin.vm.volume.Clear', no_payload=True,
@@ -511,6 +1002,7 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
             raise
         self.dest.fire_event('domain-volume-import-end',
             volume=self.arg, success=True)
+        self.app.mark_dirty(vm=self.dest)
         self.app.save()
 
     @qubes.api.method('admin.vm.volume.Set.revisions_to_keep',
@@ -530,6 +1022,7 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
         self.fire_event_for_permission(newvalue=newvalue)
 
         self.dest.volumes[self.arg].revisions_to_keep = newvalue
+        self.app.mark_dirty(vm=self.dest)
         self.app.save()
 
     @qubes.api.method('admin.vm.volume.Set.rw',
@@ -550,6 +1043,7 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
             raise qubes.exc.QubesVMNotHaltedError(self.dest)
 
         self.dest.volumes[self.arg].rw = newvalue
+        self.app.mark_dirty(vm=self.dest)
         self.app.save()
 
     @qubes.api.method('admin.vm.tag.List', no_payload=True,
@@ -778,6 +1272,7 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
         self.fire_event_for_permission(newvalue=newvalue)
 
         pool.revisions_to_keep = newvalue
+        self.app.mark_dirty(section='pools')
         self.app.save()
 
     @qubes.api.method('admin.label.List', no_payload=True,
@@ -856,6 +1351,8 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
 
         label = qubes.Label(new_index, color, self.arg)
         self.app.labels[new_index] = label
+        self.app.mark_dirty(section='labels')
+        self.app.fire_event('label-add', label=label)
         self.app.save()
 
     @qubes.api.method('admin.label.Remove', no_payload=True,
@@ -879,6 +1376,8 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
         self.fire_event_for_permission(label=label)
 
         del self.app.labels[label.index]
+        self.app.mark_dirty(section='labels')
+        self.app.fire_event('label-delete', label=label)
         self.app.save()
 
     @qubes.api.method('admin.vm.Start', no_payload=True,
@@ -927,6 +1426,208 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
         self.fire_event_for_permission()
         yield from self.dest.kill()
 
+    @qubes.api.method('admin.vm.StartMany',
+        scope='global', execute=True)
+    @asyncio.coroutine
+    def vm_start_many(self, untrusted_payload):
+        """Start multiple qubes, given in the payload one per line.
+
+        A qube is started after the qubes it depends on (its netvm, guivm and
+        audiovm, also indirectly), others are started concurrently - up to
+        :py:data:`qubes.config.api_lifecycle_parallelism` at once. For each
+        qube, ``domain-start`` or ``domain-start-failed`` (with ``reason``)
+        event is sent as soon as it is done.
+
+        Starting each qube needs to be allowed also by qrexec policy for
+        ``admin.vm.Start`` call, see :py:mod:`qubes.ext.admin`.
+        """
+        self.enforce(not self.arg)
+        self.enforce(self.dest.name == 'dom0')
+        vms = self._lifecycle_vms(untrusted_payload)
+        del untrusted_payload
+
+        # all the qubes must pass the filters
+        self.enforce(len(list(self.fire_event_for_filter(vms, vms=vms)))
+            == len(vms))
+        for vm in vms:
+            self.src.fire_event('admin-permission:admin.vm.Start',
+                pre_event=True, dest=vm, arg='')
+
+        yield from self._run_lifecycle(vms, self._lifecycle_dependencies(vms),
+            self._start_one, 'start')
+
+    @qubes.api.method('admin.vm.ShutdownMany',
+        scope='global', execute=True)
+    @asyncio.coroutine
+    def vm_shutdown_many(self, untrusted_payload):
+        """Shutdown multiple qubes, given in the payload one per line, and
+        wait for them to halt.
+
+        A qube is shut down after the qubes depending on it (for which it is
+        netvm, guivm or audiovm, also indirectly) are halted, others are shut
+        down concurrently - up to
+        :py:data:`qubes.config.api_lifecycle_parallelism` at once. For each
+        qube, ``domain-shutdown`` or ``domain-shutdown-failed`` (with
+        ``reason``) event is sent as soon as it is done.
+
+        Shutting down each qube needs to be allowed also by qrexec policy for
+        ``admin.vm.Shutdown`` call (with the same argument), see
+        :py:mod:`qubes.ext.admin`.
+        """
+        force = (self.arg == 'force')
+        self.enforce(self.arg in ('', 'force'))
+        self.enforce(self.dest.name == 'dom0')
+        vms = self._lifecycle_vms(untrusted_payload)
+        del untrusted_payload
+
+        # all the qubes must pass the filters
+        self.enforce(len(list(self.fire_event_for_filter(vms, vms=vms,
+            force=force))) == len(vms))
+        for vm in vms:
+            self.src.fire_event('admin-permission:admin.vm.Shutdown',
+                pre_event=True, dest=vm, arg=self.arg, force=force)
+
+        # reverse the dependencies
+        dependents = {vm: set() for vm in vms}
+        for vm, vm_dependencies in self._lifecycle_dependencies(vms).items():
+            for dependency in vm_dependencies:
+                dependents[dependency].add(vm)
+
+        yield from self._run_lifecycle(vms, dependents,
+            functools.partial(self._shutdown_one, force=force), 'shutdown')
+
+    def _lifecycle_vms(self, untrusted_payload):
+        '''Get qubes listed in admin.vm.StartMany/ShutdownMany payload'''
+        try:
+            untrusted_names = untrusted_payload.decode(
+                'ascii', errors='strict').splitlines()
+        except UnicodeDecodeError:
+            raise qubes.api.ProtocolError('Invalid payload')
+        self.enforce(untrusted_names)
+
+        vms = []
+        for untrusted_name in untrusted_names:
+            self.enforce(untrusted_name in self.app.domains)
+            vm = self.app.domains[untrusted_name]
+            self.enforce(not isinstance(vm, qubes.vm.adminvm.AdminVM))
+            if vm not in vms:
+                vms.append(vm)
+        return tuple(vms)
+
+    @staticmethod
+    def _lifecycle_dependencies(vms):
+        '''Build dependency graph of *vms* for starting them.
+
+        A qube depends on its netvm, guivm and audiovm, and on anything they
+        depend on. Dependencies making a cycle (possible through guivm and
+        audiovm) are dropped.
+
+        :return: dict mapping each of *vms* to a set of those of *vms*
+            it depends on
+        '''
+        def direct(vm):
+            for prop in ('netvm', 'guivm', 'audiovm'):
+                dependency = getattr(vm, prop, None)
+                if dependency is not None and not isinstance(dependency,
+                        qubes.vm.adminvm.AdminVM):
+                    yield dependency
+
+        def closure(vm):
+            seen = set()
+            pending = list(direct(vm))
+            while pending:
+                dependency = pending.pop()
+                if dependency in seen or dependency is vm:
+                    continue
+                seen.add(dependency)
+                pending.extend(direct(dependency))
+            return seen
+
+        requested = set(vms)
+        reachable = {vm: closure(vm) & requested for vm in vms}
+
+        # depth-first topological sort, skipping back edges
+        order = {}
+        visiting = set()
+
+        def visit(vm):
+            if vm in order or vm in visiting:
+                return
+            visiting.add(vm)
+            for dependency in sorted(reachable[vm]):
+                visit(dependency)
+            visiting.discard(vm)
+            order[vm] = len(order)
+
+        for vm in vms:
+            visit(vm)
+
+        return {vm: {dependency for dependency in reachable[vm]
+                if order[dependency] < order[vm]}
+            for vm in vms}
+
+    @asyncio.coroutine
+    def _run_lifecycle(self, vms, waits_for, action, action_name):
+        '''Run *action* for each of *vms*, after it was successfully done
+        for all the qubes in ``waits_for[vm]``.
+
+        :param action: coroutine function, called with a qube
+        :param str action_name: ``start`` or ``shutdown``, for events and
+            messages
+        '''
+        semaphore = asyncio.Semaphore(qubes.config.api_lifecycle_parallelism)
+        tasks = {}
+
+        @asyncio.coroutine
+        def run_one(vm):
+            try:
+                for other in waits_for[vm]:
+                    if not (yield from asyncio.shield(tasks[other])):
+                        raise qubes.exc.QubesVMError(vm,
+                            'Not attempted, {} of qube {} failed'.format(
+                                action_name, other.name))
+                yield from semaphore.acquire()
+                try:
+                    yield from action(vm)
+                finally:
+                    semaphore.release()
+            except Exception as e:  # pylint: disable=broad-except
+                self.send_event(vm, 'domain-{}-failed'.format(action_name),
+                    reason=str(e))
+                return False
+            self.send_event(vm, 'domain-{}'.format(action_name))
+            return True
+
+        for vm in vms:
+            tasks[vm] = asyncio.ensure_future(run_one(vm))
+        results = yield from asyncio.gather(*tasks.values())
+
+        failed = sorted(vm.name for vm, result in zip(tasks, results)
+            if not result)
+        if failed:
+            raise qubes.exc.QubesException('Failed to {}: {}'.format(
+                action_name, ', '.join(failed)))
+
+    @staticmethod
+    @asyncio.coroutine
+    def _start_one(vm):
+        try:
+            yield from vm.start()
+        except libvirt.libvirtError as e:
+            # change to QubesException, as in admin.vm.Start
+            raise qubes.exc.QubesException('Start failed: ' + str(e) +
+                ', see /var/log/libvirt/libxl/libxl-driver.log for details')
+
+    @staticmethod
+    @asyncio.coroutine
+    def _shutdown_one(vm, force=False):
+        if vm.is_halted():
+            return
+        try:
+            yield from vm.shutdown(force=force, wait=True)
+        except qubes.exc.QubesVMNotStartedError:
+            pass
+
     @qubes.api.method('admin.Events', no_payload=True,
         scope='global', read=True)
     @asyncio.coroutine
@@ -1394,6 +2095,8 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
             persistent=persistent)
 
         self.dest.devices[devclass].update_persistent(dev, persistent)
+        self.app.domains.update_dependencies(self.dest)
+        self.app.mark_dirty(vm=self.dest)
         self.app.save()
 
     @qubes.api.method('admin.vm.firewall.Get', no_payload=True,
@@ -1603,51 +2306,31 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
             skip_passphrase=True)
         return backup.get_backup_summary()
 
-    def _send_stats_single(self, info_time, info, only_vm, filters,
-            id_to_name_map):
-        """A single iteration of sending VM stats
+    def _send_stats_single(self, stats, only_vm, filters):
+        """Send a single sample of VM stats
 
-        :param info_time: time of previous iteration
-        :param info: information retrieved in previous iteration
+        :param stats: VM -> stats dictionary, as given by
+            :py:class:`qubes.app.VMStatsSampler`
         :param only_vm: send information only about this VM
         :param filters: filters to apply on stats before sending
-        :param id_to_name_map: ID->VM name map, may be modified
-        :return: tuple(info_time, info) - new information (to be passed to
-        the next iteration)
         """
 
-        (info_time, info) = self.app.host.get_vm_stats(info_time, info,
-            only_vm=only_vm)
-        for vm_id, vm_info in info.items():
-            if vm_id not in id_to_name_map:
-                try:
-                    name = \
-                        self.app.vmm.libvirt_conn.lookupByID(vm_id).name()
-                except libvirt.libvirtError as err:
-                    if err.get_error_code() == libvirt.VIR_ERR_NO_DOMAIN:
-                        # stubdomain or so
-                        name = None
-                    else:
-                        raise
-                id_to_name_map[vm_id] = name
-            else:
-                name = id_to_name_map[vm_id]
+        if only_vm is not None and only_vm not in stats:
+            raise qubes.exc.QubesVMNotRunningError(only_vm)
 
-            # skip VMs with unknown name
-            if name is None:
+        for vm, vm_info in stats.items():
+            if only_vm is not None and vm is not only_vm:
                 continue
 
-            if not list(qubes.api.apply_filters([name], filters)):
+            if not list(qubes.api.apply_filters([vm.name], filters)):
                 continue
 
-            self.send_event(name, 'vm-stats',
+            self.send_event(vm.name, 'vm-stats',
                 memory_kb=int(vm_info['memory_kb']),
                 cpu_time=int(vm_info['cpu_time'] / 1000000),
                 cpu_usage=int(vm_info['cpu_usage']),
                 cpu_usage_raw=int(vm_info['cpu_usage_raw']))
 
-        return info_time, info
-
     @qubes.api.method('admin.vm.Stats', no_payload=True,
         scope='global', read=True)
     @asyncio.coroutine
@@ -1666,17 +2349,74 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
 
         self.send_event(self.app, 'connection-established')
 
-        info_time = None
-        info = None
-        id_to_name_map = {0: 'dom0'}
+        # all the subscribers share a single sampling task
+        subscription = self.app.stats_sampler.subscribe()
         try:
             while True:
-                info_time, info = self._send_stats_single(info_time, info,
-                    only_vm, stats_filters, id_to_name_map)
-                yield from asyncio.sleep(self.app.stats_interval)
+                _, stats = yield from subscription.get()
+                self._send_stats_single(stats, only_vm, stats_filters)
         except asyncio.CancelledError:
             # valid method to terminate this loop
             pass
+        finally:
+            subscription.close()
+
+    @qubes.api.method('admin.vm.StatsHistory', no_payload=True,
+        scope='local', read=True)
+    @asyncio.coroutine
+    def vm_stats_history(self):
+        """Get recent stats samples of the VM, kept by qubesd.
+
+        Optional argument limits the samples to the given number of last
+        seconds. Each line is a single sample, the oldest first:
+        ``<time> <cpu_time> <cpu_usage> <cpu_usage_raw> <memory_kb>``, where
+        time is a UNIX timestamp and the rest have meaning as in
+        ``vm-stats`` event of admin.vm.Stats.
+        """
+        window = None
+        if self.arg:
+            untrusted_window = self.arg
+            self.enforce(untrusted_window.isdigit())
+            window = int(untrusted_window)
+            del untrusted_window
+
+        self.fire_event_for_permission(window=window)
+
+        sampler = self.app.stats_sampler
+        if not sampler.history_size:
+            raise qubes.exc.QubesException('VM stats history is disabled')
+
+        history = sampler.history.get(self.dest)
+        if history is None:
+            return ''
+        since = time.time() - window if window else None
+        return ''.join(
+            '{:.3f} {} {} {} {}\n'.format(sample_time, cpu_time // 1000000,
+                cpu_usage, cpu_usage_raw, memory_kb)
+            for sample_time, cpu_time, cpu_usage, cpu_usage_raw, memory_kb
+            in history.get(since))
+
+    @qubes.api.method('admin.vm.StartTimings', no_payload=True,
+        scope='local', read=True)
+    @asyncio.coroutine
+    def vm_start_timings(self):
+        """Get percentiles of durations of startup phases of the VM, from
+        its recent successful startups. Called on dom0, aggregates startups
+        of all VMs.
+
+        Each line describes a single phase (``total`` for the whole startup):
+        ``<phase> count=<n> p50=<s> p90=<s> p99=<s> max=<s>``
+        (see :py:class:`qubes.api.metrics.StartupMetrics`).
+        """
+        self.enforce(not self.arg)
+
+        self.fire_event_for_permission()
+
+        if self.app.startup_metrics is None:
+            raise qubes.exc.QubesException('Startup statistics disabled')
+        if self.dest.name == 'dom0':
+            return self.app.startup_metrics.format()
+        return self.app.startup_metrics.format(self.dest.name)
 
     @qubes.api.method('admin.vm.CurrentState', no_payload=True,
         scope='local', read=True)
@@ -1692,3 +2432,18 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
             'power_state': self.dest.get_power_state(),
         }
         return ' '.join('{}={}'.format(k, v) for k, v in state.items())
+
+    @qubes.api.method('admin.api.Stats', no_payload=True,
+        scope='global', read=True)
+    @asyncio.coroutine
+    def api_stats(self):
+        """Get statistics of qubesd API calls, in Prometheus text format
+        (see :py:class:`qubes.api.metrics.CallMetrics`)"""
+        self.enforce(self.dest.name == 'dom0')
+        self.enforce(not self.arg)
+
+        self.fire_event_for_permission()
+
+        if self.app.api_metrics is None:
+            raise qubes.exc.QubesException('API calls statistics disabled')
+        return self.app.api_metrics.format_prometheus()
@@ -30,22 +30,189 @@ import qubes.vm.adminvm
 import qubes.vm.dispvm
 
 
+def get_domain_info(domain):
+    '''Get information about a single domain, as included in system info'''
+    return {
+        'tags': list(domain.tags),
+        'type': domain.__class__.__name__,
+        'template_for_dispvms':
+            getattr(domain, 'template_for_dispvms', False),
+        'default_dispvm': (domain.default_dispvm.name if
+            getattr(domain, 'default_dispvm', None) else None),
+        'icon': str(domain.label.icon),
+        'guivm': (domain.guivm.name if getattr(domain, 'guivm', None)
+                  else None),
+        'power_state': domain.get_power_state(),
+    }
+
+
 def get_system_info(app):
-    system_info = {'domains': {
-        domain.name: {
-            'tags': list(domain.tags),
-            'type': domain.__class__.__name__,
-            'template_for_dispvms':
-                getattr(domain, 'template_for_dispvms', False),
-            'default_dispvm': (domain.default_dispvm.name if
-                getattr(domain, 'default_dispvm', None) else None),
-            'icon': str(domain.label.icon),
-            'guivm': (domain.guivm.name if getattr(domain, 'guivm', None)
-                      else None),
-            'power_state': domain.get_power_state(),
-        } for domain in app.domains
+    '''Get system info used for qrexec policy evaluation.
+
+    If the application has :py:class:`SystemInfoCache` attached, it is used
+    instead of collecting the info from scratch. The returned value must not
+    be modified.
+    '''
+    cache = getattr(app, 'system_info_cache', None)
+    if isinstance(cache, SystemInfoCache):
+        return cache.get()
+    return {'domains': {
+        domain.name: get_domain_info(domain) for domain in app.domains
     }}
-    return system_info
+
+
+class SystemInfoCache:
+    '''Snapshot of system info, updated based on events.
+
+    Collecting power state requires a few libvirt calls for each domain, so
+    the info about each domain is kept until an event about its tags,
+    relevant properties or power state is fired. Domains that are in the
+    middle of starting or shutting down, or in a state that can change
+    without an event (like ``'Transient'``), are queried each time.
+
+    Attach it to the application as :py:attr:`qubes.Qubes.system_info_cache`.
+    Only works when events are enabled on the application object.
+
+    :py:attr:`generation` is changed whenever anything besides power state
+    changes, so it can be used to cache results computed from system info
+    (like policy decisions).
+    '''
+
+    #: power states not expected to change without an event
+    stable_power_states = ('Halted', 'Running', 'Paused')
+
+    #: events starting a power state transition
+    transition_begin_events = ('domain-pre-start', 'domain-pre-shutdown')
+
+    #: events finishing a power state transition
+    transition_end_events = ('domain-start', 'domain-start-failed',
+        'domain-shutdown', 'domain-shutdown-failed', 'domain-stopped')
+
+    #: other events changing domain power state
+    power_state_events = ('domain-spawn', 'domain-paused', 'domain-unpaused')
+
+    #: events changing other domain info
+    domain_events = ('domain-tag-add:*', 'domain-tag-delete:*',
+        'property-set:*', 'property-reset:*', 'property-del:*')
+
+    #: properties included in domain info
+    domain_properties = ('label', 'template_for_dispvms', 'default_dispvm',
+        'guivm')
+
+    #: properties referenced in info about other domains
+    global_properties = ('name', 'template')
+
+    def __init__(self, app):
+        self.app = app
+        #: domain -> cached info
+        self._domains = {}
+        #: cached whole system info, if all domains could be cached
+        self._system_info = None
+        #: domains in the middle of power state transition
+        self._in_transition = set()
+        #: incremented on each change not related to power state
+        self.generation = 0
+
+        for event in ('domain-add', 'domain-delete', 'property-set:*',
+                'property-reset:*', 'property-del:*'):
+            app.add_handler(event, self._on_app_changed)
+        for domain in app.domains:
+            self._add_domain_handlers(domain)
+
+    def _domain_handlers(self):
+        for event in self.transition_begin_events:
+            yield event, self._on_transition_begin
+        for event in self.transition_end_events:
+            yield event, self._on_transition_end
+        for event in self.power_state_events:
+            yield event, self._on_power_state_changed
+        for event in self.domain_events:
+            yield event, self._on_domain_changed
+
+    def _add_domain_handlers(self, domain):
+        for event, func in self._domain_handlers():
+            domain.add_handler(event, func)
+
+    def _remove_domain_handlers(self, domain):
+        for event, func in self._domain_handlers():
+            domain.remove_handler(event, func)
+
+    def _on_app_changed(self, app, event, vm=None, **kwargs):
+        # pylint: disable=unused-argument
+        if event == 'domain-add':
+            self._add_domain_handlers(vm)
+        elif event == 'domain-delete':
+            self._remove_domain_handlers(vm)
+            self._in_transition.discard(vm)
+            self._domains.pop(vm, None)
+        # app-wide defaults may be used by any domain
+        self.invalidate()
+
+    def _on_transition_begin(self, vm, event, **kwargs):
+        # pylint: disable=unused-argument
+        self._in_transition.add(vm)
+        self.invalidate(vm, power_state_only=True)
+
+    def _on_transition_end(self, vm, event, **kwargs):
+        # pylint: disable=unused-argument
+        self._in_transition.discard(vm)
+        self.invalidate(vm, power_state_only=True)
+
+    def _on_power_state_changed(self, vm, event, **kwargs):
+        # pylint: disable=unused-argument
+        self.invalidate(vm, power_state_only=True)
+
+    def _on_domain_changed(self, vm, event, name=None, **kwargs):
+        # pylint: disable=unused-argument
+        if not event.startswith('property-'):
+            self.invalidate(vm)
+        elif name in self.global_properties:
+            self.invalidate()
+        elif name in self.domain_properties:
+            self.invalidate(vm)
+
+    def invalidate(self, vm=None, power_state_only=False):
+        '''Drop cached info about a domain, or about all of them.
+
+        :param qubes.vm.BaseVM vm: domain to drop info about, or \
+            :py:obj:`None` for all of them
+        :param bool power_state_only: only power state has changed, don't \
+            change :py:attr:`generation`
+        '''
+        self._system_info = None
+        if not power_state_only:
+            self.generation += 1
+        if vm is None:
+            self._domains.clear()
+        else:
+            self._domains.pop(vm, None)
+
+    def get(self):
+        '''Get system info, see :py:func:`get_system_info`.'''
+        if not self.app.events_enabled:
+            # nothing keeps the cache up to date
+            self.invalidate()
+        if self._system_info is not None:
+            return self._system_info
+
+        all_cached = True
+        domains = {}
+        for domain in self.app.domains:
+            try:
+                info = self._domains[domain]
+            except KeyError:
+                info = get_domain_info(domain)
+                if domain not in self._in_transition and \
+                        info['power_state'] in self.stable_power_states:
+                    self._domains[domain] = info
+                else:
+                    all_cached = False
+            domains[domain.name] = info
+
+        system_info = {'domains': domains}
+        if all_cached and self.app.events_enabled:
+            self._system_info = system_info
+        return system_info
 
 
 class QubesInternalAPI(qubes.api.AbstractQubesAPI):
@@ -192,6 +359,9 @@ class QubesInternalAPI(qubes.api.AbstractQubesAPI):
                 coros.append(vm.suspend())
         if coros:
             yield from asyncio.wait(coros)
+        # suspend doesn't fire any events
+        if self.app.system_info_cache is not None:
+            self.app.system_info_cache.invalidate(power_state_only=True)
 
     @qubes.api.method('internal.SuspendPost', no_payload=True)
     @asyncio.coroutine
@@ -211,6 +381,8 @@ class QubesInternalAPI(qubes.api.AbstractQubesAPI):
                 coros.append(vm.resume())
         if coros:
             yield from asyncio.wait(coros)
+        if self.app.system_info_cache is not None:
+            self.app.system_info_cache.invalidate(power_state_only=True)
 
         # then notify all VMs
         processes = []
@@ -0,0 +1,510 @@
+# -*- encoding: utf8 -*-
+#
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# Copyright (C) 2017 Marek Marczykowski-Górecki
+#                               <marmarek@invisiblethingslab.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, see <https://www.gnu.org/licenses/>.
+
+''' Instrumentation of qubesd API calls and its event loop. '''
+
+import asyncio
+import bisect
+import collections
+import logging
+import os
+import shutil
+import sys
+import threading
+import time
+import traceback
+
+import qubes.api
+
+
+class Histogram:
+    '''Histogram of durations (in seconds), with fixed buckets'''
+
+    __slots__ = ('counts', 'sum')
+
+    #: upper bounds of buckets; the last bucket has no upper bound
+    buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+        0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        '''Add a single measurement'''
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    @property
+    def count(self):
+        '''Number of measurements'''
+        return sum(self.counts)
+
+    def format_prometheus(self, name, labels):
+        '''Format as Prometheus histogram samples
+
+        :param str name: metric name
+        :param str labels: formatted labels, without braces
+        '''
+        prefix = labels + ',' if labels else ''
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            cumulative += count
+            yield '{}_bucket{{{}le="{}"}} {}\n'.format(
+                name, prefix, bound, cumulative)
+        labels = '{' + labels + '}' if labels else ''
+        yield '{}_sum{} {}\n'.format(name, labels, self.sum)
+        yield '{}_count{} {}\n'.format(name, labels, cumulative)
+
+
+class CallStats:
+    '''Statistics of calls of a single method from a single source'''
+
+    __slots__ = ('calls', 'errors', 'bytes_in', 'bytes_out', 'queue_wait',
+        'execute_time')
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        #: time between receiving the request and starting to execute it
+        self.queue_wait = Histogram()
+        #: time of executing the call, until the reply was ready
+        self.execute_time = Histogram()
+
+
+def percentile(samples, quantile):
+    '''Get percentile of measurements
+
+    :param samples: measurements
+    :param float quantile: between 0 and 1
+    '''
+    if not samples:
+        return 0.
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(quantile * len(samples)))]
+
+
+def _format_label_value(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n')
+
+
+class CallMetrics:
+    '''Statistics of API calls, by method and source qube.
+
+    Attach it to the application as :py:attr:`qubes.Qubes.api_metrics`, to
+    have all calls recorded by :py:class:`qubes.api.QubesDaemonProtocol`.
+    Recording a call costs a few dictionary and list operations, so it can
+    stay enabled.
+
+    Calls taking longer than *slow_call_threshold* seconds are logged, except
+    methods classified ``execute`` (like starting a qube), which are
+    expected to take long, and :py:attr:`long_running_methods`.
+
+    :param float slow_call_threshold: in seconds, :py:obj:`None` to not log \
+        slow calls
+    '''
+
+    #: methods sending events until cancelled
+    long_running_methods = ('admin.Events', 'admin.vm.Stats')
+
+    def __init__(self, slow_call_threshold=None):
+        self.slow_call_threshold = slow_call_threshold
+        #: (method, source) -> :py:class:`CallStats`
+        self.calls = {}
+        #: :py:class:`LoopWatchdog` to include statistics of, if any
+        self.loop_watchdog = None
+        #: :py:class:`StartupMetrics` to include statistics of, if any
+        self.startup_metrics = None
+        #: :py:class:`qubes.api.admin.ResponseCache` to include statistics
+        #: of, if any
+        self.response_cache = None
+        self.log = logging.getLogger('qubes.api.metrics')
+
+    def record(self, handler, src, meth, dest, arg, *, queue_wait,
+            execute_time, bytes_in, bytes_out, error):
+        '''Record a finished call.
+
+        Method names not known to *handler* are recorded as ``'unknown'``,
+        to not let clients create arbitrary number of entries.
+
+        :param handler: API class handling the call
+        :param bytes src: source qube name
+        :param bytes meth: method name
+        :param bytes dest: destination qube name
+        :param bytes arg: argument
+        :param float queue_wait: time waited before execution
+        :param float execute_time: execution time
+        :param int bytes_in: size of the payload
+        :param int bytes_out: size of the reply
+        :param bool error: whether the call failed
+        '''
+        method = meth.decode('ascii', 'replace')
+        routing_table = handler.get_routing_table()
+        if method not in routing_table:
+            method = 'unknown'
+        source = src.decode('ascii', 'replace')
+        try:
+            stats = self.calls[method, source]
+        except KeyError:
+            stats = self.calls[method, source] = CallStats()
+        stats.calls += 1
+        if error:
+            stats.errors += 1
+        stats.bytes_in += bytes_in
+        stats.bytes_out += bytes_out
+        stats.queue_wait.observe(queue_wait)
+        stats.execute_time.observe(execute_time)
+
+        if self.slow_call_threshold is not None \
+                and execute_time >= self.slow_call_threshold \
+                and method in routing_table \
+                and method not in self.long_running_methods \
+                and not routing_table[method][2].get('execute', False):
+            self.log.warning(
+                'slow call %s+%s (%s → %s): %.3fs, waited %.3fs',
+                method, arg.decode('ascii', 'replace'), source,
+                dest.decode('ascii', 'replace'), execute_time, queue_wait)
+
+    def format_prometheus(self):
+        '''Format all the statistics in Prometheus text format'''
+        calls = sorted(self.calls.items())
+        lines = []
+
+        def add_metric(name, metric_type, description, attr):
+            lines.append('# HELP {} {}\n'.format(name, description))
+            lines.append('# TYPE {} {}\n'.format(name, metric_type))
+            for (method, source), stats in calls:
+                labels = 'method="{}",source="{}"'.format(
+                    _format_label_value(method), _format_label_value(source))
+                value = getattr(stats, attr)
+                if metric_type == 'histogram':
+                    lines.extend(value.format_prometheus(name, labels))
+                else:
+                    lines.append('{}{{{}}} {}\n'.format(name, labels, value))
+
+        add_metric('qubesd_api_calls_total', 'counter',
+            'Number of API calls', 'calls')
+        add_metric('qubesd_api_errors_total', 'counter',
+            'Number of failed API calls', 'errors')
+        add_metric('qubesd_api_received_bytes_total', 'counter',
+            'Size of API call payloads', 'bytes_in')
+        add_metric('qubesd_api_sent_bytes_total', 'counter',
+            'Size of API call replies (without events)', 'bytes_out')
+        add_metric('qubesd_api_queue_wait_seconds', 'histogram',
+            'Time between receiving an API call and executing it',
+            'queue_wait')
+        add_metric('qubesd_api_execute_seconds', 'histogram',
+            'Time of executing API calls', 'execute_time')
+
+        lines.append('# HELP qubesd_api_events_total '
+            'Events sent to API clients, by what happened to them\n')
+        lines.append('# TYPE qubesd_api_events_total counter\n')
+        for state, count in sorted(
+                qubes.api.QubesDaemonProtocol.event_counters.items()):
+            lines.append('qubesd_api_events_total{{state="{}"}} {}\n'.format(
+                state, count))
+
+        if self.loop_watchdog is not None:
+            lines.extend(self.loop_watchdog.format_prometheus())
+        if self.startup_metrics is not None:
+            lines.extend(self.startup_metrics.format_prometheus())
+        if self.response_cache is not None:
+            lines.extend(self.response_cache.format_prometheus())
+
+        return ''.join(lines)
+
+
+def _find_api_call(frame):
+    '''Find API call executed in the stack of *frame*'''
+    while frame is not None:
+        obj = frame.f_locals.get('self')
+        if isinstance(obj, qubes.api.AbstractQubesAPI):
+            return obj
+        frame = frame.f_back
+    return None
+
+
+class LoopWatchdog:
+    '''Measure lag of the event loop, and find what blocks it.
+
+    A callback scheduled every *interval* seconds measures how late it was
+    called. A thread checks if the callback is overdue by more than
+    *stall_threshold* seconds, and if so, captures the stack of the event
+    loop thread - which is then still executing the blocking code. When the
+    loop gets back, the stall is logged with the stack and the API call it
+    happened in.
+
+    :param float interval: in seconds
+    :param float stall_threshold: in seconds, :py:obj:`None` to only \
+        measure the lag
+    '''
+
+    #: number of recent lag measurements used for percentiles
+    samples_size = 1000
+
+    #: percentiles of lag published
+    quantiles = (0.5, 0.9, 0.99, 1.0)
+
+    def __init__(self, interval=0.25, stall_threshold=None, loop=None):
+        self.interval = interval
+        self.stall_threshold = stall_threshold
+        self.loop = loop or asyncio.get_event_loop()
+        #: recent lag measurements
+        self.samples = collections.deque(maxlen=self.samples_size)
+        #: all lag measurements
+        self.lag = Histogram()
+        #: number of times the loop was blocked for longer than
+        #: *stall_threshold*
+        self.stalls = 0
+        self.log = logging.getLogger('qubes.api.metrics')
+
+        self._handle = None
+        self._expected = None
+        #: :py:func:`time.monotonic` time of the last callback
+        self._last_beat = None
+        self._loop_thread_id = None
+        self._thread = None
+        self._stopped = threading.Event()
+        #: (stack, API call) captured by the thread in the current stall
+        self._stall = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        '''Start the measurements; must be called from the event loop
+        thread'''
+        self._loop_thread_id = threading.get_ident()
+        self._last_beat = time.monotonic()
+        self._schedule()
+        if self.stall_threshold is not None:
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._watch,
+                name='loop-watchdog', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        '''Stop the measurements'''
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        if self._thread is not None:
+            self._stopped.set()
+            self._thread.join()
+            self._thread = None
+
+    def _schedule(self):
+        self._expected = self.loop.time() + self.interval
+        self._handle = self.loop.call_at(self._expected, self._beat)
+
+    def _beat(self):
+        lag = max(0., self.loop.time() - self._expected)
+        self.samples.append(lag)
+        self.lag.observe(lag)
+        with self._lock:
+            self._last_beat = time.monotonic()
+            stall, self._stall = self._stall, None
+
+        if self.stall_threshold is not None and lag >= self.stall_threshold:
+            self.stalls += 1
+            if stall is None:
+                self.log.warning('event loop blocked for %.3fs', lag)
+            else:
+                stack, call = stall
+                self.log.warning('event loop blocked for %.3fs%s, at:\n%s',
+                    lag,
+                    '' if call is None else ' in call {}+{} ({} → {})'.format(
+                        call.method, call.arg, call.src.name, call.dest.name),
+                    ''.join(stack).rstrip())
+        self._schedule()
+
+    def _watch(self):
+        while not self._stopped.wait(self.interval):
+            self.check()
+
+    def check(self):
+        '''Capture the stack of the event loop thread, if it is blocked.
+
+        Called periodically from the watchdog thread.
+        '''
+        with self._lock:
+            if self._stall is not None or time.monotonic() \
+                    - self._last_beat - self.interval < self.stall_threshold:
+                return
+            # pylint: disable=protected-access
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                return
+            self._stall = (traceback.format_stack(frame),
+                _find_api_call(frame))
+
+    def percentile(self, quantile):
+        '''Get percentile of recent lag measurements
+
+        :param float quantile: between 0 and 1
+        '''
+        return percentile(self.samples, quantile)
+
+    def format_prometheus(self):
+        '''Format statistics in Prometheus text format'''
+        yield '# HELP qubesd_loop_lag_seconds Delay of event loop ' \
+            'callbacks (recent measurements)\n'
+        yield '# TYPE qubesd_loop_lag_seconds summary\n'
+        for quantile in self.quantiles:
+            yield 'qubesd_loop_lag_seconds{{quantile="{}"}} {}\n'.format(
+                quantile, self.percentile(quantile))
+        yield 'qubesd_loop_lag_seconds_sum {}\n'.format(self.lag.sum)
+        yield 'qubesd_loop_lag_seconds_count {}\n'.format(self.lag.count)
+        yield '# HELP qubesd_loop_stalls_total Number of times the event ' \
+            'loop was blocked for too long\n'
+        yield '# TYPE qubesd_loop_stalls_total counter\n'
+        yield 'qubesd_loop_stalls_total {}\n'.format(self.stalls)
+
+
+class StartupMetrics:
+    '''Durations of qube startup phases, collected from
+    ``domain-start-timings`` events (see
+    :py:class:`qubes.vm.startup.StartupTimings`).
+
+    Only successful startups are included; the duration of the whole startup
+    is recorded as ``'total'`` phase. Percentiles are computed from the
+    *samples_size* most recent startups of each qube.
+
+    Attach it to the application as :py:attr:`qubes.Qubes.startup_metrics`.
+    Only works when events are enabled on the application object.
+
+    :param int samples_size: number of recent startups of each qube kept
+    '''
+
+    #: percentiles of phases durations published
+    quantiles = (0.5, 0.9, 0.99, 1.0)
+
+    def __init__(self, app, samples_size=100):
+        self.app = app
+        self.samples_size = samples_size
+        #: qube name -> phase -> recent durations
+        self.samples = {}
+
+        app.add_handler('domain-add', self._on_domain_add)
+        app.add_handler('domain-delete', self._on_domain_delete)
+        for domain in app.domains:
+            domain.add_handler('domain-start-timings', self._on_start_timings)
+
+    def _on_domain_add(self, app, event, vm, **kwargs):
+        # pylint: disable=unused-argument
+        vm.add_handler('domain-start-timings', self._on_start_timings)
+
+    def _on_domain_delete(self, app, event, vm, **kwargs):
+        # pylint: disable=unused-argument
+        vm.remove_handler('domain-start-timings', self._on_start_timings)
+        self.samples.pop(vm.name, None)
+
+    def _on_start_timings(self, vm, event, success, total, timings):
+        # pylint: disable=unused-argument
+        if not success:
+            return
+        vm_samples = self.samples.setdefault(vm.name, {})
+        for phase, duration in timings + (('total', total),):
+            try:
+                phase_samples = vm_samples[phase]
+            except KeyError:
+                phase_samples = vm_samples[phase] = collections.deque(
+                    maxlen=self.samples_size)
+            phase_samples.append(duration)
+
+    def phases(self, vm=None):
+        '''Get recent durations of each phase
+
+        :param str vm: name of the qube, :py:obj:`None` for all of them
+        :returns: dict phase -> list of durations
+        '''
+        if vm is not None:
+            return {phase: list(samples) for phase, samples
+                in self.samples.get(vm, {}).items()}
+        phases = {}
+        for vm_samples in self.samples.values():
+            for phase, samples in vm_samples.items():
+                phases.setdefault(phase, []).extend(samples)
+        return phases
+
+    def format(self, vm=None):
+        '''Format percentiles of durations of each phase, one phase per line:
+        ``phase count=... p50=... p90=... p99=... max=...``
+
+        :param str vm: name of the qube, :py:obj:`None` for all of them
+        '''
+        lines = []
+        for phase, samples in sorted(self.phases(vm).items()):
+            lines.append('{} count={} {}\n'.format(phase, len(samples),
+                ' '.join('{}={:.3f}'.format(
+                    'max' if quantile == 1.0 else 'p{:g}'.format(
+                        quantile * 100),
+                    percentile(samples, quantile))
+                    for quantile in self.quantiles)))
+        return ''.join(lines)
+
+    def format_prometheus(self):
+        '''Format statistics in Prometheus text format'''
+        yield '# HELP qubesd_vm_start_phase_seconds Duration of qube ' \
+            'startup phases (recent startups)\n'
+        yield '# TYPE qubesd_vm_start_phase_seconds summary\n'
+        for phase, samples in sorted(self.phases().items()):
+            label = 'phase="{}"'.format(_format_label_value(phase))
+            for quantile in self.quantiles:
+                yield 'qubesd_vm_start_phase_seconds{{{},quantile="{}"}} ' \
+                    '{}\n'.format(label, quantile,
+                        percentile(samples, quantile))
+            yield 'qubesd_vm_start_phase_seconds_sum{{{}}} {}\n'.format(
+                label, sum(samples))
+            yield 'qubesd_vm_start_phase_seconds_count{{{}}} {}\n'.format(
+                label, len(samples))
+
+
+class _MetricsProtocol(asyncio.Protocol):
+    '''Send the statistics to each client connecting, then disconnect'''
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    def connection_made(self, transport):
+        transport.write(self.metrics.format_prometheus().encode('utf-8'))
+        transport.close()
+
+
+@asyncio.coroutine
+def create_server(metrics, sockpath, loop=None):
+    '''Serve the statistics in Prometheus text format on a socket
+
+    :param CallMetrics metrics: the statistics
+    :param str sockpath: socket path
+    '''
+    loop = loop or asyncio.get_event_loop()
+    if os.path.exists(sockpath):
+        qubes.api.cleanup_socket(sockpath, False)
+    old_umask = os.umask(0o007)
+    try:
+        server = yield from loop.create_unix_server(
+            lambda: _MetricsProtocol(metrics), sockpath)
+    finally:
+        os.umask(old_umask)
+    for sock in server.sockets:
+        shutil.chown(sock.getsockname(), group='qubes')
+    return server
@@ -0,0 +1,494 @@
+# -*- encoding: utf8 -*-
+#
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# Copyright (C) 2017 Marek Marczykowski-Górecki
+#                               <marmarek@invisiblethingslab.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, see <https://www.gnu.org/licenses/>.
+
+''' Worker processes serving read-only API calls on behalf of qubesd. '''
+
+import array
+import asyncio
+import functools
+import itertools
+import logging
+import os
+import signal
+import socket
+import struct
+import threading
+
+import lxml.etree
+
+import qubes
+import qubes.api
+import qubes.exc
+
+#: header of a message to the fork server (followed by the snapshot), and
+#: of the message a worker sends when it is ready
+_header = struct.Struct('=I')
+
+#: objects inherited by the fork server from qubesd and holding its file
+#: descriptors; kept referenced, so they will not close descriptors
+#: (possibly reused by then) when garbage-collected
+_inherited_objects = []
+
+
+class ReadWorker(asyncio.Protocol):
+    '''Connection to a single worker process, on the qubesd side.
+
+    The worker speaks :py:class:`qubes.api.QubesDaemonProtocol` in multiple
+    requests mode over a socket pair. Before that, it sends its process ID,
+    once it has loaded the snapshot.
+
+    :param int pid: worker process ID, :py:obj:`None` to wait for the \
+        worker to send it
+    :param int generation: :py:attr:`ReadWorkerPool.generation` of the
+        snapshot the worker has
+    '''
+
+    def __init__(self, pid, generation):
+        self.pid = pid
+        self.generation = generation
+        self.transport = None
+        self._buffer = bytearray()
+        #: request id -> future of the reply
+        self._pending = {}
+        self._request_ids = itertools.count(1)
+
+    @property
+    def alive(self):
+        '''Can the worker take requests'''
+        return self.pid is not None and self.transport is not None \
+            and not self.transport.is_closing()
+
+    @property
+    def load(self):
+        '''Number of requests being served'''
+        return len(self._pending)
+
+    def connection_made(self, transport):
+        self.transport = transport
+        transport.write(qubes.api.QubesDaemonProtocol.framed_magic)
+
+    def connection_lost(self, exc):
+        self.transport = None
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(
+                    ConnectionError('worker {} exited'.format(self.pid)))
+        self._pending.clear()
+
+    def data_received(self, data):
+        frame_header = qubes.api.QubesDaemonProtocol.frame_header
+        self._buffer.extend(data)
+        if self.pid is None:
+            if len(self._buffer) < _header.size:
+                return
+            self.pid, = _header.unpack_from(self._buffer)
+            del self._buffer[:_header.size]
+        while len(self._buffer) >= frame_header.size:
+            request_id, length = frame_header.unpack_from(self._buffer)
+            frame_end = frame_header.size + length
+            if len(self._buffer) < frame_end:
+                break
+            message = bytes(self._buffer[frame_header.size:frame_end])
+            del self._buffer[:frame_end]
+            if message[:1] == b'\x31':
+                # events are not expected from methods served by workers
+                continue
+            future = self._pending.pop(request_id, None)
+            if future is not None and not future.done():
+                future.set_result(message)
+
+    def call(self, request):
+        '''Send a request (in qubesd socket format) to the worker.
+
+        :return: future of the encoded reply; empty if the call failed
+            without a reply
+        '''
+        request_id = next(self._request_ids) & 0xffffffff
+        future = asyncio.get_event_loop().create_future()
+        self._pending[request_id] = future
+        self.transport.write(qubes.api.QubesDaemonProtocol.frame_header.pack(
+            request_id, len(request)) + request)
+        return future
+
+    def retire(self):
+        '''Stop taking new requests; the worker exits when it is done with
+        the pending ones'''
+        if self.alive:
+            self.transport.write_eof()
+
+
+class _WorkerProtocol(qubes.api.QubesDaemonProtocol):
+    '''Protocol of the worker side of the connection'''
+
+    def connection_lost(self, exc):
+        super().connection_lost(exc)
+        asyncio.get_event_loop().stop()
+
+
+class ReadWorkerPool:
+    '''Pool of worker processes serving read-only calls of an API.
+
+    Each worker is a process loading a snapshot of the whole application
+    state (serialized the same way as :file:`qubes.xml`) sent by qubesd, and
+    executes the calls against it on its own event loop, in parallel with
+    qubesd and other workers.
+
+    Workers are not forked from qubesd directly - it has threads by then,
+    and a child of a multi-threaded process may inherit locks held by them
+    (in Python or in C libraries, like libvirt), which would never be
+    released. Instead, a fork server process is forked early, while qubesd
+    has a single thread (see :py:meth:`start`), and it forks the workers.
+
+    The snapshot is kept fresh by a feed of changes from qubesd: each event
+    changing the state, fired on the application or any domain (see
+    :py:attr:`state_events`), advances :py:attr:`generation`. Workers having
+    an older snapshot don't take new requests, and are replaced with new
+    ones. Until a worker with
+    the current snapshot is available, calls are executed by qubesd itself,
+    so a worker never returns outdated data.
+
+    Calls of methods classified as ``read`` only (without ``write`` or
+    ``execute``) are served by workers, except
+    :py:attr:`primary_only_methods`.
+
+    :param qubes.Qubes app: the application
+    :param handler: API class (child of :py:class:`qubes.api.AbstractQubesAPI`)
+    :param int size: number of worker processes
+    :param bool debug: passed to the workers' protocol
+    '''
+
+    #: events changing the state; other events (queries, stats,
+    #: permission checks, ``*-pre-*`` events) are ignored
+    state_events = frozenset(('domain-add', 'domain-delete', 'label-add',
+        'label-delete', 'pool-add', 'pool-delete', 'firewall-changed',
+        'domain-volume-import-end', 'domain-spawn', 'domain-start',
+        'domain-start-failed', 'domain-paused', 'domain-unpaused',
+        'domain-shutdown', 'domain-stopped'))
+
+    #: prefixes of events (with an argument) changing the state
+    state_event_prefixes = ('property-set:', 'property-del:',
+        'domain-feature-set:', 'domain-feature-delete:', 'domain-tag-add:',
+        'domain-tag-delete:', 'device-attach:', 'device-detach:')
+
+    #: methods depending on state kept by qubesd only, or sending events
+    primary_only_methods = ('admin.Events', 'admin.vm.Stats',
+        'admin.vm.StatsHistory', 'admin.vm.StartTimings', 'admin.api.Stats')
+
+    def __init__(self, app, handler, size, debug=False):
+        self.app = app
+        self.handler = handler
+        self.size = size
+        self.debug = debug
+        #: version of the application state, advanced on each change
+        self.generation = 0
+        self.workers = []
+        self._respawn_handle = None
+        #: socket connected to the fork server, and its process ID
+        self._fork_server = None
+        self._fork_server_pid = None
+        #: (generation, serialized state) sent to the workers
+        self._snapshot = None
+
+        app.add_handler('*', self._on_event)
+        app.add_handler('domain-add', self._on_domain_add)
+        app.add_handler('domain-delete', self._on_domain_delete)
+        for vm in app.domains:
+            vm.add_handler('*', self._on_event)
+
+    def start(self):
+        '''Start the fork server.
+
+        Must be called before qubesd starts any thread, like
+        :py:class:`qubes.utils.BlockingExecutor` or
+        :py:class:`qubes.api.metrics.LoopWatchdog`.
+        '''
+        assert threading.active_count() == 1, \
+            'API workers fork server started after other threads'
+        server_sock, pool_sock = socket.socketpair()
+        pid = os.fork()
+        if pid == 0:
+            # pylint: disable=broad-except
+            try:
+                pool_sock.detach()
+                _inherited_objects.append((asyncio.get_event_loop(),
+                    self.app))
+                _run_fork_server(server_sock, self.app.store, self.handler,
+                    self.debug)
+            except BaseException:
+                logging.getLogger('qubes.api.workers').exception(
+                    'API workers fork server failed')
+            finally:
+                os._exit(0)  # pylint: disable=protected-access
+
+        server_sock.close()
+        self._fork_server = pool_sock
+        self._fork_server_pid = pid
+
+    def close(self):
+        '''Stop all the workers, and the fork server'''
+        if self._respawn_handle is not None:
+            self._respawn_handle.cancel()
+            self._respawn_handle = None
+        self.app.remove_handler('*', self._on_event)
+        self.app.remove_handler('domain-add', self._on_domain_add)
+        self.app.remove_handler('domain-delete', self._on_domain_delete)
+        for vm in self.app.domains:
+            vm.remove_handler('*', self._on_event)
+        for worker in self.workers:
+            if worker.transport is not None:
+                worker.transport.close()
+        self.workers.clear()
+        if self._fork_server is not None:
+            self._fork_server.close()
+            self._fork_server = None
+            os.waitpid(self._fork_server_pid, 0)
+            self._fork_server_pid = None
+        self._snapshot = None
+
+    def _on_event(self, subject, event, **kwargs):
+        # pylint: disable=unused-argument
+        if event in self.state_events \
+                or event.startswith(self.state_event_prefixes):
+            self.generation += 1
+
+    def _on_domain_add(self, subject, event, vm):
+        # pylint: disable=unused-argument
+        vm.add_handler('*', self._on_event)
+
+    def _on_domain_delete(self, subject, event, vm):
+        # pylint: disable=unused-argument
+        vm.remove_handler('*', self._on_event)
+
+    def can_serve(self, handler, meth):
+        '''Check if a call should be served by a worker
+
+        :param handler: API class handling the call
+        :param bytes meth: method name
+        '''
+        if handler is not self.handler:
+            return False
+        try:
+            meth = meth.decode('ascii')
+            _, _, classifiers = handler.get_routing_table()[meth]
+        except (UnicodeDecodeError, KeyError):
+            return False
+        return (classifiers.get('read', False)
+            and not classifiers.get('write', False)
+            and not classifiers.get('execute', False)
+            and meth not in self.primary_only_methods)
+
+    def _get_worker(self):
+        fresh = [worker for worker in self.workers
+            if worker.alive and worker.generation == self.generation]
+        if len(fresh) < self.size and self._respawn_handle is None:
+            self._respawn_handle = \
+                asyncio.get_event_loop().call_soon(self._respawn)
+        if not fresh:
+            return None
+        return min(fresh, key=lambda worker: worker.load)
+
+    def _respawn(self):
+        self._respawn_handle = None
+        for worker in list(self.workers):
+            if worker.transport is None or worker.transport.is_closing() \
+                    or worker.generation != self.generation:
+                worker.retire()
+                self.workers.remove(worker)
+        for _ in range(self.size - len(self.workers)):
+            try:
+                self._spawn()
+            except OSError:
+                self.app.log.exception('Failed to start API worker')
+                break
+
+    def _get_snapshot(self):
+        if self._snapshot is None or self._snapshot[0] != self.generation:
+            self._snapshot = (self.generation,
+                lxml.etree.tostring(self.app.__xml__(), encoding='utf-8'))
+        return self._snapshot[1]
+
+    def _spawn(self):
+        if self._fork_server is None:
+            return
+        worker_sock, pool_sock = socket.socketpair()
+        try:
+            snapshot = self._get_snapshot()
+            self._fork_server.sendmsg([_header.pack(len(snapshot))],
+                [(socket.SOL_SOCKET, socket.SCM_RIGHTS,
+                    array.array('i', [worker_sock.fileno()]))])
+            self._fork_server.sendall(snapshot)
+        except OSError:
+            pool_sock.close()
+            raise
+        finally:
+            worker_sock.close()
+        worker = ReadWorker(None, self.generation)
+        asyncio.ensure_future(asyncio.get_event_loop().create_unix_connection(
+            lambda: worker, sock=pool_sock))
+        self.workers.append(worker)
+
+    @asyncio.coroutine
+    def call(self, src, meth, dest, arg, untrusted_payload):
+        '''Execute a call in a worker.
+
+        :return: encoded reply (empty if the call failed without a reply),
+            or :py:obj:`None` if there is no worker with the current snapshot
+            available - the call should be executed locally then
+        '''
+        worker = self._get_worker()
+        if worker is None:
+            return None
+        request = b''.join((meth, b'+' + arg if arg else b'', b' ', src,
+            b' name ', dest, b'\0', untrusted_payload))
+        try:
+            return (yield from worker.call(request))
+        except ConnectionError:
+            return None
+
+
+def _close_inherited_fds(keep):
+    '''Close file descriptors inherited from qubesd, except *keep*'''
+    fd_dir = '/proc/self/fd'
+    for fd in sorted(int(name) for name in os.listdir(fd_dir)):
+        if fd not in keep:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+
+def _recv_exactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise EOFError
+        data.extend(chunk)
+    return bytes(data)
+
+
+def _run_fork_server(sock, store, handler, debug):
+    '''Main function of the fork server process.
+
+    Receives requests from :py:meth:`ReadWorkerPool._spawn`: a socket for
+    the worker (passed as ancillary data) and the snapshot of the state, and
+    forks a worker for each.
+    '''
+    signal.set_wakeup_fd(-1)
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, signal.SIG_DFL)
+    # workers are not waited for, let them be reaped automatically
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+
+    # do not keep anything of qubesd open (client connections, libvirt...),
+    # logging (including per-qube logs, reused by workers) is kept
+    keep = {0, 1, 2, sock.fileno()}
+    loggers = [logging.root] + [logger
+        for logger in logging.Logger.manager.loggerDict.values()
+        if isinstance(logger, logging.Logger)]
+    for logger in loggers:
+        for log_handler in logger.handlers:
+            stream = getattr(log_handler, 'stream', None)
+            if stream is not None and hasattr(stream, 'fileno'):
+                keep.add(stream.fileno())
+    _close_inherited_fds(keep)
+
+    fd_size = array.array('i').itemsize
+    while True:
+        header, ancdata, _, _ = sock.recvmsg(_header.size,
+            socket.CMSG_LEN(fd_size))
+        if not header:
+            # qubesd closed the connection
+            return
+        fds = array.array('i')
+        for level, cmsg_type, data in ancdata:
+            if level == socket.SOL_SOCKET and cmsg_type == socket.SCM_RIGHTS:
+                fds.frombytes(data[:len(data) - (len(data) % fd_size)])
+        if len(header) < _header.size:
+            header += _recv_exactly(sock, _header.size - len(header))
+        size, = _header.unpack(header)
+        snapshot = _recv_exactly(sock, size)
+        if len(fds) != 1:
+            for fd in fds:
+                os.close(fd)
+            continue
+        worker_sock = socket.socket(fileno=fds[0])
+
+        pid = os.fork()
+        if pid == 0:
+            # pylint: disable=broad-except
+            try:
+                sock.close()
+                signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                _run_worker(store, snapshot, handler, worker_sock, debug)
+            except BaseException:
+                logging.getLogger('qubes.api.workers').exception(
+                    'API worker failed')
+            finally:
+                os._exit(0)  # pylint: disable=protected-access
+        worker_sock.close()
+
+
+def _load_worker_app(store, snapshot):
+    '''Load the application object of a worker from *snapshot*.
+
+    Must be called with the worker's event loop set as the current one.
+    '''
+    # Extensions are singletons, inherited from qubesd. The policy cache of
+    # AdminExtension watches for policy changes on qubesd's event loop, so
+    # let the new application object create a fresh one.
+    import qubes.ext.admin
+    _inherited_objects.append(
+        qubes.ext.admin.AdminExtension().detach_policy_cache())
+
+    # A fresh instance: no libvirt event handlers are registered (so libvirt
+    # state is not cached), nor anything of qubesd is shared. It's loaded in
+    # offline mode, to not set up QubesDB watches (needed by qubesd only) and
+    # query libvirt about each domain upfront, then libvirt is used as needed.
+    app = qubes.Qubes(store, load=False, offline_mode=True)
+    app.events_enabled = False
+    app.load(xml=lxml.etree.ElementTree(lxml.etree.fromstring(snapshot)))
+    app.events_enabled = True
+    app.vmm._offline_mode = False  # pylint: disable=protected-access
+
+    def read_only_save(*args, **kwargs):
+        raise qubes.exc.QubesException('read-only API worker')
+    app.save = read_only_save
+    return app
+
+
+def _run_worker(store, snapshot, handler, sock, debug):
+    '''Main function of a worker process'''
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        import libvirtaio
+        libvirtaio.virEventRegisterAsyncIOImpl(loop=loop)
+    except ImportError:
+        pass
+
+    app = _load_worker_app(store, snapshot)
+    del snapshot
+
+    sock.sendall(_header.pack(os.getpid()))
+    loop.run_until_complete(loop.connect_accepted_socket(
+        functools.partial(_WorkerProtocol, handler, app=app, debug=debug),
+        sock))
+    loop.run_forever()
@@ -20,6 +20,7 @@
 # License along with this library; if not, see <https://www.gnu.org/licenses/>.
 #
 
+import array
 import collections.abc
 import copy
 import functools
@@ -32,6 +33,7 @@ import sys
 import tempfile
 import time
 import traceback
+import threading
 import uuid
 
 import asyncio
@@ -116,18 +118,26 @@ class VirConnectWrapper:
     def __init__(self, uri, reconnect_cb=None):
         self._conn = libvirt.open(uri)
         self._reconnect_cb = reconnect_cb
+        # calls may be made from threads of qubes.utils.BlockingExecutor
+        self._reconnect_lock = threading.Lock()
 
     def _reconnect_if_dead(self):
-        is_dead = not self._conn.isAlive()
-        if is_dead:
-            uri = self._conn.getURI()
-            old_conn = self._conn
-            self._conn = libvirt.open(uri)
-            if callable(self._reconnect_cb):
-                self._reconnect_cb(old_conn)
-            old_conn.close()
+        with self._reconnect_lock:
+            is_dead = not self._conn.isAlive()
+            if is_dead:
+                uri = self._conn.getURI()
+                old_conn = self._conn
+                self._conn = libvirt.open(uri)
+                # event handlers are registered in the event loop
+                qubes.utils.call_in_loop_thread(self._on_reconnected,
+                    old_conn)
         return is_dead
 
+    def _on_reconnected(self, old_conn):
+        if callable(self._reconnect_cb):
+            self._reconnect_cb(old_conn)
+        old_conn.close()
+
     def _wrap_domain(self, ret):
         if isinstance(ret, libvirt.virDomain):
             ret = VirDomainWrapper(self, ret)
@@ -396,7 +406,8 @@ class QubesHost:
         except AttributeError:
             raise NotImplementedError(
                 'This function requires Xen hypervisor')
-        # TODO: add stubdomain stats to actual VMs
+        # stubdomains are reported separately, VMStatsSampler adds their
+        # usage to the actual VMs
         for vm in info:
             domid = vm['domid']
             current[domid] = {}
@@ -418,6 +429,336 @@ class QubesHost:
         return current_time, current
 
 
+class VMStatsHistory:
+    """Ring buffer of recent stats samples of a single VM.
+
+    Each field is kept in a preallocated :py:class:`array.array`, so memory
+    used depends only on *size*, not on the number of samples taken.
+    """
+
+    #: fields of each sample, with array typecodes
+    fields = (
+        ('time', 'd'),
+        ('cpu_time', 'Q'),
+        ('cpu_usage', 'L'),
+        ('cpu_usage_raw', 'L'),
+        ('memory_kb', 'Q'),
+    )
+
+    def __init__(self, size):
+        self.size = size
+        self._arrays = [array.array(typecode, [0]) * size
+            for _, typecode in self.fields]
+        #: index of the next sample to write
+        self._next = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def append(self, sample_time, vm_info):
+        """Add a sample, replacing the oldest one if the buffer is full
+
+        :param sample_time: time of the measurement
+        :param vm_info: measurement, as returned by
+            :py:meth:`QubesHost.get_vm_stats`
+        """
+        self._arrays[0][self._next] = sample_time
+        for (name, _), values in zip(self.fields[1:], self._arrays[1:]):
+            values[self._next] = max(int(vm_info[name]), 0)
+        self._next = (self._next + 1) % self.size
+        self._count = min(self._count + 1, self.size)
+
+    def get(self, since=None):
+        """Get samples, the oldest first
+
+        :param since: get only samples taken after this time
+        :return: list of tuples, with values in order of :py:attr:`fields`
+        """
+        samples = []
+        start = self._next - self._count
+        for i in range(start, start + self._count):
+            i %= self.size
+            if since is not None and self._arrays[0][i] <= since:
+                continue
+            samples.append(tuple(values[i] for values in self._arrays))
+        return samples
+
+
+class VMStatsSubscription:
+    """A single subscriber of :py:class:`VMStatsSampler`.
+
+    Only the most recent sample is kept - a subscriber not keeping up with
+    the sampler skips older ones.
+    """
+
+    def __init__(self, sampler):
+        self.sampler = sampler
+        #: sample not retrieved yet, or an exception raised while sampling
+        self._pending = None
+        self._waiter = None
+
+    def deliver(self, sample):
+        """Pass a sample (or an exception) to the subscriber"""
+        self._pending = sample
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    @asyncio.coroutine
+    def get(self):
+        """Wait for the next sample.
+
+        :return: tuple(sample_time, stats), where *stats* is a dictionary
+            with key: VM object, value: dict as returned by
+            :py:meth:`QubesHost.get_vm_stats`
+        """
+        while self._pending is None:
+            self._waiter = asyncio.get_event_loop().create_future()
+            yield from self._waiter
+        sample, self._pending = self._pending, None
+        if isinstance(sample, Exception):
+            raise sample
+        return sample
+
+    def close(self):
+        """Stop receiving samples"""
+        self.sampler.unsubscribe(self)
+
+
+class VMStatsSampler:
+    """Shared sampler of stats of all the running VMs.
+
+    As long as there is at least one subscriber, a single task measures all
+    the domains with :py:meth:`QubesHost.get_vm_stats` every
+    :py:attr:`Qubes.stats_interval` seconds, and passes the result to every
+    subscriber. Domain IDs are mapped to VM objects using a map updated on
+    domain start and stop. Usage of a stubdomain is added to the VM it
+    serves; IDs of other domains are skipped.
+
+    With history enabled (see :py:meth:`enable_history`), the sampler runs
+    also without subscribers, and keeps recent samples of each VM in
+    :py:attr:`history`.
+
+    Failure of a measurement is passed to the subscribers, ending their
+    subscriptions. With history enabled, sampling goes on.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self._subscribers = set()
+        self._task = None
+        #: most recent sample, given to new subscribers right away
+        self._last_sample = None
+        #: domain ID -> VM object (:py:obj:`None` if not a qube)
+        self._vm_by_xid = {0: app.domains[0]}
+        #: stubdomain ID -> VM it serves
+        self._stubdom_owner = {}
+        #: whether stubdomains of VMs started before the sampler were looked
+        #: up, see :py:meth:`_get_vm_by_xid`
+        self._stubdomains_scanned = False
+        #: number of samples kept for each VM, 0 if history is disabled
+        self.history_size = 0
+        #: VM -> :py:class:`VMStatsHistory`
+        self.history = {}
+
+        app.add_handler('domain-add', self._on_domain_add)
+        app.add_handler('domain-delete', self._on_domain_delete)
+        for vm in app.domains:
+            self._add_domain_handlers(vm)
+
+    def close(self):
+        for vm in self.app.domains:
+            self._remove_domain_handlers(vm)
+        self.app.remove_handler('domain-add', self._on_domain_add)
+        self.app.remove_handler('domain-delete', self._on_domain_delete)
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self._subscribers.clear()
+        self._vm_by_xid.clear()
+        self._stubdom_owner.clear()
+        self._stubdomains_scanned = False
+        self.history.clear()
+
+    def _add_domain_handlers(self, vm):
+        vm.add_handler('domain-spawn', self._on_domain_spawn)
+        vm.add_handler('domain-stopped', self._on_domain_stopped)
+
+    def _remove_domain_handlers(self, vm):
+        vm.remove_handler('domain-spawn', self._on_domain_spawn)
+        vm.remove_handler('domain-stopped', self._on_domain_stopped)
+
+    def _on_domain_add(self, app, event, vm, **kwargs):
+        # pylint: disable=unused-argument
+        self._add_domain_handlers(vm)
+
+    def _on_domain_delete(self, app, event, vm, **kwargs):
+        # pylint: disable=unused-argument
+        self._remove_domain_handlers(vm)
+        self._forget_vm(vm)
+        self.history.pop(vm, None)
+
+    def _on_domain_spawn(self, vm, event, **kwargs):
+        # pylint: disable=unused-argument
+        xid = vm.xid
+        if xid >= 0:
+            self._vm_by_xid[xid] = vm
+            self._learn_stubdomain(vm)
+
+    def _on_domain_stopped(self, vm, event, **kwargs):
+        # pylint: disable=unused-argument
+        self._forget_vm(vm)
+
+    def _forget_vm(self, vm):
+        for xid, known_vm in list(self._vm_by_xid.items()):
+            if known_vm is vm:
+                del self._vm_by_xid[xid]
+        # stubdomains of the VM are gone too
+        for xid, owner in list(self._stubdom_owner.items()):
+            if owner is vm:
+                del self._stubdom_owner[xid]
+                self._vm_by_xid.pop(xid, None)
+
+    def _learn_stubdomain(self, vm):
+        stubdom_xid = getattr(vm, 'stubdom_xid', -1)
+        if stubdom_xid >= 0:
+            self._stubdom_owner[stubdom_xid] = vm
+
+    def _get_vm_by_xid(self, xid):
+        try:
+            return self._vm_by_xid[xid]
+        except KeyError:
+            pass
+        if xid in self._stubdom_owner:
+            return None
+        try:
+            name = self.app.vmm.libvirt_conn.lookupByID(xid).name()
+        except libvirt.libvirtError as err:
+            if err.get_error_code() != libvirt.VIR_ERR_NO_DOMAIN:
+                raise
+            # stubdomain or so; stubdomains of VMs started before the
+            # sampler are not known yet, later ones are learned on
+            # domain-spawn
+            name = None
+            if not self._stubdomains_scanned:
+                self._stubdomains_scanned = True
+                for vm in self.app.domains:
+                    if vm not in self._stubdom_owner.values() \
+                            and vm.is_running():
+                        self._learn_stubdomain(vm)
+        try:
+            vm = self.app.domains[name]
+        except KeyError:
+            vm = None
+        self._vm_by_xid[xid] = vm
+        return vm
+
+    def _forget_missing_xids(self, info):
+        """Forget domain IDs of non-qubes not present in the measurement
+        *info* anymore - the domains are gone"""
+        for xid in [xid for xid, vm in self._vm_by_xid.items()
+                if vm is None and xid not in info]:
+            del self._vm_by_xid[xid]
+
+    def enable_history(self, size):
+        """Keep the last *size* samples of each VM, sampling continuously
+
+        :param int size: number of samples to keep for each VM; 0 disables
+            the history
+        """
+        self.history_size = size
+        self.history.clear()
+        if size and self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+        elif not size and not self._subscribers and self._task is not None:
+            self._task.cancel()
+            self._task = None
+            self._last_sample = None
+
+    def subscribe(self):
+        """Start receiving samples.
+
+        :rtype: VMStatsSubscription
+        """
+        subscription = VMStatsSubscription(self)
+        self._subscribers.add(subscription)
+        if self._last_sample is not None:
+            subscription.deliver(self._last_sample)
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """Stop sending samples to the subscriber"""
+        self._subscribers.discard(subscription)
+        if not self._subscribers and not self.history_size \
+                and self._task is not None:
+            self._task.cancel()
+            self._task = None
+            self._last_sample = None
+
+    @staticmethod
+    def _add_stubdomain_stats(vm, vm_info, stubdom_info):
+        # don't modify *vm_info*, it is needed for the next measurement
+        vm_info = vm_info.copy()
+        for key in ('memory_kb', 'cpu_time', 'cpu_usage_raw'):
+            vm_info[key] += stubdom_info[key]
+        vm_info['cpu_usage'] += int(stubdom_info['cpu_usage_raw']
+            / max(getattr(vm, 'vcpus', 1), 1))
+        return vm_info
+
+    @asyncio.coroutine
+    def _run(self):
+        info_time = None
+        info = None
+        failed = False
+        while True:
+            try:
+                info_time, info = self.app.host.get_vm_stats(info_time, info)
+                stats = {}
+                stubdomains = []
+                for xid, vm_info in info.items():
+                    vm = self._get_vm_by_xid(xid)
+                    if vm is not None:
+                        stats[vm] = vm_info
+                    elif xid in self._stubdom_owner:
+                        stubdomains.append((self._stubdom_owner[xid], vm_info))
+                for vm, stubdom_info in stubdomains:
+                    if vm in stats:
+                        stats[vm] = self._add_stubdomain_stats(vm, stats[vm],
+                            stubdom_info)
+                self._forget_missing_xids(info)
+            except Exception as e:  # pylint: disable=broad-except
+                # let the subscribers report it
+                for subscription in self._subscribers:
+                    subscription.deliver(e)
+                self._subscribers.clear()
+                self._last_sample = None
+                if not self.history_size:
+                    # a new subscriber will start over
+                    self._task = None
+                    return
+                # keep the history going, log only the first of consecutive
+                # failures
+                if not failed:
+                    self.app.log.warning('Failed to sample VM stats: %s', e)
+                failed = True
+                info_time = None
+                info = None
+                yield from asyncio.sleep(self.app.stats_interval)
+                continue
+            failed = False
+            self._last_sample = (info_time, stats)
+            if self.history_size:
+                for vm, vm_info in stats.items():
+                    if vm not in self.history:
+                        self.history[vm] = VMStatsHistory(self.history_size)
+                    self.history[vm].append(info_time, vm_info)
+            for subscription in self._subscribers:
+                subscription.deliver(self._last_sample)
+            yield from asyncio.sleep(self.app.stats_interval)
+
+
 class VMCollection:
     """A collection of Qubes VMs
 
@@ -425,16 +766,44 @@ class VMCollection:
     and whole VM object's presence.
 
     Iterating over VMCollection will yield machine objects.
+
+    The collection also keeps track of dependencies between the VMs - which VM
+    refer to which one with its :py:class:`qubes.vm.VMProperty` properties
+    (including default values) and which VM have devices of which one
+    persistently assigned. See :py:meth:`get_vms_referring_to`.
     """
 
     def __init__(self, app):
         self.app = app
         self._dict = dict()
+        #: name -> qid index
+        self._qid_by_name = dict()
+        #: uuid -> qid index
+        self._qid_by_uuid = dict()
+        #: cached result of sorting all the VMs, :py:obj:`None` if invalid
+        self._sorted = None
+        #: VM -> {property name -> VM it refers to}
+        self._references = {}
+        #: VM -> {property name -> set of VMs referring to it},
+        #: :py:obj:`None` if needs to be rebuilt
+        self._referring = None
+        #: VM -> set of backend VMs of its persistently assigned devices
+        self._device_backends = {}
+        #: backend VM -> set of VMs with its devices persistently assigned
+        self._device_frontends = None
 
     def close(self):
+        for vm in self._dict.values():
+            vm.remove_handler('property-set:name',
+                self._on_vm_property_set_name)
+            self._remove_dependency_handlers(vm)
         del self.app
         self._dict.clear()
         del self._dict
+        self._qid_by_name.clear()
+        self._qid_by_uuid.clear()
+        self._sorted = None
+        self.invalidate_dependencies()
 
     def __repr__(self):
         return '<{} {!r}>'.format(
@@ -461,7 +830,7 @@ class VMCollection:
         names are sorted by lexical order.
         """
 
-        return iter(sorted(vm.name for vm in self._dict.values()))
+        return iter(sorted(self._qid_by_name.keys()))
 
     def vms(self):
         """Iterate over all machines
@@ -469,7 +838,11 @@ class VMCollection:
         vms are sorted by qid.
         """
 
-        return iter(sorted(self._dict.values()))
+        if self._sorted is None:
+            self._sorted = sorted(self._dict.values())
+        # the list is never modified, only replaced, so it is safe to modify
+        # the collection while iterating
+        return iter(self._sorted)
 
     __iter__ = vms
     values = vms
@@ -498,9 +871,22 @@ class VMCollection:
                              .format(value.name))
 
         self._dict[value.qid] = value
+        self._qid_by_name[value.name] = value.qid
+        try:
+            self._qid_by_uuid.setdefault(value.uuid, value.qid)
+        except AttributeError:
+            pass
+        self._sorted = None
+        value.add_handler('property-set:name', self._on_vm_property_set_name)
+        for event in self._dependency_events:
+            value.add_handler(event, self._on_vm_dependency_changed)
         if _enable_events:
             value.events_enabled = True
+            self.update_dependencies(value)
             self.app.fire_event('domain-add', vm=value)
+        else:
+            # properties will be loaded without events
+            self.invalidate_dependencies()
 
         return value
 
@@ -509,19 +895,13 @@ class VMCollection:
             return self._dict[key]
 
         if isinstance(key, str):
-            for vm in self:
-                if vm.name == key:
-                    return vm
-            raise KeyError(key)
+            return self._dict[self._qid_by_name[key]]
 
         if isinstance(key, qubes.vm.BaseVM):
             key = key.uuid
 
         if isinstance(key, uuid.UUID):
-            for vm in self:
-                if vm.uuid == key:
-                    return vm
-            raise KeyError(key)
+            return self._dict[self._qid_by_uuid[key]]
 
         raise KeyError(key)
 
@@ -540,19 +920,175 @@ class VMCollection:
                 # already undefined
                 pass
         del self._dict[vm.qid]
+        del self._qid_by_name[vm.name]
+        try:
+            if self._qid_by_uuid.get(vm.uuid) == vm.qid:
+                del self._qid_by_uuid[vm.uuid]
+        except AttributeError:
+            pass
+        self._sorted = None
+        vm.remove_handler('property-set:name', self._on_vm_property_set_name)
+        self._remove_dependency_handlers(vm)
+        self._forget_dependencies(vm)
         self.app.fire_event('domain-delete', vm=vm)
 
     def __contains__(self, key):
-        return any((key in (vm, vm.qid, vm.name))
-                   for vm in self)
+        if isinstance(key, qubes.vm.BaseVM):
+            return self._dict.get(getattr(key, 'qid', None)) is key
+        if isinstance(key, str):
+            return key in self._qid_by_name
+        try:
+            return key in self._dict
+        except TypeError:  # unhashable
+            return False
+
+    def _on_vm_property_set_name(self, vm, event, name, newvalue,
+                                 oldvalue=None):
+        # pylint: disable=unused-argument
+        if oldvalue is not None and \
+                self._qid_by_name.get(oldvalue) == vm.qid:
+            del self._qid_by_name[oldvalue]
+        self._qid_by_name[newvalue] = vm.qid
+        # VMs are sorted by name
+        self._sorted = None
 
     def __len__(self):
         return len(self._dict)
 
+    #: events on VMs that may change their dependencies
+    _dependency_events = ('property-set:*', 'property-reset:*',
+                          'device-attach:*', 'device-detach:*')
+
+    def _remove_dependency_handlers(self, vm):
+        for event in self._dependency_events:
+            vm.remove_handler(event, self._on_vm_dependency_changed)
+
+    def _on_vm_dependency_changed(self, vm, event, *args, name=None,
+                                  **kwargs):
+        # pylint: disable=unused-argument
+        if event.startswith('property-'):
+            try:
+                prop = vm.property_get_def(name)
+            except AttributeError:
+                return
+            if not isinstance(prop, qubes.vm.VMProperty):
+                return
+        self.update_dependencies(vm)
+
+    def invalidate_dependencies(self):
+        """Drop the dependencies index, to be rebuilt when needed
+
+        This needs to be called after changes done without firing events,
+        which can affect any VM - for example change of global defaults.
+        """
+        self._references.clear()
+        self._referring = None
+        self._device_backends.clear()
+        self._device_frontends = None
+
+    def _rebuild_dependencies(self):
+        self._referring = collections.defaultdict(
+            lambda: collections.defaultdict(set))
+        self._device_frontends = collections.defaultdict(set)
+        for vm in self._dict.values():
+            self._index_dependencies(vm)
+
+    def _forget_dependencies(self, vm):
+        if self._referring is None:
+            return
+        for name, target in self._references.pop(vm, {}).items():
+            self._referring[target][name].discard(vm)
+        for backend in self._device_backends.pop(vm, ()):
+            self._device_frontends[backend].discard(vm)
+        self._referring.pop(vm, None)
+        self._device_frontends.pop(vm, None)
+
+    def _index_dependencies(self, vm):
+        references = {}
+        for prop in vm.property_list():
+            if not isinstance(prop, qubes.vm.VMProperty):
+                continue
+            try:
+                target = getattr(vm, prop.__name__)
+            except AttributeError:
+                continue
+            if target is not None:
+                references[prop.__name__] = target
+                self._referring[target][prop.__name__].add(vm)
+        self._references[vm] = references
+
+        backends = set(device.backend_domain
+            for collection in vm.devices.values()
+            for device in collection.persistent())
+        for backend in backends:
+            self._device_frontends[backend].add(vm)
+        self._device_backends[vm] = backends
+
+    def update_dependencies(self, vm):
+        """Update dependencies index after change of VM properties or
+        devices
+
+        It is called automatically on relevant events, call it directly only
+        for changes done without an event. Dependencies of VMs based on this
+        one (whose default values may change too) are updated as well.
+
+        :param qubes.vm.BaseVM vm: changed VM
+        """
+        if self._referring is None or vm not in self:
+            return
+        old_references = self._references.get(vm)
+        for name, target in self._references.pop(vm, {}).items():
+            self._referring[target][name].discard(vm)
+        for backend in self._device_backends.pop(vm, ()):
+            self._device_frontends[backend].discard(vm)
+        self._index_dependencies(vm)
+        if self._references[vm] != old_references:
+            for child in list(self._referring[vm]['template']):
+                self.update_dependencies(child)
+
+    def get_vms_referring_to(self, vm, name):
+        """Domains having property *name* set (explicitly or by default) to
+        *vm*
+
+        :param qubes.vm.BaseVM vm: referred VM
+        :param str name: property name
+        :rtype: set
+        """
+        if self._referring is None:
+            self._rebuild_dependencies()
+        if vm not in self._referring:
+            return set()
+        return set(self._referring[vm].get(name, ()))
+
+    def get_references_to(self, vm):
+        """Iterate over VM properties referring to *vm*
+
+        :param qubes.vm.BaseVM vm: referred VM
+        :returns: iterable of ``(domain, property name)`` pairs
+        """
+        if self._referring is None:
+            self._rebuild_dependencies()
+        if vm not in self._referring:
+            return
+        for name, domains in list(self._referring[vm].items()):
+            for domain in sorted(domains):
+                yield (domain, name)
+
+    def get_vms_with_devices_of(self, backend):
+        """Domains with devices of *backend* persistently assigned
+
+        :param qubes.vm.BaseVM backend: backend VM
+        :rtype: set
+        """
+        if self._device_frontends is None:
+            self._rebuild_dependencies()
+        if backend not in self._device_frontends:
+            return set()
+        return set(self._device_frontends[backend])
+
     def get_vms_based_on(self, template):
         template = self[template]
-        return set(vm for vm in self
-                   if hasattr(vm, 'template') and vm.template == template)
+        return self.get_vms_referring_to(template, 'template')
 
     def get_vms_connected_to(self, netvm):
         new_vms = {self[netvm]}
@@ -593,6 +1129,172 @@ class VMCollection:
                               random.randint(0, 1)])
 
 
+class StoreJournal:
+    """Append-only journal of changes made to :file:`qubes.xml`
+
+    Instead of serializing the whole store on each save, only the parts that
+    changed are appended here. Each line of the file is a single XML element:
+    the first one (``<journal>``) identifies the :file:`qubes.xml` version the
+    journal applies to, each following one (``<commit>``) holds records
+    written by a single :py:meth:`Qubes.save` call. Records are full
+    replacements of the respective :file:`qubes.xml` parts:
+
+    - ``<domain>`` - replace (or add) a domain with the same ``id``
+    - ``<remove-domain id=...>`` - remove a domain
+    - ``<labels>``, ``<pools>``, ``<properties>`` - replace global sections
+
+    The journal is valid only for the exact :file:`qubes.xml` file it was
+    started for - full save replaces the file (and so its inode), which
+    implicitly invalidates any leftover journal.
+
+    :param str path: path to the journal file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        #: number of commits in the journal
+        self.records = 0
+        #: the journal contains unusable records, it needs to be merged into
+        #: :file:`qubes.xml` before appending anything else
+        self.needs_compaction = False
+
+    @staticmethod
+    def _base_id(base_stat):
+        return str(base_stat.st_ino), str(base_stat.st_mtime_ns)
+
+    @staticmethod
+    def _serialize(element):
+        # escape newlines in text nodes, to keep one record per line
+        return lxml.etree.tostring(element, encoding='utf-8').replace(
+            b'\n', b'&#10;') + b'\n'
+
+    def size(self):
+        """Current size of the journal file (0 if there is none)"""
+        try:
+            return os.path.getsize(self.path)
+        except FileNotFoundError:
+            return 0
+
+    def read(self, base_stat, log=None):
+        """Iterate over commits applicable to given :file:`qubes.xml`
+
+        Incomplete (torn) trailing record, left by an interrupted write, is
+        ignored.
+
+        :param os.stat_result base_stat: stat of the :file:`qubes.xml`
+        :param logging.Logger log: where to report dropped records
+        :rtype: iterable of :py:class:`lxml.etree._Element`
+        """
+        self.records = 0
+        self.needs_compaction = False
+        try:
+            with open(self.path, 'rb') as fh:
+                data = fh.read()
+        except FileNotFoundError:
+            return
+        lines = data.split(b'\n')
+        if lines[-1]:
+            self.needs_compaction = True
+            if log is not None:
+                log.warning('Ignoring incomplete record at the end of %s',
+                            self.path)
+        # the last element is either empty or incomplete
+        lines = lines[:-1]
+        if not lines:
+            return
+        try:
+            header = lxml.etree.fromstring(lines[0])
+        except lxml.etree.XMLSyntaxError:
+            header = None
+        if header is None or header.tag != 'journal' or \
+                (header.get('base-inode'), header.get('base-mtime')) != \
+                self._base_id(base_stat):
+            if log is not None:
+                log.warning('Ignoring stale journal %s', self.path)
+            return
+        for line in lines[1:]:
+            try:
+                commit = lxml.etree.fromstring(line)
+            except lxml.etree.XMLSyntaxError:
+                self.needs_compaction = True
+                if log is not None:
+                    log.error('Corrupted record in %s, ignoring it and all '
+                              'the following ones', self.path)
+                return
+            self.records += 1
+            yield commit
+
+    def append(self, records, base_stat):
+        """Append a commit with given records, and wait until it hits the disk
+
+        :param list records: list of :py:class:`lxml.etree._Element`
+        :param os.stat_result base_stat: stat of the :file:`qubes.xml`
+        """
+        commit = lxml.etree.Element('commit')
+        commit.extend(records)
+        data = self._serialize(commit)
+        if not self.records:
+            # start a new journal for this qubes.xml (possibly overriding a
+            # stale one)
+            base_inode, base_mtime = self._base_id(base_stat)
+            data = self._serialize(lxml.etree.Element('journal', {
+                'base-inode': base_inode, 'base-mtime': base_mtime})) + data
+            mode = 'wb'
+        else:
+            mode = 'ab'
+        with open(self.path, mode) as fh:
+            if mode == 'wb':
+                try:
+                    os.chown(fh.name, -1, grp.getgrnam('qubes').gr_gid)
+                    os.chmod(fh.name, 0o660)
+                except KeyError:  # group 'qubes' not found
+                    pass
+            fh.write(data)
+            fh.flush()
+            os.fsync(fh.fileno())
+        self.records += 1
+
+    def remove(self):
+        """Discard the journal, after its content was saved elsewhere"""
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        self.records = 0
+        self.needs_compaction = False
+
+    @staticmethod
+    def apply(root, commit):
+        """Apply a commit to the :file:`qubes.xml` tree
+
+        :param lxml.etree._Element root: ``<qubes>`` element
+        :param lxml.etree._Element commit: ``<commit>`` element
+        """
+        domains = root.find('./domains')
+        if domains is None:
+            domains = lxml.etree.SubElement(root, 'domains')
+        for record in list(commit):
+            if record.tag in ('domain', 'remove-domain'):
+                old = domains.find('./domain[@id=\'{}\']'.format(
+                    record.get('id')))
+                if record.tag == 'remove-domain':
+                    if old is not None:
+                        domains.remove(old)
+                elif old is not None:
+                    domains.replace(old, record)
+                else:
+                    domains.append(record)
+            elif record.tag in ('labels', 'pools', 'properties'):
+                old = root.find('./' + record.tag)
+                if old is not None:
+                    root.replace(old, record)
+                else:
+                    domains.addprevious(record)
+            else:
+                raise qubes.exc.QubesException(
+                    'Unknown journal record: {!r}'.format(record.tag))
+
+
 def _default_pool(app):
     """ Default storage pool.
 
@@ -747,6 +1449,23 @@ class Qubes(qubes.PropertyHolder):
             :param event: Event name (``'pool-delete'``)
             :param pool: Pool object
 
+        .. event:: label-add (subject, event, label)
+
+            When label is created with ``admin.label.Create``.
+
+            :param subject: Event emitter
+            :param event: Event name (``'label-add'``)
+            :param label: Label object
+
+        .. event:: label-delete (subject, event, label)
+
+            When label is removed with ``admin.label.Remove``. The label is
+            already removed at this point.
+
+            :param subject: Event emitter
+            :param event: Event name (``'label-delete'``)
+            :param label: Label object
+
         .. event:: qubes-close (subject, event)
 
             Fired when this Qubes() object instance is going to be closed
@@ -878,7 +1597,7 @@ class Qubes(qubes.PropertyHolder):
         doc='Check for updates inside qubes')
 
     def __init__(self, store=None, load=True, offline_mode=None, lock=False,
-                 **kwargs):
+                 journal=False, **kwargs):
         #: logger instance for logging global messages
         self.log = logging.getLogger('app')
         self.log.debug('init() -> %#x', id(self))
@@ -914,9 +1633,49 @@ class Qubes(qubes.PropertyHolder):
                                              qubes.config.system_path[
                                                  'qubes_store_filename']))
 
+        #: journal of changes not yet merged into :file:`qubes.xml`
+        self.journal = StoreJournal(self._store + '.journal')
+
+        #: save only changed parts, into the journal (see
+        #: :py:class:`StoreJournal`), instead of rewriting the whole
+        #: :file:`qubes.xml` each time
+        self.use_journal = journal
+
+        #: qids of domains changed since the last save
+        self._dirty_domains = set()
+        #: global sections (``labels``, ``pools``, ``properties``) changed
+        #: since the last save
+        self._dirty_sections = set()
+
+        #: collect changes for this many seconds and write them together
+        #: (see :py:meth:`schedule_save`), instead of writing on each
+        #: :py:meth:`save` call; :py:obj:`None` to write immediately
+        self.save_delay = None
+        self._pending_save = None
+        self._pending_save_handle = None
+
+        #: snapshot of system info for qrexec policy evaluation, kept up to
+        #: date by events (see :py:class:`qubes.api.internal.SystemInfoCache`)
+        self.system_info_cache = None
+
+        #: responses of read-only Admin API calls, kept up to date by events
+        #: (see :py:class:`qubes.api.admin.ResponseCache`)
+        self.api_response_cache = None
+
+        #: statistics of API calls
+        #: (see :py:class:`qubes.api.metrics.CallMetrics`)
+        self.api_metrics = None
+
+        #: statistics of qube startup phases
+        #: (see :py:class:`qubes.api.metrics.StartupMetrics`)
+        self.startup_metrics = None
+
+        self._stats_sampler = None
+
         super().__init__(xml=None, **kwargs)
 
         self.__load_timestamp = None
+        self.__load_journal_size = 0
         self.__locked_fh = None
         self._domain_event_callback_id = None
 
@@ -937,6 +1696,21 @@ class Qubes(qubes.PropertyHolder):
     def store(self):
         return self._store
 
+    @property
+    def libvirt_events_registered(self):
+        """Whether libvirt lifecycle events are being received (see
+        :py:meth:`register_event_handlers`), so VMs can cache their libvirt
+        state"""
+        return self._domain_event_callback_id is not None
+
+    @property
+    def stats_sampler(self):
+        """Sampler of VM stats shared by all subscribers
+        (see :py:class:`VMStatsSampler`)"""
+        if self._stats_sampler is None:
+            self._stats_sampler = VMStatsSampler(self)
+        return self._stats_sampler
+
     def _migrate_global_properties(self):
         """Migrate renamed/dropped properties"""
         if self.xml is None:
@@ -991,16 +1765,26 @@ class Qubes(qubes.PropertyHolder):
         if grey_label is not None:
             grey_label.set('color', '0x555555')
 
-    def load(self, lock=False):
+    def load(self, lock=False, xml=None):
         """Open qubes.xml
 
+        :param lxml.etree._ElementTree xml: load this content (like \
+            a snapshot of another instance) instead of the file; it is \
+            neither locked nor read then, so this instance can't be saved
         :throws EnvironmentError: failure on parsing store
         :throws xml.parsers.expat.ExpatError: failure on parsing store
         :raises lxml.etree.XMLSyntaxError: on syntax error in qubes.xml
         """
 
-        fh = self._acquire_lock()
-        self.xml = lxml.etree.parse(fh)
+        if xml is None:
+            fh = self._acquire_lock()
+            self.xml = lxml.etree.parse(fh)
+
+            # apply changes saved after the last full write of qubes.xml
+            for commit in self.journal.read(os.fstat(fh.fileno()), self.log):
+                self.journal.apply(self.xml.getroot(), commit)
+        else:
+            self.xml = xml
 
         self._migrate_labels()
 
@@ -1053,9 +1837,13 @@ class Qubes(qubes.PropertyHolder):
             vm.events_enabled = True
             vm.fire_event('domain-load')
 
+        if xml is not None:
+            return
+
         # get a file timestamp (before closing it - still holding the lock!),
         #  to detect whether anyone else have modified it in the meantime
         self.__load_timestamp = os.path.getmtime(self._store)
+        self.__load_journal_size = self.journal.size()
 
         if not lock:
             self._release_lock()
@@ -1064,14 +1852,7 @@ class Qubes(qubes.PropertyHolder):
         element = lxml.etree.Element('qubes')
 
         element.append(self.xml_labels())
-
-        pools_xml = lxml.etree.Element('pools')
-        for pool in self.pools.values():
-            xml = pool.__xml__()
-            if xml is not None:
-                pools_xml.append(xml)
-
-        element.append(pools_xml)
+        element.append(self.xml_pools())
 
         element.append(self.xml_properties())
 
@@ -1096,13 +1877,87 @@ class Qubes(qubes.PropertyHolder):
         - Attempts to write two or more files concurrently. This is done by
           sophisticated locking.
 
-        :param bool lock: keep file locked after saving
+        If :py:attr:`use_journal` is set, only parts changed since the last
+        save (see :py:meth:`mark_dirty`) are appended to the
+        :py:attr:`journal`. The whole file is rewritten (and the journal
+        discarded) once the journal grows to
+        :py:data:`qubes.config.journal_max_records` records.
+
+        If :py:attr:`save_delay` is set, the data is not written immediately,
+        but scheduled with :py:meth:`schedule_save`. Use
+        :py:meth:`wait_saved` to wait until it is written.
+
+        :param bool lock: keep file locked after saving (ignored if \
+            :py:attr:`save_delay` is set - the file is kept locked then)
         :throws EnvironmentError: failure on saving
         """
 
+        if self.save_delay is not None:
+            self.schedule_save()
+            return
+        self._save(lock=lock)
+
+    def _save(self, lock):
         if not self.__locked_fh:
             self._acquire_lock(for_save=True)
 
+        if self.use_journal and self.__load_timestamp is not None \
+                and not self.journal.needs_compaction \
+                and self.journal.records < qubes.config.journal_max_records:
+            self._save_journal()
+        else:
+            self._save_full()
+
+        self._dirty_domains.clear()
+        self._dirty_sections.clear()
+
+        if not lock:
+            self._release_lock()
+
+    def schedule_save(self):
+        """Schedule writing all the data, together with changes made within
+        next :py:attr:`save_delay` seconds
+
+        This allows many concurrent Admin API calls to share a single write.
+
+        :returns: future done when the data is written
+        :rtype: asyncio.Future
+        """
+        if self._pending_save is None:
+            loop = asyncio.get_event_loop()
+            self._pending_save = loop.create_future()
+            self._pending_save_handle = loop.call_later(
+                self.save_delay or 0, self.flush_save)
+        return self._pending_save
+
+    def flush_save(self):
+        """Write the data scheduled with :py:meth:`schedule_save` now"""
+        if self._pending_save is None:
+            return
+        future = self._pending_save
+        self._pending_save = None
+        self._pending_save_handle.cancel()
+        self._pending_save_handle = None
+        try:
+            self._save(lock=True)
+        except Exception as e:  # pylint: disable=broad-except
+            self.log.exception('Failed to save %s', self._store)
+            # already logged, don't complain if no one is waiting for it
+            future.add_done_callback(lambda f: f.exception())
+            future.set_exception(e)
+        else:
+            future.set_result(None)
+
+    @asyncio.coroutine
+    def wait_saved(self):
+        """Wait until changes scheduled so far are written
+
+        :raises EnvironmentError: failure on saving
+        """
+        if self._pending_save is not None:
+            yield from asyncio.shield(self._pending_save)
+
+    def _save_full(self):
         fh_new = tempfile.NamedTemporaryFile(
             prefix=self._store, delete=False)
         lxml.etree.ElementTree(self.__xml__()).write(
@@ -1116,6 +1971,11 @@ class Qubes(qubes.PropertyHolder):
             pass
         os.rename(fh_new.name, self._store)
 
+        # the journal is already included in the new file (and does not
+        # match it anymore anyway)
+        self.journal.remove()
+        self.__load_journal_size = 0
+
         # update stored mtime, in case of multiple save() calls without
         # loading qubes.xml again
         self.__load_timestamp = os.path.getmtime(self._store)
@@ -1125,8 +1985,42 @@ class Qubes(qubes.PropertyHolder):
         self.__locked_fh.close()
         self.__locked_fh = fh_new
 
-        if not lock:
-            self._release_lock()
+    def _save_journal(self):
+        records = []
+        if 'labels' in self._dirty_sections:
+            records.append(self.xml_labels())
+        if 'pools' in self._dirty_sections:
+            records.append(self.xml_pools())
+        if 'properties' in self._dirty_sections:
+            records.append(self.xml_properties())
+        for qid in sorted(self._dirty_domains):
+            if qid in self.domains:
+                records.append(self.domains[qid].__xml__())
+            else:
+                records.append(lxml.etree.Element('remove-domain',
+                    id='domain-' + str(qid)))
+        if not records:
+            return
+
+        self.journal.append(records, os.fstat(self.__locked_fh.fileno()))
+        self.__load_journal_size = self.journal.size()
+
+    def mark_dirty(self, vm=None, section=None):
+        """Mark part of the data to be written on the next :py:meth:`save`
+
+        Changes announced with events (properties, features, tags, devices,
+        domains and pools) are tracked automatically, this needs to be
+        called only for changes done without an event.
+
+        :param qubes.vm.BaseVM vm: changed domain
+        :param str section: changed global section - one of ``labels``, \
+            ``pools``, ``properties``
+        """
+        if vm is not None:
+            self._dirty_domains.add(vm.qid)
+        if section is not None:
+            assert section in ('labels', 'pools', 'properties'), section
+            self._dirty_sections.add(section)
 
     def close(self):
         """Deconstruct the object and break circular references
@@ -1142,6 +2036,10 @@ class Qubes(qubes.PropertyHolder):
 
         super().close()
 
+        if self._stats_sampler is not None:
+            self._stats_sampler.close()
+            self._stats_sampler = None
+
         if self._domain_event_callback_id is not None:
             self.vmm.libvirt_conn.domainEventDeregisterAny(
                 self._domain_event_callback_id)
@@ -1189,8 +2087,9 @@ class Qubes(qubes.PropertyHolder):
                 os.close(fd)
                 continue
 
-            if self.__load_timestamp and \
-                    os.path.getmtime(self._store) != self.__load_timestamp:
+            if self.__load_timestamp and (
+                    os.path.getmtime(self._store) != self.__load_timestamp or
+                    self.journal.size() != self.__load_journal_size):
                 os.close(fd)
                 raise qubes.exc.QubesException(
                     'Someone else modified qubes.xml in the meantime')
@@ -1272,6 +2171,19 @@ class Qubes(qubes.PropertyHolder):
             labels.append(label.__xml__())
         return labels
 
+    def xml_pools(self):
+        """Serialise pools
+
+        :rtype: lxml.etree._Element
+        """
+
+        pools_xml = lxml.etree.Element('pools')
+        for pool in self.pools.values():
+            xml = pool.__xml__()
+            if xml is not None:
+                pools_xml.append(xml)
+        return pools_xml
+
     @staticmethod
     def get_vm_class(clsname):
         """Find the class for a domain.
@@ -1432,6 +2344,10 @@ class Qubes(qubes.PropertyHolder):
                 # the connection is probably in a bad state; but call the above
                 # anyway to cleanup the client structures
                 pass
+            # events might have been lost in the meantime, query libvirt
+            # again about every domain
+            for vm in self.domains:
+                vm.invalidate_libvirt_state()
         self._domain_event_callback_id = (
             self.vmm.libvirt_conn.domainEventRegisterAny(
                 None,  # any domain
@@ -1443,15 +2359,18 @@ class Qubes(qubes.PropertyHolder):
         """Generic libvirt event handler (virConnectDomainEventCallback),
         translate libvirt event into qubes.events.
         """
-        if not self.events_enabled:
-            return
-
         try:
             vm = self.domains[domain.name()]
         except KeyError:
             # ignore events for unknown domains
             return
 
+        # any lifecycle event may change the domain state
+        vm.invalidate_libvirt_state()
+
+        if not self.events_enabled:
+            return
+
         if event == libvirt.VIR_DOMAIN_EVENT_STOPPED:
             vm.on_libvirt_domain_stopped()
         elif event == libvirt.VIR_DOMAIN_EVENT_SUSPENDED:
@@ -1472,25 +2391,27 @@ class Qubes(qubes.PropertyHolder):
     @qubes.events.handler('domain-pre-delete')
     def on_domain_pre_deleted(self, event, vm):
         # pylint: disable=unused-argument
-        for obj in itertools.chain(self.domains, (self,)):
+        global_references = ((self, prop.__name__)
+            for prop in self.property_list()
+            if isinstance(prop, qubes.vm.VMProperty))
+        for obj, name in itertools.chain(
+                self.domains.get_references_to(vm), global_references):
             if obj is vm:
                 # allow removed VM to reference itself
                 continue
-            for prop in obj.property_list():
-                try:
-                    if isinstance(prop, qubes.vm.VMProperty) and \
-                            getattr(obj, prop.__name__) == vm:
-                        self.log.error(
-                            'Cannot remove %s, used by %s.%s',
-                            vm, obj, prop.__name__)
-                        raise qubes.exc.QubesVMInUseError(
-                            vm,
-                            'Domain is in use: {!r};'
-                            'see /var/log/qubes/qubes.log in dom0 for '
-                            'details'.format(
-                                vm.name))
-                except AttributeError:
-                    pass
+            try:
+                if getattr(obj, name) == vm:
+                    self.log.error(
+                        'Cannot remove %s, used by %s.%s',
+                        vm, obj, name)
+                    raise qubes.exc.QubesVMInUseError(
+                        vm,
+                        'Domain is in use: {!r};'
+                        'see /var/log/qubes/qubes.log in dom0 for '
+                        'details'.format(
+                            vm.name))
+            except AttributeError:
+                pass
 
         assignments = vm.get_provided_assignments()
         if assignments:
@@ -1518,6 +2439,24 @@ class Qubes(qubes.PropertyHolder):
             except AttributeError:
                 pass
 
+    @qubes.events.handler('domain-add', 'domain-delete')
+    def on_domain_added_or_deleted(self, event, vm):
+        # pylint: disable=unused-argument
+        self.mark_dirty(vm=vm)
+
+    @qubes.events.handler('property-set:*', 'property-reset:*')
+    def on_property_changed(self, event, name, *args, **kwargs):
+        # pylint: disable=unused-argument
+        self.mark_dirty(section='properties')
+        if isinstance(self.property_get_def(name), qubes.vm.VMProperty):
+            # global defaults may affect dependencies of any VM
+            self.domains.invalidate_dependencies()
+
+    @qubes.events.handler('pool-add', 'pool-delete')
+    def on_pool_added_or_deleted(self, event, pool):
+        # pylint: disable=unused-argument
+        self.mark_dirty(section='pools')
+
     @qubes.events.handler('property-pre-set:clockvm')
     def on_property_pre_set_clockvm(self, event, name, newvalue, oldvalue=None):
         # pylint: disable=unused-argument,no-self-use
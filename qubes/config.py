@@ -82,6 +82,68 @@ max_dispid = 10000
 # number, at least until label index is removed from API
 max_default_label = 8
 
+#: number of commits in :file:`qubes.xml` journal, after which the whole file
+# is rewritten
+journal_max_records = 256
+
+#: time (in seconds) for collecting changes made by concurrent Admin API
+# calls, to write them to :file:`qubes.xml` together
+save_delay = 0.01
+
+#: maximum number of events waiting to be sent to a single admin.Events (or
+# similar) client, because it doesn't read them fast enough
+events_queue_limit = 10000
+
+#: what to do with a client reaching :py:data:`events_queue_limit`:
+# ``'coalesce'`` - replace older queued event of the same type about the same
+# subject (if there is none, drop the oldest one as in ``'drop-oldest'``),
+# ``'drop-oldest'`` - drop the oldest queued event; in both cases
+# ``events-lost`` event is sent before the remaining ones, so the client can
+# refresh its state; ``'disconnect'`` - close the connection
+events_overflow_policy = 'coalesce'
+
+#: number of VM stats samples (taken every ``stats_interval`` seconds) kept
+# in qubesd for each qube, for admin.vm.StatsHistory; 0 to not keep history
+stats_history_size = 600
+
+#: number of worker processes serving read-only Admin API calls in parallel
+# with qubesd (see :py:class:`qubes.api.workers.ReadWorkerPool`); 0 to serve
+# all the calls in qubesd itself
+api_read_workers = 0
+
+#: number of threads for blocking hypervisor (libvirt) and storage calls,
+# see :py:class:`qubes.utils.BlockingExecutor`
+blocking_executor_workers = 8
+
+#: maximum number of qubes started or shut down at the same time by
+# admin.vm.StartMany and admin.vm.ShutdownMany calls
+api_lifecycle_parallelism = 4
+
+#: Admin API calls taking longer than this (in seconds) are logged, see
+# :py:class:`qubes.api.metrics.CallMetrics`; :py:obj:`None` to disable
+api_slow_call_threshold = 1.0
+
+#: socket serving statistics of API calls in Prometheus text format;
+# :py:obj:`None` to disable
+api_metrics_socket = '/var/run/qubesd.metrics.sock'
+
+#: how often (in seconds) qubesd measures lag of its event loop, see
+# :py:class:`qubes.api.metrics.LoopWatchdog`; :py:obj:`None` to disable
+loop_watchdog_interval = 0.25
+
+#: event loop blocked for longer than this (in seconds) is logged, with the
+# stack of the blocking code; :py:obj:`None` to only measure the lag
+loop_stall_threshold = 0.5
+
+#: number of recent startups of each qube used for percentiles of startup
+# phases durations, see :py:class:`qubes.api.metrics.StartupMetrics`
+startup_metrics_samples = 100
+
+#: directory to write traces of each qube startup to, in Chrome trace format
+# (see :py:class:`qubes.vm.startup.StartupTimings`); can be overridden by
+# ``QUBES_STARTUP_TRACE_DIR`` environment variable; :py:obj:`None` to disable
+startup_trace_dir = None
+
 #: profiles for admin.backup.* calls
 backup_profile_dir = '/etc/qubes/backup'
 
@@ -69,6 +69,69 @@ def ishandler(obj):
         and hasattr(obj, 'ha_events')
 
 
+#: maximum number of events kept in a single dispatch cache; events names can
+#: contain user provided parts (like feature or tag name), so don't let it grow
+#: indefinitely
+DISPATCH_CACHE_SIZE = 1024
+
+#: (class, event) -> handlers registered on classes in class' MRO, in both
+#: orders: (for pre-event, for normal event)
+_class_dispatch_cache = {}
+
+
+def invalidate_dispatch_cache():
+    '''Drop cached lists of class-level handlers.
+
+    This needs to be called after modifying class-level handlers (like when
+    registering extension handlers).
+    '''
+    _class_dispatch_cache.clear()
+
+
+def _is_wildcard(pattern):
+    return any(c in pattern for c in '*?[')
+
+
+def _matching_handlers(handlers_dict, event):
+    '''Handlers from a single ``__handlers__`` dict matching an event.
+
+    Bound handlers (specified in class definition) are returned first, others
+    in order of registering the event name or pattern they are registered
+    for - the same as without caching.
+    '''
+    handlers = []
+    for h_name, h_func_set in handlers_dict.items():
+        if h_name == event or (_is_wildcard(h_name)
+                and fnmatch.fnmatch(event, h_name)):
+            handlers.extend(h_func_set)
+    return sorted(handlers,
+        key=(lambda handler: hasattr(handler, 'ha_bound')),
+        reverse=True)
+
+
+def _class_handlers(cls, event):
+    '''Class-level handlers for an event, in order for (pre-event, event)'''
+    try:
+        return _class_dispatch_cache[cls, event]
+    except KeyError:
+        pass
+    per_class = []
+    for i in cls.__mro__:
+        try:
+            handlers_dict = i.__handlers__
+        except AttributeError:
+            continue
+        per_class.append(_matching_handlers(handlers_dict, event))
+    result = (
+        tuple(itertools.chain.from_iterable(per_class)),
+        tuple(itertools.chain.from_iterable(reversed(per_class))),
+    )
+    if len(_class_dispatch_cache) >= DISPATCH_CACHE_SIZE:
+        _class_dispatch_cache.clear()
+    _class_dispatch_cache[cls, event] = result
+    return result
+
+
 class EmitterMeta(type):
     '''Metaclass for :py:class:`Emitter`'''
     def __init__(cls, name, bases, dict_):
@@ -93,6 +156,8 @@ class EmitterMeta(type):
             for event in attr.ha_events:
                 cls.__handlers__[event].add(attr)
 
+        invalidate_dispatch_cache()
+
 
 class Emitter(metaclass=EmitterMeta):
     '''Subject that can emit events.
@@ -106,6 +171,8 @@ class Emitter(metaclass=EmitterMeta):
         if not hasattr(self, 'events_enabled'):
             self.events_enabled = False
         self.__handlers__ = collections.defaultdict(set)
+        #: event -> instance handlers, see :py:meth:`_instance_handlers`
+        self._dispatch_cache = {}
 
     def close(self):
         self.events_enabled = False
@@ -121,6 +188,7 @@ class Emitter(metaclass=EmitterMeta):
 
         # pylint: disable=no-member
         self.__handlers__[event].add(func)
+        self._invalidate_dispatch_cache()
 
     def remove_handler(self, event, func):
         '''Remove event handler from subject's class.
@@ -136,6 +204,30 @@ class Emitter(metaclass=EmitterMeta):
 
         # pylint: disable=no-member
         self.__handlers__[event].remove(func)
+        self._invalidate_dispatch_cache()
+
+    def _invalidate_dispatch_cache(self):
+        if self.__handlers__ is type(self).__handlers__:
+            # no instance-specific handlers, the class ones were modified
+            invalidate_dispatch_cache()
+        self._dispatch_cache = {}
+
+    def _instance_handlers(self, event):
+        '''Handlers registered on this very object (not its class)'''
+        if '__handlers__' not in self.__dict__:
+            # :py:meth:`__init__` wasn't called, this falls back to class
+            # handlers, which can be modified without notifying this object
+            return _matching_handlers(self.__handlers__, event)
+        cache = self._dispatch_cache
+        try:
+            return cache[event]
+        except KeyError:
+            pass
+        handlers = _matching_handlers(self.__handlers__, event)
+        if len(cache) >= DISPATCH_CACHE_SIZE:
+            cache.clear()
+        cache[event] = handlers
+        return handlers
 
     def _fire_event(self, event, kwargs, pre_event=False):
         '''Fire event for classes in given order.
@@ -146,28 +238,23 @@ class Emitter(metaclass=EmitterMeta):
         if not self.events_enabled:
             return [], []
 
-        order = itertools.chain((self,), self.__class__.__mro__)
-        if not pre_event:
-            order = reversed(list(order))
+        # handlers for the object itself, then for classes in MRO order
+        # (reversed if not pre_event)
+        pre_handlers, post_handlers = _class_handlers(type(self), event)
+        instance_handlers = self._instance_handlers(event)
+        if pre_event:
+            handlers = itertools.chain(instance_handlers, pre_handlers)
+        else:
+            handlers = itertools.chain(post_handlers, instance_handlers)
 
         effects = []
         async_effects = []
-        for i in order:
-            try:
-                handlers_dict = i.__handlers__
-            except AttributeError:
-                continue
-            handlers = [h_func for h_name, h_func_set in handlers_dict.items()
-                        for h_func in h_func_set
-                        if fnmatch.fnmatch(event, h_name)]
-            for func in sorted(handlers,
-                    key=(lambda handler: hasattr(handler, 'ha_bound')),
-                    reverse=True):
-                effect = func(self, event, **kwargs)
-                if asyncio.iscoroutinefunction(func):
-                    async_effects.append(effect)
-                elif effect is not None:
-                    effects.extend(effect)
+        for func in handlers:
+            effect = func(self, event, **kwargs)
+            if asyncio.iscoroutinefunction(func):
+                async_effects.append(effect)
+            elif effect is not None:
+                effects.extend(effect)
         return effects, async_effects
 
     def fire_event(self, event, pre_event=False, **kwargs):
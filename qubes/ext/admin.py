@@ -34,6 +34,87 @@ class JustEvaluateAllowResolution(parser.AllowResolution):
         pass
 
 
+def evaluate_policy(policy, system_info, service, arg, source, dest):
+    '''Check if policy allows the call, without asking the user.'''
+    request = parser.Request(
+        service,
+        arg,
+        source,
+        dest,
+        system_info=system_info,
+        ask_resolution_type=JustEvaluateAskResolution,
+        allow_resolution_type=JustEvaluateAllowResolution)
+    try:
+        resolution = policy.evaluate(request)
+        # do not consider 'ask' as allow here,
+        # this needs to be not interactive
+        return isinstance(resolution, parser.AllowResolution)
+    except parser.AccessDenied:
+        return False
+
+
+class PolicyDecisionCache:
+    '''Memoized policy decisions, used for filtering Admin API responses.
+
+    Decisions are keyed by (source, service+argument, destination) and are
+    valid for a single policy object (:py:class:`utils.PolicyCache` loads a
+    new one when policy files change) and a single
+    :py:attr:`qubes.api.internal.SystemInfoCache.generation`. Without
+    system info cache attached to the application, nothing is cached.
+
+    :py:attr:`hits` and :py:attr:`misses` count lookups, for tuning.
+    '''
+
+    #: maximum number of cached decisions
+    max_size = 4096
+
+    def __init__(self):
+        self.decisions = {}
+        self.hits = 0
+        self.misses = 0
+        self._policy = None
+        self._system_info_cache = None
+        self._generation = None
+
+    def clear(self):
+        self.decisions.clear()
+        self._policy = None
+        self._system_info_cache = None
+        self._generation = None
+
+    def evaluate(self, policy, app, service, arg, source, dest):
+        '''Check if policy allows the call, see :py:func:`evaluate_policy`'''
+        system_info_cache = getattr(app, 'system_info_cache', None)
+        if not isinstance(system_info_cache,
+                qubes.api.internal.SystemInfoCache):
+            return evaluate_policy(policy,
+                qubes.api.internal.get_system_info(app),
+                service, arg, source, dest)
+
+        if policy is not self._policy \
+                or system_info_cache is not self._system_info_cache \
+                or system_info_cache.generation != self._generation:
+            self.decisions.clear()
+            self._policy = policy
+            self._system_info_cache = system_info_cache
+            self._generation = system_info_cache.generation
+
+        key = (source, service + arg, dest)
+        try:
+            result = self.decisions[key]
+            self.hits += 1
+            return result
+        except KeyError:
+            self.misses += 1
+
+        result = evaluate_policy(policy, system_info_cache.get(),
+            service, arg, source, dest)
+        if len(self.decisions) >= self.max_size:
+            self.decisions.clear()
+        self.decisions[key] = result
+        return result
+
+
 class AdminExtension(qubes.ext.Extension):
     def __init__(self):
         super().__init__()
@@ -42,6 +123,9 @@ class AdminExtension(qubes.ext.Extension):
         if not hasattr(self, 'policy_cache'):
             self.policy_cache = utils.PolicyCache(lazy_load=True)
             self.policy_cache.initialize_watcher()
+        if not hasattr(self, 'policy_decisions'):
+            #: decisions for filtering admin.vm.List and admin.Events
+            self.policy_decisions = PolicyDecisionCache()
 
     # pylint: disable=too-few-public-methods
     @qubes.ext.handler(
@@ -58,7 +142,8 @@ class AdminExtension(qubes.ext.Extension):
 
     # TODO create that tag here (need to figure out how to pass mgmtvm name)
 
-    @qubes.ext.handler('admin-permission:admin.vm.List')
+    @qubes.ext.handler('admin-permission:admin.vm.List',
+        'admin-permission:admin.vm.GetAllData')
     def admin_vm_list(self, vm, event, arg, **kwargs):
         '''When called with target 'dom0' (aka "get full list"), exclude domains
            that the caller don't have permission to list
@@ -70,24 +155,84 @@ class AdminExtension(qubes.ext.Extension):
             return None
 
         policy = self.policy_cache.get_policy()
-        system_info = qubes.api.internal.get_system_info(vm.app)
+        service = event.split(':', 1)[1]
 
         def filter_vms(dest_vm):
-            request = parser.Request(
-                'admin.vm.List',
-                '+' + arg,
-                vm.name,
-                dest_vm.name,
-                system_info=system_info,
-                ask_resolution_type=JustEvaluateAskResolution,
-                allow_resolution_type=JustEvaluateAllowResolution)
-            try:
-                resolution = policy.evaluate(request)
-                # do not consider 'ask' as allow here,
-                # this needs to be not interactive
-                return isinstance(resolution, parser.AllowResolution)
-            except parser.AccessDenied:
-                return False
+            return self.policy_decisions.evaluate(policy, vm.app,
+                service, '+' + arg, vm.name, dest_vm.name)
+
+        return (filter_vms,)
+
+    @qubes.ext.handler('admin-permission:admin.vm.SetMany')
+    def admin_vm_set_many(self, vm, event, arg, dest, **kwargs):
+        '''Allow only the changes the caller could make with the
+           corresponding single change calls (like admin.vm.property.Set
+           with the property name as an argument) - qrexec checked only
+           admin.vm.SetMany call itself
+        '''
+        # pylint: disable=unused-argument
+
+        if vm.klass == 'AdminVM':
+            # dom0 can always change everything
+            return None
+
+        policy = self.policy_cache.get_policy()
+
+        def filter_changes(change):
+            service, change_arg, _ = change
+            return self.policy_decisions.evaluate(policy, vm.app,
+                service, '+' + change_arg, vm.name, dest.name)
+
+        return (filter_changes,)
+
+    @qubes.ext.handler(
+        'admin-permission:admin.vm.property.GetAll',
+        'admin-permission:admin.vm.feature.List',
+        'admin-permission:admin.vm.feature.Get',
+        'admin-permission:admin.vm.tag.List',
+        'admin-permission:admin.vm.volume.List',
+        'admin-permission:admin.vm.volume.Info')
+    def admin_vm_get_all_data_part(self, vm, event, arg, dest,
+            get_all_data=False, **kwargs):
+        '''Include in admin.vm.GetAllData response only the parts the caller
+           could get with the corresponding single calls (like
+           admin.vm.feature.Get with the feature name as an argument) -
+           qrexec checked only admin.vm.GetAllData call itself
+        '''
+        # pylint: disable=unused-argument
+
+        if not get_all_data or vm.klass == 'AdminVM':
+            # a single call, already checked by qrexec; or dom0, which can
+            # always get everything
+            return
+
+        policy = self.policy_cache.get_policy()
+        service = event.split(':', 1)[1]
+        if not self.policy_decisions.evaluate(policy, vm.app,
+                service, '+' + arg, vm.name, dest.name):
+            raise qubes.api.PermissionDenied(
+                'denied by qrexec policy for {}'.format(service))
+
+    @qubes.ext.handler('admin-permission:admin.vm.StartMany',
+        'admin-permission:admin.vm.ShutdownMany')
+    def admin_vm_lifecycle_many(self, vm, event, arg, **kwargs):
+        '''Allow only the qubes the caller could start (or shut down) with
+           admin.vm.Start (or admin.vm.Shutdown) call - qrexec checked only
+           the call for all of them, targeted at dom0
+        '''
+        # pylint: disable=unused-argument
+
+        if vm.klass == 'AdminVM':
+            # dom0 can always start everything
+            return None
+
+        policy = self.policy_cache.get_policy()
+        # admin.vm.StartMany -> admin.vm.Start
+        service = event.split(':', 1)[1][:-len('Many')]
+
+        def filter_vms(dest_vm):
+            return self.policy_decisions.evaluate(policy, vm.app,
+                service, '+' + arg, vm.name, dest_vm.name)
 
         return (filter_vms,)
 
@@ -115,26 +260,30 @@ class AdminExtension(qubes.ext.Extension):
                     dest = '@adminvm'
 
             policy = self.policy_cache.get_policy()
-            # TODO: cache system_info (based on last qubes.xml write time?)
-            system_info = qubes.api.internal.get_system_info(vm.app)
-            request = parser.Request(
-                'admin.Events',
-                '+' + event.replace(':', '_'),
-                vm.name,
-                dest,
-                system_info=system_info,
-                ask_resolution_type=JustEvaluateAskResolution,
-                allow_resolution_type=JustEvaluateAllowResolution)
-            try:
-                resolution = policy.evaluate(request)
-                # do not consider 'ask' as allow here,
-                # this needs to be not interactive
-                return isinstance(resolution, parser.AllowResolution)
-            except parser.AccessDenied:
-                return False
+            return self.policy_decisions.evaluate(policy, vm.app,
+                'admin.Events', '+' + event.replace(':', '_'), vm.name, dest)
 
         return (filter_events,)
 
+    def detach_policy_cache(self):
+        '''Drop the policy cache without cleaning it up, in a forked process
+        (like an API worker).
+
+        Its watcher of policy changes is set up on the parent's event loop,
+        so it would never notice a change here. A new cache is created on
+        the next initialization of the extension (by a new
+        :py:class:`qubes.Qubes` object), watching on the current event loop.
+
+        :return: the old cache, or :py:obj:`None`; it holds file descriptors
+            of the parent, so keep it referenced
+        '''
+        policy_cache = getattr(self, 'policy_cache', None)
+        if policy_cache is not None:
+            del self.policy_cache
+        if hasattr(self, 'policy_decisions'):
+            self.policy_decisions.clear()
+        return policy_cache
+
     @qubes.ext.handler('qubes-close', system=True)
     def on_qubes_close(self, app, event, **kwargs):
         """Unregister policy file watches on app.close()."""
@@ -142,6 +291,8 @@ class AdminExtension(qubes.ext.Extension):
         if hasattr(self, 'policy_cache'):
             self.policy_cache.cleanup()
             del self.policy_cache
+        if hasattr(self, 'policy_decisions'):
+            self.policy_decisions.clear()
 
     @qubes.ext.handler('domain-tag-add:created-by-*')
     def on_tag_add(self, vm, event, tag, **kwargs):
@@ -27,9 +27,7 @@ class AUDIO(qubes.ext.Extension):
     # pylint: disable=unused-argument,no-self-use
     @staticmethod
     def attached_vms(vm):
-        for domain in vm.app.domains:
-            if getattr(domain, 'audiovm', None) and domain.audiovm == vm:
-                yield domain
+        yield from sorted(vm.app.domains.get_vms_referring_to(vm, 'audiovm'))
 
     @qubes.ext.handler('domain-pre-shutdown')
     @asyncio.coroutine
@@ -31,9 +31,7 @@ class GUI(qubes.ext.Extension):
     # pylint: disable=too-few-public-methods,unused-argument,no-self-use
     @staticmethod
     def attached_vms(vm):
-        for domain in vm.app.domains:
-            if getattr(domain, 'guivm', None) and domain.guivm == vm:
-                yield domain
+        yield from sorted(vm.app.domains.get_vms_referring_to(vm, 'guivm'))
 
     @qubes.ext.handler('domain-pre-shutdown')
     def on_domain_pre_shutdown(self, vm, event, **kwargs):
@@ -294,7 +294,8 @@ class FileVolume(qubes.storage.Volume):
             _remove_if_exists(self.path)
             path = yield from qubes.utils.coro_maybe(src_volume.export())
             try:
-                copy_file(path, self.path)
+                yield from qubes.utils.run_blocking(self.domain,
+                    copy_file, path, self.path)
             finally:
                 yield from qubes.utils.coro_maybe(src_volume.export_end(path))
         return self
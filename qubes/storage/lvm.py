@@ -395,6 +395,8 @@ class ThinVolume(qubes.storage.Volume):
                 yield from qubes_lvm_coro(cmd, self.log)
             except qubes.storage.StoragePoolException:
                 pass
+        if revisions:
+            yield from reset_cache_coro()
 
     @asyncio.coroutine
     def _commit(self, vid_to_commit=None, keep=False):
@@ -488,10 +490,12 @@ class ThinVolume(qubes.storage.Volume):
         # pylint: disable=protected-access
         self.pool._volume_objects_cache.pop(self.vid, None)
 
+    @asyncio.coroutine
     def export(self):
         ''' Returns an object that can be `open()`. '''
         # make sure the device node is available
-        qubes_lvm(['activate', self.path], self.log)
+        yield from qubes_lvm_coro(['activate', self.path], self.log)
+        yield from reset_cache_coro()
         devpath = self.path
         return devpath
 
@@ -534,6 +538,7 @@ class ThinVolume(qubes.storage.Volume):
             if p.returncode != 0:
                 cmd = ['remove', self._vid_import]
                 yield from qubes_lvm_coro(cmd, self.log)
+                yield from reset_cache_coro()
                 raise qubes.storage.StoragePoolException(
                     'Failed to import volume {!r}, dd exit code: {}'.format(
                         src_volume, p.returncode))
@@ -570,6 +575,7 @@ class ThinVolume(qubes.storage.Volume):
         else:
             cmd = ['remove', self._vid_import]
             yield from qubes_lvm_coro(cmd, self.log)
+            yield from reset_cache_coro()
 
     def abort_if_import_in_progress(self):
         try:
@@ -801,7 +807,7 @@ def _process_lvm_output(returncode, stdout, stderr, log):
 
 def qubes_lvm(cmd, log=logging.getLogger('qubes.storage.lvm')):
     ''' Call :program:`lvm` to execute an LVM operation '''
-    # the only caller for this non-coroutine version is ThinVolume.export()
+    # use qubes_lvm_coro() where possible, this one blocks the event loop
     cmd = _get_lvm_cmdline(cmd)
     environ = os.environ.copy()
     environ['LC_ALL'] = 'C.utf8'
@@ -833,16 +839,54 @@ def qubes_lvm_coro(cmd, log=logging.getLogger('qubes.storage.lvm')):
     return _process_lvm_output(p.returncode, out, err, log)
 
 
+def _set_cache(cache, query_time):
+    '''Store result of :program:`lvs` started at *query_time*, unless there is
+    already a newer one (from a call started later, but finished sooner)'''
+    if query_time < qubes.storage.lvm.size_cache_time:
+        return
+    qubes.storage.lvm.size_cache = cache
+    qubes.storage.lvm.size_cache_time = query_time
+
 def reset_cache():
-    qubes.storage.lvm.size_cache = init_cache()
-    qubes.storage.lvm.size_cache_time = time.monotonic()
+    query_time = time.monotonic()
+    _set_cache(init_cache(), query_time)
 
 @asyncio.coroutine
 def reset_cache_coro():
-    qubes.storage.lvm.size_cache = yield from init_cache_coro()
-    qubes.storage.lvm.size_cache_time = time.monotonic()
+    '''Reset size cache, waiting for :program:`lvs`. Volume operations call
+    this after changing the volume, so that they see their own changes.'''
+    query_time = time.monotonic()
+    _set_cache((yield from init_cache_coro()), query_time)
+
+_refresh_cache_task = None
+
+@asyncio.coroutine
+def _refresh_cache_coro():
+    try:
+        yield from reset_cache_coro()
+    except Exception:  # pylint: disable=broad-except
+        logging.getLogger('qubes.storage.lvm').exception(
+            'Failed to refresh LVM size cache')
 
 def refresh_cache():
-    '''Reset size cache, if it's older than 30sec '''
-    if size_cache_time+30 < time.monotonic():
+    '''Reset size cache, if it's older than 30sec
+
+    If called from a running event loop and the cache is already filled, it
+    is refreshed in the background, and old values are returned meanwhile -
+    instead of blocking the loop on :program:`lvs`. This is meant for
+    periodic polls only (like usage); the background refresh never replaces
+    data from :py:func:`reset_cache_coro` started after it.
+    '''
+    global _refresh_cache_task  # pylint: disable=global-statement
+    if size_cache_time+30 >= time.monotonic():
+        return
+    try:
+        loop = asyncio.get_event_loop()
+    except RuntimeError:
+        loop = None
+    if size_cache and loop is not None and loop.is_running():
+        if _refresh_cache_task is None or _refresh_cache_task.done():
+            _refresh_cache_task = asyncio.ensure_future(
+                _refresh_cache_coro())
+    else:
         reset_cache()
@@ -44,14 +44,13 @@ LOGGER = logging.getLogger('qubes.storage.reflink')
 
 def _coroutinized(function):
     ''' Wrap a synchronous function in a coroutine that runs the
-        function via the event loop's ThreadPool-based default
-        executor.
+        function via :py:class:`qubes.utils.BlockingExecutor`.
     '''
     @asyncio.coroutine
     @functools.wraps(function)
     def wrapper(*args, **kwargs):
-        return (yield from asyncio.get_event_loop().run_in_executor(
-            None, functools.partial(function, *args, **kwargs)))
+        return (yield from qubes.utils.run_blocking(
+            None, function, *args, **kwargs))
     return wrapper
 
 class ReflinkPool(qubes.storage.Pool):
@@ -20,9 +20,15 @@
 
 import asyncio
 import socket
+import struct
+import time
 import unittest.mock
 
+import lxml.etree
+
 import qubes.api
+import qubes.api.metrics
+import qubes.api.workers
 import qubes.tests
 
 
@@ -41,6 +47,7 @@ class TestMgmt(object):
                 'mgmt.qubesexception': self.qubesexception,
                 'mgmt.exception': self.exception,
                 'mgmt.event': self.event,
+                'mgmt.wait': self.wait,
             }[self.method.decode()]
         except KeyError:
             raise qubes.api.ProtocolError('Invalid method')
@@ -71,6 +78,11 @@ class TestMgmt(object):
     def exception(self, untrusted_payload):
         raise Exception('exception')
 
+    @asyncio.coroutine
+    def wait(self, untrusted_payload):
+        # runs until cancelled, without handling it
+        yield from asyncio.get_event_loop().create_future()
+
     @asyncio.coroutine
     def event(self, untrusted_payload):
         future = asyncio.get_event_loop().create_future()
@@ -97,6 +109,7 @@ class TC_00_QubesDaemonProtocol(qubes.tests.QubesTestCase):
         super(TC_00_QubesDaemonProtocol, self).setUp()
         self.app = unittest.mock.Mock()
         self.app.log = self.log
+        self.app.wait_saved.side_effect = lambda: asyncio.sleep(0)
         self.sock_client, self.sock_server = socket.socketpair()
         self.reader, self.writer = self.loop.run_until_complete(
             asyncio.open_connection(sock=self.sock_client))
@@ -183,3 +196,523 @@ class TC_00_QubesDaemonProtocol(qubes.tests.QubesTestCase):
                 asyncio.wait_for(self.reader.read(), 1))
         self.assertEqual(response,
             b"0\0src: b'src', dest: b'dom0', arg: b'arg', payload: b'payload'")
+
+    def test_007_wait_saved(self):
+        saved = self.loop.create_future()
+        self.app.wait_saved.side_effect = lambda: saved
+        self.writer.write(b'mgmt.success+arg src name dest\0payload')
+        self.writer.write_eof()
+        with self.assertRaises(asyncio.TimeoutError):
+            self.loop.run_until_complete(
+                asyncio.wait_for(self.reader.read(), 0.1))
+        saved.set_result(None)
+        with self.assertNotRaises(asyncio.TimeoutError):
+            response = self.loop.run_until_complete(
+                asyncio.wait_for(self.reader.read(), 1))
+        self.assertEqual(response,
+            b"0\0src: b'src', dest: b'dest', arg: b'arg', payload: b'payload'")
+
+    def test_008_wait_saved_failed_call(self):
+        @asyncio.coroutine
+        def wait_saved():
+            raise OSError('save failed')
+        self.app.wait_saved.side_effect = wait_saved
+        self.writer.write(b'mgmt.qubesexception+arg dom0 name dom0\0payload')
+        self.writer.write_eof()
+        with self.assertNotRaises(asyncio.TimeoutError):
+            response = self.loop.run_until_complete(
+                asyncio.wait_for(self.reader.read(), 1))
+        self.assertEqual(response, b"2\0QubesException\0\0qubes-exception\0")
+
+    def create_protocol_with_mock_transport(self):
+        protocol = qubes.api.QubesDaemonProtocol(TestMgmt, app=self.app)
+        transport = unittest.mock.Mock(**{'is_closing.return_value': False})
+        protocol.connection_made(transport)
+        self.addCleanup(protocol.connection_lost, None)
+        return protocol, transport
+
+    def test_010_events_batched(self):
+        protocol, transport = self.create_protocol_with_mock_transport()
+        protocol.send_event('subject', 'event1', arg='1')
+        protocol.send_event(self.app, 'event2')
+        self.assertFalse(transport.write.called)
+        self.loop.run_until_complete(asyncio.sleep(0))
+        transport.write.assert_called_once_with(
+            b'1\0subject\0event1\0arg\x001\0\0'
+            b'1\0\0event2\0\0')
+
+    def test_011_events_drop_oldest(self):
+        protocol, transport = self.create_protocol_with_mock_transport()
+        protocol.event_queue_limit = 2
+        protocol.event_overflow_policy = 'drop-oldest'
+        protocol.pause_writing()
+        for i in range(4):
+            protocol.send_event('subject', 'event', arg=str(i))
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.assertFalse(transport.write.called)
+        protocol.resume_writing()
+        transport.write.assert_called_once_with(
+            b'1\0\0events-lost\0count\x002\0\0'
+            b'1\0subject\0event\0arg\x002\0\0'
+            b'1\0subject\0event\0arg\x003\0\0')
+
+    def test_012_events_coalesce(self):
+        protocol, transport = self.create_protocol_with_mock_transport()
+        protocol.event_queue_limit = 2
+        protocol.event_overflow_policy = 'coalesce'
+        protocol.pause_writing()
+        protocol.send_event('subject', 'event1', arg='1')
+        protocol.send_event('subject', 'event2', arg='2')
+        protocol.send_event('subject', 'event1', arg='3')
+        protocol.send_event('subject', 'event3', arg='4')
+        protocol.resume_writing()
+        # both the replaced and the dropped events are lost
+        transport.write.assert_called_once_with(
+            b'1\0\0events-lost\0count\x002\0\0'
+            b'1\0subject\0event1\0arg\x003\0\0'
+            b'1\0subject\0event3\0arg\x004\0\0')
+
+    def test_013_events_disconnect(self):
+        protocol, transport = self.create_protocol_with_mock_transport()
+        protocol.event_queue_limit = 2
+        protocol.event_overflow_policy = 'disconnect'
+        protocol.pause_writing()
+        for i in range(3):
+            protocol.send_event('subject', 'event', arg=str(i))
+        transport.abort.assert_called_once_with()
+        protocol.resume_writing()
+        self.assertFalse(transport.write.called)
+
+    def write_frame(self, request_id, message):
+        self.writer.write(
+            qubes.api.QubesDaemonProtocol.frame_header.pack(
+                request_id, len(message)) + message)
+
+    def read_frame(self):
+        header = self.loop.run_until_complete(asyncio.wait_for(
+            self.reader.readexactly(
+                qubes.api.QubesDaemonProtocol.frame_header.size), 1))
+        request_id, length = \
+            qubes.api.QubesDaemonProtocol.frame_header.unpack(header)
+        message = self.loop.run_until_complete(asyncio.wait_for(
+            self.reader.readexactly(length), 1))
+        return request_id, message
+
+    def test_020_framed_pipelined(self):
+        self.writer.write(qubes.api.QubesDaemonProtocol.framed_magic)
+        self.write_frame(1, b'mgmt.success+arg1 src name dest\0payload1')
+        self.write_frame(2, b'mgmt.qubesexception+arg dom0 name dom0\0')
+        self.write_frame(3, b'mgmt.exception+arg dom0 name dom0\0')
+        self.write_frame(4, b'mgmt.success_none+arg dom0 name dom0\0')
+        self.writer.write_eof()
+        with self.assertNotRaises(asyncio.TimeoutError):
+            responses = dict(self.read_frame() for _ in range(4))
+            # connection closed after all the requests are handled
+            rest = self.loop.run_until_complete(
+                asyncio.wait_for(self.reader.read(), 1))
+        self.assertEqual(responses, {
+            1: b"0\0src: b'src', dest: b'dest', arg: b'arg1', "
+               b"payload: b'payload1'",
+            2: b"2\0QubesException\0\0qubes-exception\0",
+            3: b"",
+            4: b"0\0",
+        })
+        self.assertEqual(rest, b'')
+
+    def test_021_framed_in_parts(self):
+        message = b'mgmt.success src name dest\0'
+        request = qubes.api.QubesDaemonProtocol.framed_magic + \
+            qubes.api.QubesDaemonProtocol.frame_header.pack(
+                5, len(message)) + message
+        for i in range(0, len(request), 3):
+            self.writer.write(request[i:i+3])
+            self.loop.run_until_complete(self.writer.drain())
+            self.loop.run_until_complete(asyncio.sleep(0))
+        with self.assertNotRaises(asyncio.TimeoutError):
+            response = self.read_frame()
+        self.assertEqual(response, (5,
+            b"0\0src: b'src', dest: b'dest', arg: b'', payload: b''"))
+
+    def test_022_framed_event_cancel(self):
+        self.writer.write(qubes.api.QubesDaemonProtocol.framed_magic)
+        self.write_frame(7, b'mgmt.event+arg dom0 name dom0\0payload')
+        with self.assertNotRaises(asyncio.TimeoutError):
+            event = self.read_frame()
+        self.assertEqual(event,
+            (7, b"1\0subject\0event\0payload\0payload\0\0"))
+        # other requests are handled meanwhile
+        self.write_frame(8, b'mgmt.success_none dom0 name dom0\0')
+        with self.assertNotRaises(asyncio.TimeoutError):
+            response = self.read_frame()
+        self.assertEqual(response, (8, b"0\0"))
+        # cancel the request
+        self.write_frame(7, b'')
+        with self.assertNotRaises(asyncio.TimeoutError):
+            response = self.read_frame()
+        self.assertEqual(response, (7, b"0\0"))
+        self.assertEqual(self.protocol.requests, {})
+
+    def test_023_framed_duplicated_id(self):
+        self.writer.write(qubes.api.QubesDaemonProtocol.framed_magic)
+        self.write_frame(1, b'mgmt.event+arg dom0 name dom0\0payload')
+        self.write_frame(1, b'mgmt.success_none dom0 name dom0\0')
+        with self.assertNotRaises(asyncio.TimeoutError):
+            response = self.loop.run_until_complete(
+                asyncio.wait_for(self.reader.read(), 1))
+        self.assertEqual(response, b'')
+
+    def test_024_framed_events_lost(self):
+        protocol, transport = self.create_protocol_with_mock_transport()
+        protocol.framed = True
+        protocol.event_queue_limit = 1
+        protocol.event_overflow_policy = 'drop-oldest'
+        protocol.pause_writing()
+        protocol.queue_event(3, 'subject', 'event1', {})
+        protocol.queue_event(3, 'subject', 'event2', {})
+        protocol.resume_writing()
+        frame_header = qubes.api.QubesDaemonProtocol.frame_header
+        transport.write.assert_called_once_with(
+            frame_header.pack(3, 24) + b'1\0\0events-lost\0count\x001\0\0'
+            + frame_header.pack(3, 18) + b'1\0subject\0event2\0\0')
+
+    def test_025_call_metrics(self):
+        self.app.api_metrics = unittest.mock.Mock()
+        self.writer.write(b'mgmt.qubesexception+arg src name dest\0payload')
+        self.writer.write_eof()
+        with self.assertNotRaises(asyncio.TimeoutError):
+            response = self.loop.run_until_complete(
+                asyncio.wait_for(self.reader.read(), 1))
+        self.app.api_metrics.record.assert_called_once_with(TestMgmt,
+            b'src', b'mgmt.qubesexception', b'dest', b'arg',
+            queue_wait=unittest.mock.ANY, execute_time=unittest.mock.ANY,
+            bytes_in=7, bytes_out=len(response), error=True)
+
+    def test_026_framed_cancelled(self):
+        self.writer.write(qubes.api.QubesDaemonProtocol.framed_magic)
+        self.write_frame(9, b'mgmt.wait dom0 name dom0\0')
+        self.loop.run_until_complete(asyncio.sleep(0.1))
+        # the call doesn't handle the cancellation itself
+        self.write_frame(9, b'')
+        self.writer.write_eof()
+        with self.assertNotRaises(asyncio.TimeoutError):
+            response = self.read_frame()
+            # connection closed after the last request is finished
+            rest = self.loop.run_until_complete(
+                asyncio.wait_for(self.reader.read(), 1))
+        self.assertEqual(response, (9, b''))
+        self.assertEqual(rest, b'')
+        self.assertEqual(self.protocol.requests, {})
+
+
+class TestAPI(qubes.api.AbstractQubesAPI):
+    @qubes.api.method('test.Method', no_payload=True, read=True)
+    @asyncio.coroutine
+    def method(self):
+        return 'method'
+
+    @qubes.api.method('test.{endpoint}.Endpoint', endpoints=('a', 'b'),
+        write=True)
+    @asyncio.coroutine
+    def method_endpoint(self, endpoint, untrusted_payload):
+        return endpoint
+
+
+class TestAPI2(TestAPI):
+    @qubes.api.method('test.Method2', no_payload=True)
+    @asyncio.coroutine
+    def method2(self):
+        return 'method2'
+
+
+class TC_10_RoutingTable(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.app = unittest.mock.Mock()
+        self.app.domains = {'dom0': unittest.mock.Mock()}
+
+    def test_000_routing_table(self):
+        self.assertEqual(dict(TestAPI.get_routing_table()), {
+            'test.Method': (TestAPI.method, None, {'read': True}),
+            'test.a.Endpoint': (TestAPI.method_endpoint, 'a', {'write': True}),
+            'test.b.Endpoint': (TestAPI.method_endpoint, 'b', {'write': True}),
+        })
+        self.assertIs(TestAPI.get_routing_table(),
+            TestAPI.get_routing_table())
+        self.assertCountEqual(TestAPI2.get_routing_table(),
+            ['test.Method', 'test.a.Endpoint', 'test.b.Endpoint',
+             'test.Method2'])
+        self.assertNotIn('test.Method2', TestAPI.get_routing_table())
+
+    def test_001_list_methods(self):
+        self.assertEqual(list(TestAPI.list_methods('test.b.Endpoint')),
+            [(TestAPI.method_endpoint, 'test.b.Endpoint', 'b')])
+        self.assertEqual(list(TestAPI.list_methods('test.Method2')), [])
+        self.assertEqual(len(list(TestAPI.list_methods())), 3)
+
+    def test_002_dispatch(self):
+        mgmt = TestAPI(self.app, b'dom0', b'test.b.Endpoint', b'dom0', b'')
+        self.assertEqual(self.loop.run_until_complete(
+            mgmt.execute(untrusted_payload=b'')), 'b')
+        with self.assertRaises(qubes.api.ProtocolError):
+            TestAPI(self.app, b'dom0', b'test.Method2', b'dom0', b'')
+
+
+class TC_20_ReadWorkerPool(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.app = qubes.tests.TestEmitter()
+        self.app.events_enabled = True
+        # no domains to iterate over, any name looked up
+        self.app.domains = unittest.mock.MagicMock()
+        self.app.log = self.log
+        self.app.wait_saved = lambda: asyncio.sleep(0)
+        self.pool = qubes.api.workers.ReadWorkerPool(self.app, TestAPI, 1)
+        self.addCleanup(self.pool.close)
+
+    def connect_worker(self):
+        # serve the worker side in this process
+        sock_pool, sock_worker = socket.socketpair()
+        worker = qubes.api.workers.ReadWorker(0, self.pool.generation)
+        transport, _ = self.loop.run_until_complete(
+            self.loop.create_connection(
+                lambda: qubes.api.QubesDaemonProtocol(TestAPI, app=self.app),
+                sock=sock_worker))
+        self.addCleanup(transport.close)
+        self.loop.run_until_complete(self.loop.create_connection(
+            lambda: worker, sock=sock_pool))
+        self.pool.workers.append(worker)
+        return worker
+
+    def test_000_can_serve(self):
+        self.assertTrue(self.pool.can_serve(TestAPI, b'test.Method'))
+        self.assertFalse(self.pool.can_serve(TestAPI, b'test.a.Endpoint'))
+        self.assertFalse(self.pool.can_serve(TestAPI, b'test.Unknown'))
+        self.assertFalse(self.pool.can_serve(TestAPI2, b'test.Method'))
+
+    def test_001_call(self):
+        self.connect_worker()
+        with unittest.mock.patch.object(self.pool, '_spawn') as mock_spawn:
+            reply = self.loop.run_until_complete(self.pool.call(
+                b'dom0', b'test.Method', b'dom0', b'', b''))
+        self.assertEqual(reply, b'0\0method')
+        mock_spawn.assert_not_called()
+
+    def test_002_stale_snapshot(self):
+        worker = self.connect_worker()
+        self.app.fire_event('admin-permission:test.Method')
+        self.assertEqual(worker.generation, self.pool.generation)
+        self.app.fire_event('property-set:default_netvm')
+        self.assertNotEqual(worker.generation, self.pool.generation)
+        with unittest.mock.patch.object(self.pool, '_spawn') as mock_spawn:
+            reply = self.loop.run_until_complete(self.pool.call(
+                b'dom0', b'test.Method', b'dom0', b'', b''))
+            # to be served locally, until a fresh worker is started
+            self.assertIsNone(reply)
+            self.loop.run_until_complete(asyncio.sleep(0))
+        mock_spawn.assert_called_once_with()
+        self.assertEqual(self.pool.workers, [])
+
+    def test_003_read_only_events(self):
+        worker = self.connect_worker()
+        for event in ('admin-permission:test.Method', 'domain-is-fully-usable',
+                'vm-stats', 'domain-feature-pre-set:foo', 'property-pre-set:x',
+                'property-reset:xid', 'device-list:pci',
+                'domain-start-timings', 'domain-qdb-change:/name'):
+            self.app.fire_event(event)
+        self.assertEqual(worker.generation, self.pool.generation)
+        with unittest.mock.patch.object(self.pool, '_spawn') as mock_spawn:
+            for _ in range(3):
+                reply = self.loop.run_until_complete(self.pool.call(
+                    b'dom0', b'test.Method', b'dom0', b'', b''))
+                self.assertEqual(reply, b'0\0method')
+            self.loop.run_until_complete(asyncio.sleep(0))
+        mock_spawn.assert_not_called()
+
+        for event in ('domain-feature-set:foo', 'domain-tag-delete:bar',
+                'domain-start', 'property-del:label'):
+            generation = self.pool.generation
+            self.app.fire_event(event)
+            self.assertNotEqual(generation, self.pool.generation)
+
+    def test_004_spawn(self):
+        server_sock, pool_sock = socket.socketpair()
+        self.addCleanup(server_sock.close)
+        self.addCleanup(pool_sock.close)
+        # not a real fork server, nothing to wait for in close()
+        self.pool._fork_server = pool_sock
+        self.addCleanup(setattr, self.pool, '_fork_server', None)
+        self.app.__xml__ = lambda: lxml.etree.Element('qubes')
+        self.pool._spawn()
+        worker, = self.pool.workers
+        self.assertFalse(worker.alive)
+
+        # what the fork server receives
+        header, ancdata, _, _ = server_sock.recvmsg(4, socket.CMSG_LEN(4))
+        size, = struct.unpack('=I', header)
+        self.assertEqual(server_sock.recv(size), b'<qubes/>')
+        (level, cmsg_type, data), = ancdata
+        self.assertEqual((level, cmsg_type),
+            (socket.SOL_SOCKET, socket.SCM_RIGHTS))
+        worker_sock = socket.socket(fileno=struct.unpack('=i', data)[0])
+        self.addCleanup(worker_sock.close)
+
+        # the worker is ready once it sends its pid
+        worker_sock.sendall(struct.pack('=I', 1234))
+        self.loop.run_until_complete(asyncio.sleep(0.1))
+        self.assertEqual(worker.pid, 1234)
+        self.assertTrue(worker.alive)
+
+
+class TC_30_CallMetrics(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.metrics = qubes.api.metrics.CallMetrics(slow_call_threshold=1)
+        self.metrics.log = unittest.mock.Mock()
+
+    def record(self, meth, execute_time=0.002, error=False):
+        self.metrics.record(TestAPI, b'test-vm', meth, b'dom0', b'',
+            queue_wait=0.0001, execute_time=execute_time, bytes_in=3,
+            bytes_out=10, error=error)
+
+    def test_000_record(self):
+        self.record(b'test.Method')
+        self.record(b'test.Method', error=True)
+        self.record(b'test.NoSuchMethod')
+        stats = self.metrics.calls['test.Method', 'test-vm']
+        self.assertEqual((stats.calls, stats.errors, stats.bytes_in,
+            stats.bytes_out), (2, 1, 6, 20))
+        self.assertEqual(stats.execute_time.count, 2)
+        self.assertAlmostEqual(stats.execute_time.sum, 0.004)
+        self.assertEqual(stats.queue_wait.counts[0], 2)
+        self.assertIn(('unknown', 'test-vm'), self.metrics.calls)
+        self.metrics.log.warning.assert_not_called()
+
+    def test_001_slow_call(self):
+        self.record(b'test.Method', execute_time=2)
+        self.metrics.log.warning.assert_called_once_with(unittest.mock.ANY,
+            'test.Method', '', 'test-vm', 'dom0', 2, 0.0001)
+
+    def test_002_format_prometheus(self):
+        self.record(b'test.Method', execute_time=0.02)
+        text = self.metrics.format_prometheus()
+        self.assertIn('# TYPE qubesd_api_calls_total counter\n'
+            'qubesd_api_calls_total{method="test.Method",source="test-vm"} '
+            '1\n', text)
+        self.assertIn('qubesd_api_execute_seconds_bucket{method="test.Method",'
+            'source="test-vm",le="0.01"} 0\n'
+            'qubesd_api_execute_seconds_bucket{method="test.Method",'
+            'source="test-vm",le="0.025"} 1\n', text)
+        self.assertIn('qubesd_api_execute_seconds_count{method="test.Method",'
+            'source="test-vm"} 1\n', text)
+
+
+class TestDomain(qubes.tests.TestEmitter):
+    def __init__(self, name):
+        super().__init__()
+        self.name = name
+        self.events_enabled = True
+
+
+class TC_32_StartupMetrics(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.app = qubes.tests.TestEmitter()
+        self.app.events_enabled = True
+        self.vm1 = TestDomain('test-vm1')
+        self.app.domains = [self.vm1]
+        self.metrics = qubes.api.metrics.StartupMetrics(self.app,
+            samples_size=3)
+
+    def start(self, vm, durations, success=True):
+        vm.fire_event('domain-start-timings', success=success,
+            total=sum(durations) + 0.1,
+            timings=(('storage-start', durations[0]),
+                ('qrexec-start', durations[1])))
+
+    def test_000_record(self):
+        self.start(self.vm1, (1, 2))
+        self.start(self.vm1, (2, 3))
+        self.start(self.vm1, (5, 5), success=False)
+        self.assertEqual(self.metrics.phases('test-vm1'), {
+            'storage-start': [1, 2],
+            'qrexec-start': [2, 3],
+            'total': [3.1, 5.1],
+        })
+        self.assertEqual(self.metrics.phases('test-vm2'), {})
+
+    def test_001_samples_size(self):
+        for i in range(5):
+            self.start(self.vm1, (i, 0))
+        self.assertEqual(self.metrics.phases('test-vm1')['storage-start'],
+            [2, 3, 4])
+
+    def test_002_domains(self):
+        vm2 = TestDomain('test-vm2')
+        self.app.fire_event('domain-add', vm=vm2)
+        self.start(self.vm1, (1, 2))
+        self.start(vm2, (3, 4))
+        self.assertEqual(self.metrics.phases()['storage-start'], [1, 3])
+        self.app.fire_event('domain-delete', vm=self.vm1)
+        self.start(self.vm1, (1, 2))
+        self.assertEqual(self.metrics.phases()['storage-start'], [3])
+
+    def test_003_format(self):
+        self.start(self.vm1, (1, 2))
+        self.start(self.vm1, (3, 4))
+        self.assertEqual(self.metrics.format('test-vm1'),
+            'qrexec-start count=2 p50=4.000 p90=4.000 p99=4.000 '
+            'max=4.000\n'
+            'storage-start count=2 p50=3.000 p90=3.000 p99=3.000 '
+            'max=3.000\n'
+            'total count=2 p50=7.100 p90=7.100 p99=7.100 max=7.100\n')
+        text = ''.join(self.metrics.format_prometheus())
+        self.assertIn('qubesd_vm_start_phase_seconds{phase="storage-start",'
+            'quantile="0.5"} 3\n', text)
+        self.assertIn('qubesd_vm_start_phase_seconds_count'
+            '{phase="storage-start"} 2\n', text)
+
+
+class BlockingAPI(qubes.api.AbstractQubesAPI):
+    @qubes.api.method('test.Block', no_payload=True, read=True)
+    @asyncio.coroutine
+    def block(self):
+        time.sleep(0.2)
+
+
+class TC_31_LoopWatchdog(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.watchdog = qubes.api.metrics.LoopWatchdog(0.01, 0.05,
+            loop=self.loop)
+        self.watchdog.log = unittest.mock.Mock()
+
+    def tearDown(self):
+        self.watchdog.stop()
+        super().tearDown()
+
+    def test_000_lag(self):
+        self.watchdog.stall_threshold = None
+        self.watchdog.start()
+        self.loop.run_until_complete(asyncio.sleep(0.1))
+        self.assertGreater(len(self.watchdog.samples), 0)
+        self.assertLess(self.watchdog.percentile(0.5), 0.05)
+        self.assertEqual(self.watchdog.stalls, 0)
+        self.assertIn('qubesd_loop_stalls_total 0\n',
+            ''.join(self.watchdog.format_prometheus()))
+
+    def test_001_stall(self):
+        app = unittest.mock.Mock()
+        dom0 = unittest.mock.Mock()
+        dom0.name = 'dom0'
+        app.domains = {'dom0': dom0}
+        mgmt = BlockingAPI(app, b'dom0', b'test.Block', b'dom0', b'')
+        self.watchdog.start()
+        self.loop.run_until_complete(asyncio.sleep(0.02))
+        self.loop.run_until_complete(mgmt.execute(untrusted_payload=b''))
+        self.loop.run_until_complete(asyncio.sleep(0.02))
+        self.assertEqual(self.watchdog.stalls, 1)
+        self.assertGreaterEqual(self.watchdog.percentile(1), 0.1)
+        msg, *args = self.watchdog.log.warning.call_args[0]
+        msg = msg % tuple(args)
+        self.assertIn('in call test.Block+ (dom0 → dom0)', msg)
+        self.assertIn('time.sleep(0.2)', msg)
@@ -21,6 +21,7 @@
 ''' Tests for management calls endpoints '''
 
 import asyncio
+import functools
 import operator
 import os
 import shutil
@@ -28,6 +29,7 @@ import tempfile
 import unittest.mock
 
 import libvirt
+import lxml.etree
 import copy
 
 import pathlib
@@ -37,6 +39,7 @@ import qubes.devices
 import qubes.firewall
 import qubes.api.admin
 import qubes.api.internal
+import qubes.api.metrics
 import qubes.tests
 import qubes.storage
 
@@ -155,6 +158,323 @@ class TC_00_VMs(AdminAPITestCase):
                     'dom0 class=AdminVM state=Running\n'
                     'test-vm1 class=AppVM state=Halted\n')
 
+    def test_003_vm_list_filter_cached(self):
+        import qubes.ext.admin
+        self.app.system_info_cache = \
+            qubes.api.internal.SystemInfoCache(self.app)
+        decisions = qubes.ext.admin.AdminExtension._instance.policy_decisions
+        decisions.clear()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tmpdir = pathlib.Path(tmpdir)
+            with unittest.mock.patch(
+                    'qubes.ext.admin.AdminExtension._instance.policy_cache.path',
+                    pathlib.Path(tmpdir)):
+                with (tmpdir / 'admin.policy').open('w') as f:
+                    f.write('admin.vm.List * @anyvm @adminvm allow\n')
+                    f.write('admin.vm.List * @anyvm @tag:visible allow')
+
+                def vm_list():
+                    mgmt_obj = qubes.api.admin.QubesAdminAPI(self.app,
+                        b'test-vm1', b'admin.vm.List', b'dom0', b'')
+                    loop = asyncio.get_event_loop()
+                    return loop.run_until_complete(
+                        mgmt_obj.execute(untrusted_payload=b''))
+
+                self.assertEqual(vm_list(),
+                    'dom0 class=AdminVM state=Running\n')
+                hits, misses = decisions.hits, decisions.misses
+                self.assertEqual(vm_list(),
+                    'dom0 class=AdminVM state=Running\n')
+                self.assertEqual(decisions.hits, hits + 3)
+                self.assertEqual(decisions.misses, misses)
+
+                self.vm.tags.add('visible')
+                self.assertEqual(vm_list(),
+                    'dom0 class=AdminVM state=Running\n'
+                    'test-vm1 class=AppVM state=Halted\n')
+                self.assertEqual(decisions.misses, misses + 3)
+
+    def test_004_vm_get_all_data(self):
+        self.vm.features['feature1'] = 'value1'
+        self.vm.features['feature2'] = 'multi\nline'
+        self.vm.tags.add('tag1')
+        volume = unittest.mock.Mock()
+        for prop in volume_properties:
+            setattr(volume, prop, prop + '-value')
+        volume.is_outdated.side_effect = NotImplementedError
+        self.vm.volumes = {'private': volume}
+        value = self.call_mgmt_func(b'admin.vm.GetAllData', b'test-vm1')
+        lines = value.splitlines()
+        self.assertEqual(lines[0], 'vm test-vm1 class=AppVM state=Halted')
+        self.assertIn('property name default=False type=str test-vm1', lines)
+        self.assertIn('property label default=False type=label red', lines)
+        self.assertIn('tag tag1', lines)
+        self.assertEqual(
+            [line for line in lines
+                if line.startswith(('feature ', 'volume '))],
+            ['feature feature1 value1',
+             'feature feature2 multi\\nline'] +
+            ['volume private {p}={p}-value'.format(p=p)
+                for p in volume_properties])
+        self.assertEventFired(self.emitter,
+            'admin-permission:admin.vm.GetAllData')
+        self.assertEventFired(self.emitter,
+            'admin-permission:admin.vm.feature.Get',
+            kwargs={'dest': self.vm, 'arg': 'feature2'})
+
+    def test_005_vm_get_all_data_filtered(self):
+        fire_event = self.emitter.fire_event
+
+        def filtered_fire_event(event, **kwargs):
+            effects = fire_event(event, **kwargs)
+            if event == 'admin-permission:admin.vm.property.GetAll':
+                raise qubes.api.PermissionDenied()
+            if event == 'admin-permission:admin.vm.feature.Get' and \
+                    kwargs['arg'] == 'feature2':
+                raise qubes.api.PermissionDenied()
+            if event == 'admin-permission:admin.vm.tag.List':
+                return [lambda tag: tag in ('tag1', 'tag2')]
+            if event == 'admin-permission:admin.vm.GetAllData':
+                return [lambda vm: vm.name != 'test-template']
+            return effects
+        self.app.domains[0].fire_event = filtered_fire_event
+
+        self.vm.features['feature1'] = 'value1'
+        self.vm.features['feature2'] = 'value2'
+        self.vm.tags.add('tag1')
+        self.vm.tags.add('tag2')
+        self.vm.volumes = {}
+        value = self.call_mgmt_func(b'admin.vm.GetAllData', b'dom0')
+        lines = value.splitlines()
+        self.assertNotIn('vm test-template class=TemplateVM state=Halted',
+            lines)
+        self.assertEqual(lines[lines.index(
+                'vm test-vm1 class=AppVM state=Halted'):],
+            ['vm test-vm1 class=AppVM state=Halted',
+             'feature feature1 value1',
+             'tag tag1',
+             'tag tag2'])
+
+    def test_006_vm_list_worker_policy_change(self):
+        import qubes.api.workers
+        import qubes.ext.admin
+        extension = qubes.ext.admin.AdminExtension._instance
+        old_policy_cache = extension.policy_cache
+        self.addCleanup(old_policy_cache.cleanup)
+        self.addCleanup(qubes.api.workers._inherited_objects.clear)
+        with unittest.mock.patch.dict(self.app.pools):
+            # a mock, can't be serialized
+            del self.app.pools['test']
+            snapshot = lxml.etree.tostring(self.app.__xml__())
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tmpdir = pathlib.Path(tmpdir)
+            with (tmpdir / 'admin.policy').open('w') as f:
+                f.write('admin.vm.List * @anyvm @adminvm allow\n')
+            with unittest.mock.patch('qubes.ext.admin.utils.PolicyCache',
+                    functools.partial(qubes.ext.admin.utils.PolicyCache,
+                        path=tmpdir)):
+                worker_app = qubes.api.workers._load_worker_app(
+                    self.app.store, snapshot)
+            self.addCleanup(worker_app.close)
+            worker_app.vmm = self.app.vmm
+            self.assertIsNot(extension.policy_cache, old_policy_cache)
+
+            def vm_list():
+                mgmt_obj = qubes.api.admin.QubesAdminAPI(worker_app,
+                    b'test-vm1', b'admin.vm.List', b'dom0', b'')
+                return self.loop.run_until_complete(
+                    mgmt_obj.execute(untrusted_payload=b''))
+
+            self.assertEqual(vm_list(),
+                'dom0 class=AdminVM state=Running\n')
+            with (tmpdir / 'admin.policy').open('a') as f:
+                f.write('admin.vm.List * @anyvm test-vm1 allow\n')
+            # let the watcher notice the change
+            self.loop.run_until_complete(asyncio.sleep(0.1))
+            self.assertEqual(vm_list(),
+                'dom0 class=AdminVM state=Running\n'
+                'test-vm1 class=AppVM state=Halted\n')
+
+    def test_007_vm_get_all_data_policy(self):
+        self.vm.features['feature1'] = 'value1'
+        self.vm.features['feature2'] = 'value2'
+        self.vm.tags.add('tag1')
+        volume = unittest.mock.Mock()
+        for prop in volume_properties:
+            setattr(volume, prop, prop + '-value')
+        self.vm.volumes = {'private': volume}
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tmpdir = pathlib.Path(tmpdir)
+            with unittest.mock.patch(
+                    'qubes.ext.admin.AdminExtension._instance.policy_cache.path',
+                    pathlib.Path(tmpdir)):
+                with (tmpdir / 'admin.policy').open('w') as f:
+                    f.write('admin.vm.GetAllData * @anyvm @anyvm allow\n')
+                    f.write('admin.vm.property.GetAll * @anyvm @anyvm '
+                        'deny\n')
+                    f.write('admin.vm.feature.List * @anyvm @anyvm allow\n')
+                    f.write('admin.vm.feature.Get +feature2 @anyvm @anyvm '
+                        'deny\n')
+                    f.write('admin.vm.feature.Get * @anyvm @anyvm allow\n')
+                    f.write('admin.vm.tag.List * @anyvm @anyvm allow\n')
+                mgmt_obj = qubes.api.admin.QubesAdminAPI(self.app, b'test-vm1',
+                    b'admin.vm.GetAllData', b'test-vm1', b'')
+                loop = asyncio.get_event_loop()
+                value = loop.run_until_complete(
+                    mgmt_obj.execute(untrusted_payload=b''))
+        self.assertEqual(value,
+            'vm test-vm1 class=AppVM state=Halted\n'
+            'feature feature1 value1\n'
+            'tag tag1\n')
+
+    def test_008_vm_get_all_data_policy_denied_section(self):
+        self.vm.features['feature1'] = 'value1'
+        self.vm.tags.add('tag1')
+        volume = unittest.mock.Mock()
+        for prop in volume_properties:
+            setattr(volume, prop, prop + '-value')
+        self.vm.volumes = {'private': volume}
+
+        def evaluate(policy, app, service, arg, source, dest):
+            # pylint: disable=unused-argument
+            return service != 'admin.vm.volume.List'
+
+        with unittest.mock.patch(
+                'qubes.ext.admin.PolicyDecisionCache.evaluate',
+                side_effect=evaluate) as mock_evaluate:
+            mgmt_obj = qubes.api.admin.QubesAdminAPI(self.app, b'test-vm1',
+                b'admin.vm.GetAllData', b'test-vm1', b'')
+            value = self.loop.run_until_complete(
+                mgmt_obj.execute(untrusted_payload=b''))
+        lines = value.splitlines()
+        self.assertIn('property name default=False type=str test-vm1', lines)
+        self.assertIn('feature feature1 value1', lines)
+        self.assertIn('tag tag1', lines)
+        self.assertFalse(any(line.startswith('volume ') for line in lines))
+        mock_evaluate.assert_any_call(unittest.mock.ANY, self.app,
+            'admin.vm.feature.Get', '+feature1', 'test-vm1', 'test-vm1')
+        mock_evaluate.assert_any_call(unittest.mock.ANY, self.app,
+            'admin.vm.volume.List', '+', 'test-vm1', 'test-vm1')
+
+    def test_015_vm_set_many(self):
+        self.vm.features['feature2'] = 'old'
+        self.vm.tags.add('tag2')
+        value = self.call_mgmt_func(b'admin.vm.SetMany', b'test-vm1',
+            payload=b'property qrexec_timeout 120\n'
+                    b'property-reset include_in_backups\n'
+                    b'feature feature1 multi\\nline\\\\n\n'
+                    b'feature-remove feature2\n'
+                    b'tag tag1\n'
+                    b'tag-remove tag2\n')
+        self.assertIsNone(value)
+        self.assertEqual(self.vm.qrexec_timeout, 120)
+        self.assertTrue(self.vm.property_is_default('include_in_backups'))
+        self.assertEqual(dict(self.vm.features),
+            {'feature1': 'multi\nline\\n'})
+        self.assertIn('tag1', self.vm.tags)
+        self.assertNotIn('tag2', self.vm.tags)
+        self.app.save.assert_called_once_with()
+        self.assertEventFired(self.emitter,
+            'admin-permission:admin.vm.SetMany')
+        self.assertEventFired(self.emitter,
+            'admin-permission:admin.vm.property.Set',
+            kwargs={'dest': self.vm, 'arg': 'qrexec_timeout',
+                'newvalue': 120})
+        self.assertEventFired(self.emitter,
+            'admin-permission:admin.vm.feature.Set',
+            kwargs={'dest': self.vm, 'arg': 'feature1',
+                'value': 'multi\nline\\n'})
+        self.assertEventFired(self.emitter,
+            'admin-permission:admin.vm.tag.Remove',
+            kwargs={'dest': self.vm, 'arg': 'tag2'})
+
+    def test_016_vm_set_many_invalid(self):
+        for payload in (b'',
+                b'property no_such_property 1\n',
+                b'property qrexec_timeout abc\n',
+                b'property-reset qrexec_timeout 1\n',
+                b'feature feature/1 value\n',
+                b'feature feature1 invalid\\escape\n',
+                b'tag tag1 value\n',
+                b'other name\n',
+                b'feature feature1 \x80\n'):
+            with self.subTest(payload):
+                with self.assertRaises((qubes.api.PermissionDenied,
+                        qubes.api.ProtocolError, qubes.exc.QubesValueError,
+                        ValueError)):
+                    self.call_mgmt_func(b'admin.vm.SetMany', b'test-vm1',
+                        payload=b'tag tag1\n' + payload if payload else b'')
+                self.assertNotIn('tag1', self.vm.tags)
+                self.assertFalse(self.app.save.called)
+
+    def test_017_vm_set_many_revert(self):
+        self.vm.qrexec_timeout = 30
+        self.vm.features['feature1'] = 'old'
+        with self.assertRaises(qubes.exc.QubesFeatureNotFoundError):
+            self.call_mgmt_func(b'admin.vm.SetMany', b'test-vm1',
+                payload=b'property qrexec_timeout 120\n'
+                        b'property include_in_backups False\n'
+                        b'feature feature1 new\n'
+                        b'feature feature2 new\n'
+                        b'tag tag1\n'
+                        b'feature-remove no-such-feature\n')
+        self.assertEqual(self.vm.qrexec_timeout, 30)
+        self.assertTrue(self.vm.property_is_default('include_in_backups'))
+        self.assertEqual(dict(self.vm.features), {'feature1': 'old'})
+        self.assertNotIn('tag1', self.vm.tags)
+        self.assertFalse(self.app.save.called)
+
+    def test_018_vm_set_many_denied(self):
+        fire_event = self.emitter.fire_event
+
+        def filtered_fire_event(event, **kwargs):
+            if event == 'admin-permission:admin.vm.tag.Set' and \
+                    kwargs['arg'] == 'tag2':
+                raise qubes.api.PermissionDenied()
+            return fire_event(event, **kwargs)
+        self.app.domains[0].fire_event = filtered_fire_event
+
+        with self.assertRaises(qubes.api.PermissionDenied):
+            self.call_mgmt_func(b'admin.vm.SetMany', b'test-vm1',
+                payload=b'feature feature1 value\n'
+                        b'tag tag1\n'
+                        b'tag tag2\n')
+        self.assertNotIn('feature1', self.vm.features)
+        self.assertNotIn('tag1', self.vm.tags)
+        self.assertFalse(self.app.save.called)
+
+    def test_019_vm_set_many_policy(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tmpdir = pathlib.Path(tmpdir)
+            with unittest.mock.patch(
+                    'qubes.ext.admin.AdminExtension._instance.policy_cache.path',
+                    pathlib.Path(tmpdir)):
+                with (tmpdir / 'admin.policy').open('w') as f:
+                    f.write('admin.vm.SetMany * @anyvm @anyvm allow\n')
+                    f.write('admin.vm.property.Set +netvm @anyvm @anyvm '
+                        'deny\n')
+                    f.write('admin.vm.property.Set * @anyvm @anyvm allow\n')
+                    f.write('admin.vm.tag.Set * @anyvm @anyvm allow\n')
+
+                def set_many(payload):
+                    mgmt_obj = qubes.api.admin.QubesAdminAPI(self.app,
+                        b'test-vm1', b'admin.vm.SetMany', b'test-vm1', b'')
+                    loop = asyncio.get_event_loop()
+                    return loop.run_until_complete(
+                        mgmt_obj.execute(untrusted_payload=payload))
+
+                for payload in (b'property netvm \n',
+                        b'feature feature1 value\n'):
+                    with self.subTest(payload):
+                        with self.assertRaises(qubes.api.PermissionDenied):
+                            set_many(b'tag tag1\n' + payload)
+                        self.assertNotIn('tag1', self.vm.tags)
+                        self.assertFalse(self.app.save.called)
+
+                set_many(b'tag tag1\nproperty qrexec_timeout 120\n')
+                self.assertIn('tag1', self.vm.tags)
+                self.assertEqual(self.vm.qrexec_timeout, 120)
+
     def test_010_vm_property_list(self):
         # this test is kind of stupid, but at least check if appropriate
         # admin-permission event is fired
@@ -1076,6 +1396,202 @@ netvm default=True type=vm \n'''
         self.assertIsNone(value)
         func_mock.assert_called_once_with()
 
+    def setup_lifecycle_vms(self):
+        self.netvm = self.app.add_new_vm('AppVM', label='red',
+            name='test-net', template='test-template', provides_network=True)
+        self.vm.netvm = self.netvm
+        self.vm2 = self.app.add_new_vm('AppVM', label='red',
+            name='test-vm2', template='test-template')
+        self.vm2.netvm = self.netvm
+        self.addCleanup(delattr, self, 'vm2')
+        return self.netvm, self.vm, self.vm2
+
+    def call_lifecycle_func(self, method, payload, arg=b'', src=b'dom0'):
+        send_event = unittest.mock.Mock(spec=[])
+        mgmt_obj = qubes.api.admin.QubesAdminAPI(self.app, src, method,
+            b'dom0', arg, send_event=send_event)
+        try:
+            self.loop.run_until_complete(
+                mgmt_obj.execute(untrusted_payload=payload))
+        finally:
+            self.events = [(call[0][0].name,) + call[0][1:] + tuple(
+                    sorted(call[1].items()))
+                for call in send_event.call_args_list]
+
+    def test_261_start_many(self):
+        calls = []
+
+        def mock_start(vm):
+            @asyncio.coroutine
+            def start():
+                calls.append(('begin', vm.name))
+                yield from asyncio.sleep(0.01)
+                calls.append(('end', vm.name))
+            return start
+        for vm in self.setup_lifecycle_vms():
+            vm.start = mock_start(vm)
+
+        self.call_lifecycle_func(b'admin.vm.StartMany',
+            b'test-vm1\ntest-vm2\ntest-net\n')
+        # netvm first, then its clients concurrently
+        self.assertEqual(calls[:2], [('begin', 'test-net'), ('end', 'test-net')])
+        self.assertEqual(sorted(calls[2:4]),
+            [('begin', 'test-vm1'), ('begin', 'test-vm2')])
+        self.assertEqual(self.events[0], ('test-net', 'domain-start'))
+        self.assertCountEqual(self.events[1:],
+            [('test-vm1', 'domain-start'), ('test-vm2', 'domain-start')])
+        self.assertEventFired(self.emitter,
+            'admin-permission:admin.vm.Start',
+            kwargs={'dest': self.vm2, 'arg': ''})
+        self.assertFalse(self.app.save.called)
+
+    def test_262_start_many_failed_dependency(self):
+        netvm, vm1, vm2 = self.setup_lifecycle_vms()
+
+        @asyncio.coroutine
+        def failing_start():
+            raise qubes.exc.QubesException('netvm failed')
+        netvm.start = failing_start
+        vm1.start = unittest.mock.Mock()
+        vm2.start = unittest.mock.Mock()
+
+        with self.assertRaises(qubes.exc.QubesException):
+            self.call_lifecycle_func(b'admin.vm.StartMany',
+                b'test-vm1\ntest-net\n')
+        self.assertFalse(vm1.start.called)
+        self.assertFalse(vm2.start.called)
+        self.assertEqual(self.events, [
+            ('test-net', 'domain-start-failed', ('reason', 'netvm failed')),
+            ('test-vm1', 'domain-start-failed', ('reason',
+                'Not attempted, start of qube test-net failed')),
+        ])
+
+    def test_263_start_many_denied(self):
+        netvm, vm1, _ = self.setup_lifecycle_vms()
+        netvm.start = unittest.mock.Mock()
+        vm1.start = unittest.mock.Mock()
+        fire_event = self.emitter.fire_event
+
+        def filtered_fire_event(event, **kwargs):
+            if event == 'admin-permission:admin.vm.Start' and \
+                    kwargs['dest'] is netvm:
+                raise qubes.api.PermissionDenied()
+            return fire_event(event, **kwargs)
+        self.app.domains[0].fire_event = filtered_fire_event
+
+        with self.assertRaises(qubes.api.PermissionDenied):
+            self.call_lifecycle_func(b'admin.vm.StartMany',
+                b'test-vm1\ntest-net\n')
+        self.assertFalse(netvm.start.called)
+        self.assertFalse(vm1.start.called)
+
+    def test_264_start_many_invalid(self):
+        for payload in (b'', b'no-such-vm\n', b'dom0\n', b'test-vm1\n\x80'):
+            with self.subTest(payload):
+                with self.assertRaises((qubes.api.PermissionDenied,
+                        qubes.api.ProtocolError)):
+                    self.call_lifecycle_func(b'admin.vm.StartMany', payload)
+
+    def test_265_shutdown_many(self):
+        calls = []
+        halted = set()
+
+        def mock_shutdown(vm):
+            @asyncio.coroutine
+            def shutdown(force=False, wait=False):
+                self.assertTrue(wait)
+                calls.append((vm.name, force))
+                yield from asyncio.sleep(0.01)
+                halted.add(vm.name)
+            return shutdown
+        for vm in self.setup_lifecycle_vms():
+            vm.shutdown = mock_shutdown(vm)
+            vm.is_halted = functools.partial(
+                lambda name: name in halted, vm.name)
+
+        self.call_lifecycle_func(b'admin.vm.ShutdownMany',
+            b'test-net\ntest-vm1\ntest-vm2\n', b'force')
+        # clients of netvm first, then netvm itself
+        self.assertCountEqual(calls[:2],
+            [('test-vm1', True), ('test-vm2', True)])
+        self.assertEqual(calls[2], ('test-net', True))
+        self.assertCountEqual(self.events[:2],
+            [('test-vm1', 'domain-shutdown'), ('test-vm2', 'domain-shutdown')])
+        self.assertEqual(self.events[2], ('test-net', 'domain-shutdown'))
+        self.assertEventFired(self.emitter,
+            'admin-permission:admin.vm.Shutdown',
+            kwargs={'dest': self.netvm, 'arg': 'force', 'force': True})
+
+    def test_266_shutdown_many_timeout(self):
+        netvm, vm1, _ = self.setup_lifecycle_vms()
+        vm1.is_halted = lambda: False
+        func_mock = unittest.mock.Mock(
+            side_effect=qubes.exc.QubesVMShutdownTimeoutError(vm1))
+
+        @asyncio.coroutine
+        def coroutine_mock(*args, **kwargs):
+            return func_mock(*args, **kwargs)
+        vm1.shutdown = coroutine_mock
+        netvm.shutdown = unittest.mock.Mock()
+        netvm.is_halted = lambda: False
+
+        with self.assertRaises(qubes.exc.QubesException):
+            self.call_lifecycle_func(b'admin.vm.ShutdownMany',
+                b'test-net\ntest-vm1\n')
+        func_mock.assert_called_once_with(force=False, wait=True)
+        self.assertFalse(netvm.shutdown.called)
+        self.assertEqual(self.events, [
+            ('test-vm1', 'domain-shutdown-failed', ('reason',
+                'Domain shutdown timed out: \'test-vm1\'')),
+            ('test-net', 'domain-shutdown-failed', ('reason',
+                'Not attempted, shutdown of qube test-vm1 failed')),
+        ])
+
+    def test_267_lifecycle_dependencies(self):
+        netvm, vm1, vm2 = self.setup_lifecycle_vms()
+        # indirect dependency through a qube not listed
+        firewall = self.app.add_new_vm('AppVM', label='red',
+            name='test-firewall', template='test-template',
+            provides_network=True)
+        firewall.netvm = netvm
+        vm1.netvm = firewall
+        # cycle through guivm
+        netvm.guivm = vm2
+        dependencies = qubes.api.admin.QubesAdminAPI._lifecycle_dependencies(
+            (vm1, vm2, netvm))
+        self.assertEqual(dependencies[vm1], {netvm, vm2})
+        self.assertEqual(len(dependencies[vm2] | dependencies[netvm]), 1)
+
+    def test_268_lifecycle_many_policy(self):
+        netvm, vm1, vm2 = self.setup_lifecycle_vms()
+        for vm in (netvm, vm1, vm2):
+            vm.start = unittest.mock.Mock()
+            vm.shutdown = unittest.mock.Mock()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tmpdir = pathlib.Path(tmpdir)
+            with unittest.mock.patch(
+                    'qubes.ext.admin.AdminExtension._instance.policy_cache.path',
+                    pathlib.Path(tmpdir)):
+                with (tmpdir / 'admin.policy').open('w') as f:
+                    f.write('admin.vm.StartMany * @anyvm @adminvm allow\n')
+                    f.write('admin.vm.ShutdownMany * @anyvm @adminvm '
+                        'allow\n')
+                    f.write('admin.vm.Start * @anyvm test-vm2 allow\n')
+                    f.write('admin.vm.Shutdown +force @anyvm test-vm2 '
+                        'allow\n')
+
+                for method, arg in ((b'admin.vm.StartMany', b''),
+                        (b'admin.vm.ShutdownMany', b''),
+                        (b'admin.vm.ShutdownMany', b'force')):
+                    with self.subTest(method=method, arg=arg):
+                        with self.assertRaises(qubes.api.PermissionDenied):
+                            self.call_lifecycle_func(method,
+                                b'test-vm2\ntest-vm1\n', arg=arg,
+                                src=b'test-vm2')
+                for vm in (netvm, vm1, vm2):
+                    self.assertFalse(vm.start.called)
+                    self.assertFalse(vm.shutdown.called)
+
     def test_270_events(self):
         send_event = unittest.mock.Mock(spec=[])
         mgmt_obj = qubes.api.admin.QubesAdminAPI(self.app, b'dom0', b'admin.Events',
@@ -2394,8 +2910,8 @@ netvm default=True type=vm \n'''
         self.assertEventFired(self.emitter,
             'admin-permission:' + 'admin.vm.Stats')
         self.assertEqual(self.app.host.get_vm_stats.mock_calls, [
-            unittest.mock.call(None, None, only_vm=None),
-            unittest.mock.call(0, stats1, only_vm=None),
+            unittest.mock.call(None, None),
+            unittest.mock.call(0, stats1),
         ])
         self.assertEqual(send_event.mock_calls, [
             unittest.mock.call(self.app, 'connection-established'),
@@ -2467,8 +2983,8 @@ netvm default=True type=vm \n'''
         self.assertEventFired(self.emitter,
             'admin-permission:' + 'admin.vm.Stats')
         self.assertEqual(self.app.host.get_vm_stats.mock_calls, [
-            unittest.mock.call(None, None, only_vm=self.vm),
-            unittest.mock.call(0, stats1, only_vm=self.vm),
+            unittest.mock.call(None, None),
+            unittest.mock.call(0, stats1),
         ])
         self.assertEqual(send_event.mock_calls, [
             unittest.mock.call(self.app, 'connection-established'),
@@ -2484,6 +3000,265 @@ netvm default=True type=vm \n'''
                     memory_kb=stats2[2]['memory_kb']),
             ])
 
+    def test_632_vm_stats_shared_sampler(self):
+        stats1 = {
+            0: {
+                'cpu_time': 243951379111104 // 8,
+                'cpu_usage': 0,
+                'cpu_usage_raw': 0,
+                'memory_kb': 3733212,
+            },
+            2: {
+                'cpu_time': 2849496569205,
+                'cpu_usage': 0,
+                'cpu_usage_raw': 0,
+                'memory_kb': 303916,
+            },
+            3: {
+                'cpu_time': 1000000000,
+                'cpu_usage': 0,
+                'cpu_usage_raw': 0,
+                'memory_kb': 40000,
+            },
+        }
+        stats2 = copy.deepcopy(stats1)
+        stats2[2]['cpu_usage'] = 5
+        stats2[2]['cpu_usage_raw'] = 5
+        self.app.host.get_vm_stats = unittest.mock.Mock()
+        self.app.host.get_vm_stats.side_effect = [
+            (0, stats1), (1, stats2),
+        ]
+        self.app.stats_interval = 1
+
+        class MockVM(object):
+            def __init__(self, name):
+                self._name = name
+
+            def name(self):
+                return self._name
+
+        self.app.vmm.libvirt_conn.lookupByID.side_effect = lambda xid: {
+            0: MockVM('Domain-0'),
+            2: MockVM('test-vm1'),
+            3: MockVM('test-vm1-dm')}[xid]
+
+        send_event_all = unittest.mock.Mock(spec=[])
+        send_event_vm = unittest.mock.Mock(spec=[])
+        mgmt_obj_all = qubes.api.admin.QubesAdminAPI(
+            self.app, b'dom0', b'admin.vm.Stats',
+            b'dom0', b'', send_event=send_event_all)
+        mgmt_obj_vm = qubes.api.admin.QubesAdminAPI(
+            self.app, b'dom0', b'admin.vm.Stats',
+            b'test-vm1', b'', send_event=send_event_vm)
+
+        def cancel_call():
+            mgmt_obj_all.cancel()
+            mgmt_obj_vm.cancel()
+
+        loop = asyncio.get_event_loop()
+        execute_task = asyncio.gather(
+            mgmt_obj_all.execute(untrusted_payload=b''),
+            mgmt_obj_vm.execute(untrusted_payload=b''))
+        loop.call_later(1.1, cancel_call)
+        loop.run_until_complete(execute_task)
+        self.assertEqual(execute_task.result(), [None, None])
+        # sampled once per interval, regardless of number of subscribers
+        self.assertEqual(self.app.host.get_vm_stats.mock_calls, [
+            unittest.mock.call(None, None),
+            unittest.mock.call(0, stats1),
+        ])
+        # stubdomain is looked up only once, and skipped
+        self.assertEqual(
+            self.app.vmm.libvirt_conn.lookupByID.mock_calls.count(
+                unittest.mock.call(3)), 1)
+        self.assertEqual(
+            [c[1][0] for c in send_event_all.mock_calls[1:]],
+            ['dom0', 'test-vm1', 'dom0', 'test-vm1'])
+        self.assertEqual(send_event_vm.mock_calls, [
+            unittest.mock.call(self.app, 'connection-established'),
+            unittest.mock.call('test-vm1', 'vm-stats',
+                cpu_time=stats1[2]['cpu_time'] // 1000000,
+                cpu_usage=stats1[2]['cpu_usage'],
+                cpu_usage_raw=stats1[2]['cpu_usage_raw'],
+                memory_kb=stats1[2]['memory_kb']),
+            unittest.mock.call('test-vm1', 'vm-stats',
+                cpu_time=stats2[2]['cpu_time'] // 1000000,
+                cpu_usage=stats2[2]['cpu_usage'],
+                cpu_usage_raw=stats2[2]['cpu_usage_raw'],
+                memory_kb=stats2[2]['memory_kb']),
+        ])
+        self.assertIsNone(self.app.stats_sampler._task)
+
+    def test_633_vm_stats_stubdomain(self):
+        stats = {
+            0: {
+                'cpu_time': 243951379111104 // 8,
+                'cpu_usage': 0,
+                'cpu_usage_raw': 0,
+                'memory_kb': 3733212,
+            },
+            2: {
+                'cpu_time': 2849496569205,
+                'cpu_usage': 5,
+                'cpu_usage_raw': 10,
+                'memory_kb': 303916,
+            },
+            3: {
+                'cpu_time': 1000000000,
+                'cpu_usage': 4,
+                'cpu_usage_raw': 4,
+                'memory_kb': 40000,
+            },
+        }
+        self.app.host.get_vm_stats = unittest.mock.Mock(
+            return_value=(0, stats))
+        self.vm.vcpus = 2
+
+        def lookup_by_id(xid):
+            if xid == 2:
+                return unittest.mock.Mock(**{'name.return_value': 'test-vm1'})
+            raise libvirt.libvirtError('no domain')
+
+        self.app.vmm.libvirt_conn.lookupByID.side_effect = lookup_by_id
+        loop = asyncio.get_event_loop()
+        with unittest.mock.patch('libvirt.libvirtError.get_error_code',
+                return_value=libvirt.VIR_ERR_NO_DOMAIN), \
+                unittest.mock.patch('qubes.vm.qubesvm.QubesVM.is_running',
+                    lambda vm: vm is self.vm), \
+                unittest.mock.patch('qubes.vm.qubesvm.QubesVM.stubdom_xid',
+                    new_callable=unittest.mock.PropertyMock,
+                    return_value=3):
+            subscription = self.app.stats_sampler.subscribe()
+            try:
+                _, sample = loop.run_until_complete(subscription.get())
+            finally:
+                subscription.close()
+        self.assertEqual(sample, {
+            self.app.domains['dom0']: stats[0],
+            self.vm: {
+                'cpu_time': 2849496569205 + 1000000000,
+                'cpu_usage': 5 + 2,
+                'cpu_usage_raw': 10 + 4,
+                'memory_kb': 303916 + 40000,
+            },
+        })
+        # the original measurement is kept intact, for the next one
+        self.assertEqual(stats[2]['memory_kb'], 303916)
+
+    def test_634_vm_stats_forget_stopped(self):
+        sampler = self.app.stats_sampler
+        vm2 = self.app.add_new_vm('AppVM', label='red', name='test-vm2',
+            template='test-template')
+        # test-vm1 with its stubdomain, test-vm2 with a stubdomain not known
+        # to be one, and something else
+        sampler._vm_by_xid.update({2: self.vm, 3: None, 4: vm2, 5: None,
+            6: None})
+        sampler._stubdom_owner.update({3: self.vm})
+        sampler._on_domain_stopped(self.vm, 'domain-stopped')
+        self.assertEqual(sampler._vm_by_xid, {0: self.app.domains[0],
+            4: vm2, 5: None, 6: None})
+        self.assertEqual(sampler._stubdom_owner, {})
+
+    def test_635_vm_stats_history(self):
+        sampler = self.app.stats_sampler
+        sampler.history_size = 3
+        history = qubes.app.VMStatsHistory(3)
+        for i in range(4):
+            history.append(1000.0 + i, {
+                'cpu_time': i * 1000000000,
+                'cpu_usage': i,
+                'cpu_usage_raw': i * 2,
+                'memory_kb': 400000 + i,
+            })
+        sampler.history[self.vm] = history
+        value = self.call_mgmt_func(b'admin.vm.StatsHistory', b'test-vm1')
+        self.assertEqual(value,
+            '1001.000 1000 1 2 400001\n'
+            '1002.000 2000 2 4 400002\n'
+            '1003.000 3000 3 6 400003\n')
+        with unittest.mock.patch('time.time', return_value=1003.5):
+            value = self.call_mgmt_func(b'admin.vm.StatsHistory',
+                b'test-vm1', b'2')
+        self.assertEqual(value,
+            '1002.000 2000 2 4 400002\n'
+            '1003.000 3000 3 6 400003\n')
+        value = self.call_mgmt_func(b'admin.vm.StatsHistory',
+            b'test-template')
+        self.assertEqual(value, '')
+
+    def test_636_vm_stats_history_invalid(self):
+        with self.assertRaises(qubes.exc.QubesException):
+            self.call_mgmt_func(b'admin.vm.StatsHistory', b'test-vm1')
+        self.app.stats_sampler.history_size = 3
+        with self.assertRaises(qubes.api.PermissionDenied):
+            self.call_mgmt_func(b'admin.vm.StatsHistory', b'test-vm1',
+                b'-1')
+
+    def test_637_vm_stats_history_sample_failure(self):
+        stats = {
+            0: {
+                'cpu_time': 243951379111104 // 8,
+                'cpu_usage': 0,
+                'cpu_usage_raw': 0,
+                'memory_kb': 3733212,
+            },
+        }
+        calls = []
+
+        def get_vm_stats(prev_time, prev_info):
+            calls.append((prev_time, prev_info))
+            if len(calls) == 2:
+                raise qubes.exc.QubesException('sampling failed')
+            if len(calls) == 4:
+                self.app.stats_interval = 3600
+            return len(calls), stats
+        self.app.host.get_vm_stats = get_vm_stats
+        self.app.stats_interval = 0
+        self.app.log = unittest.mock.Mock()
+        sampler = self.app.stats_sampler
+        subscription = sampler.subscribe()
+        sampler.enable_history(3)
+        self.addCleanup(sampler.enable_history, 0)
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(subscription.get())
+        with self.assertRaises(qubes.exc.QubesException):
+            loop.run_until_complete(subscription.get())
+        subscription.close()
+        for _ in range(100):
+            if len(calls) >= 4:
+                break
+            loop.run_until_complete(asyncio.sleep(0))
+
+        self.assertIsNotNone(sampler._task)
+        # started over after the failure
+        self.assertEqual(calls[2], (None, None))
+        self.assertEqual([sample[0]
+                for sample in sampler.history[self.app.domains[0]].get()],
+            [1, 3, 4])
+        self.app.log.warning.assert_called_once_with(
+            'Failed to sample VM stats: %s', unittest.mock.ANY)
+
+    def test_638_vm_stats_unknown_domains(self):
+        sampler = self.app.stats_sampler
+        self.app.vmm.libvirt_conn.lookupByID.side_effect = \
+            libvirt.libvirtError('no domain')
+        is_running = unittest.mock.Mock(return_value=False)
+        with unittest.mock.patch('libvirt.libvirtError.get_error_code',
+                return_value=libvirt.VIR_ERR_NO_DOMAIN), \
+                unittest.mock.patch('qubes.vm.qubesvm.QubesVM.is_running',
+                    is_running):
+            self.assertIsNone(sampler._get_vm_by_xid(5))
+            calls = is_running.call_count
+            self.assertIsNone(sampler._get_vm_by_xid(6))
+        # stubdomains of already running qubes are looked for only once
+        self.assertEqual(is_running.call_count, calls)
+        self.assertEqual(sampler._vm_by_xid,
+            {0: self.app.domains[0], 5: None, 6: None})
+        # the domain is gone
+        sampler._forget_missing_xids({0: {}, 6: {}})
+        self.assertEqual(sampler._vm_by_xid,
+            {0: self.app.domains[0], 6: None})
+
     @unittest.mock.patch('qubes.storage.Storage.create')
     def test_640_vm_create_disposable(self, mock_storage):
         mock_storage.side_effect = self.dummy_coro
@@ -2809,6 +3584,116 @@ netvm default=True type=vm \n'''
         self.assertEqual(
             value, 'mem=512 mem_static_max=1024 cputime=100 power_state=Running')
 
+    def test_810_response_cache(self):
+        cache = qubes.api.admin.ResponseCache(self.app)
+        self.app.api_response_cache = cache
+        value = self.call_mgmt_func(b'admin.vm.property.Get', b'test-vm1',
+            b'label')
+        self.assertEqual(value, 'default=False type=label red')
+        value = self.call_mgmt_func(b'admin.vm.property.Get', b'test-vm1',
+            b'label')
+        self.assertEqual(value, 'default=False type=label red')
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        # permission is checked on each call
+        self.assertEqual(sum(count
+            for (event, _), count in self.emitter.fired_events.items()
+            if event == 'admin-permission:admin.vm.property.Get'), 2)
+
+        self.vm.label = 'green'
+        value = self.call_mgmt_func(b'admin.vm.property.Get', b'test-vm1',
+            b'label')
+        self.assertEqual(value, 'default=False type=label green')
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+    def test_811_response_cache_template(self):
+        self.app.api_response_cache = qubes.api.admin.ResponseCache(self.app)
+        self.template.features['test-feature'] = '1'
+        value = self.call_mgmt_func(b'admin.vm.feature.CheckWithTemplate',
+            b'test-vm1', b'test-feature')
+        self.assertEqual(value, '1')
+        # change on the template affects qubes based on it
+        self.template.features['test-feature'] = '2'
+        value = self.call_mgmt_func(b'admin.vm.feature.CheckWithTemplate',
+            b'test-vm1', b'test-feature')
+        self.assertEqual(value, '2')
+        self.assertEqual(self.app.api_response_cache.hits, 0)
+
+    def test_812_response_cache_permission_denied(self):
+        self.app.api_response_cache = qubes.api.admin.ResponseCache(self.app)
+        self.call_mgmt_func(b'admin.vm.tag.List', b'test-vm1')
+
+        def deny(*args, **kwargs):
+            raise qubes.api.PermissionDenied
+        self.emitter.events_enabled = True
+        self.emitter.add_handler('admin-permission:admin.vm.tag.List', deny)
+        with self.assertRaises(qubes.api.PermissionDenied):
+            self.call_mgmt_func(b'admin.vm.tag.List', b'test-vm1')
+
+    def test_813_response_cache_filtered(self):
+        cache = qubes.api.admin.ResponseCache(self.app)
+        self.app.api_response_cache = cache
+        self.vm.tags.add('tag1')
+        self.vm.tags.add('tag2')
+        self.emitter.events_enabled = True
+        self.emitter.add_handler('admin-permission:admin.vm.tag.List',
+            lambda *args, **kwargs: (lambda tag: tag == 'tag1',))
+        for _ in range(2):
+            value = self.call_mgmt_func(b'admin.vm.tag.List', b'test-vm1')
+            self.assertEqual(value, 'tag1\n')
+        self.assertEqual((cache.hits, cache.misses), (0, 2))
+
+    def test_814_response_cache_label_create(self):
+        self.app.api_response_cache = qubes.api.admin.ResponseCache(self.app)
+        value = self.call_mgmt_func(b'admin.label.List', b'dom0')
+        self.assertNotIn('cyan\n', value)
+        self.call_mgmt_func(b'admin.label.Create', b'dom0', b'cyan',
+            b'0x00ffff')
+        value = self.call_mgmt_func(b'admin.label.List', b'dom0')
+        self.assertIn('cyan\n', value)
+
+    def test_815_response_cache_stats(self):
+        cache = qubes.api.admin.ResponseCache(self.app)
+        self.app.api_response_cache = cache
+        self.app.api_metrics = qubes.api.metrics.CallMetrics()
+        self.app.api_metrics.response_cache = cache
+        self.call_mgmt_func(b'admin.vm.property.Get', b'test-vm1', b'label')
+        self.call_mgmt_func(b'admin.vm.property.Get', b'test-vm1', b'label')
+        value = self.call_mgmt_func(b'admin.api.Stats', b'dom0')
+        self.assertIn(
+            'qubesd_api_response_cache_lookups_total{result="hit"} 1\n'
+            'qubesd_api_response_cache_lookups_total{result="miss"} 1\n',
+            value)
+        self.assertIn('qubesd_api_response_cache_size 1\n', value)
+
+    def test_820_api_stats(self):
+        with self.assertRaises(qubes.exc.QubesException):
+            self.call_mgmt_func(b'admin.api.Stats', b'dom0')
+        self.app.api_metrics = qubes.api.metrics.CallMetrics()
+        self.app.api_metrics.record(qubes.api.admin.QubesAdminAPI,
+            b'test-vm1', b'admin.vm.List', b'dom0', b'', queue_wait=0.001,
+            execute_time=0.01, bytes_in=0, bytes_out=100, error=False)
+        value = self.call_mgmt_func(b'admin.api.Stats', b'dom0')
+        self.assertIn('qubesd_api_calls_total{method="admin.vm.List",'
+            'source="test-vm1"} 1\n', value)
+
+    def test_821_vm_start_timings(self):
+        with self.assertRaises(qubes.exc.QubesException):
+            self.call_mgmt_func(b'admin.vm.StartTimings', b'test-vm1')
+        self.app.startup_metrics = qubes.api.metrics.StartupMetrics(self.app)
+        self.vm.fire_event('domain-start-timings', success=True, total=2.5,
+            timings=(('storage-start', 1.0), ('qrexec-start', 1.25)))
+        value = self.call_mgmt_func(b'admin.vm.StartTimings', b'test-vm1')
+        self.assertEqual(value,
+            'qrexec-start count=1 p50=1.250 p90=1.250 p99=1.250 max=1.250\n'
+            'storage-start count=1 p50=1.000 p90=1.000 p99=1.000 max=1.000\n'
+            'total count=1 p50=2.500 p90=2.500 p99=2.500 max=2.500\n')
+        value = self.call_mgmt_func(b'admin.vm.StartTimings', b'dom0')
+        self.assertIn('total count=1 ', value)
+        self.assertEqual(
+            self.call_mgmt_func(b'admin.vm.StartTimings', b'test-template'), '')
+        with self.assertRaises(qubes.api.PermissionDenied):
+            self.call_mgmt_func(b'admin.vm.StartTimings', b'test-vm1', b'arg')
+
     def test_990_vm_unexpected_payload(self):
         methods_with_no_payload = [
             b'admin.vm.List',
@@ -2886,6 +3771,7 @@ netvm default=True type=vm \n'''
             b'admin.vm.Console',
             b'admin.Events',
             b'admin.vm.feature.List',
+            b'admin.vm.SetMany',
         ]
         # make sure also no methods on actual VM gets called
         vm_mock = unittest.mock.MagicMock()
@@ -3019,6 +3905,9 @@ netvm default=True type=vm \n'''
             #b'admin.pool.volume.Resize',
             b'admin.backup.Execute',
             b'admin.backup.Info',
+            b'admin.api.Stats',
+            b'admin.vm.StartMany',
+            b'admin.vm.ShutdownMany',
         ]
         # make sure also no methods on actual VM gets called
         vm_mock = unittest.mock.MagicMock()
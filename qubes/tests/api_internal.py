@@ -186,3 +186,134 @@ class TC_00_API_Misc(qubes.tests.QubesTestCase):
                 }
             }
         })
+
+
+class TestDomain(qubes.tests.TestEmitter):
+    def __init__(self, name):
+        super().__init__()
+        self.name = name
+        self.tags = []
+        self.label = mock.Mock(icon='icon-' + name)
+        self.template_for_dispvms = False
+        self.default_dispvm = None
+        self.guivm = None
+        self.get_power_state = mock.Mock(return_value='Halted')
+        self.events_enabled = True
+
+
+class TC_10_SystemInfoCache(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.app = qubes.tests.TestEmitter()
+        self.app.domains = [TestDomain('dom0'), TestDomain('vm')]
+        self.app.events_enabled = True
+        self.dom0, self.vm = self.app.domains
+        self.cache = qubes.api.internal.SystemInfoCache(self.app)
+        self.app.system_info_cache = self.cache
+
+    def assertPowerStateCalls(self, dom0_calls, vm_calls):
+        self.assertEqual(self.dom0.get_power_state.call_count, dom0_calls)
+        self.assertEqual(self.vm.get_power_state.call_count, vm_calls)
+
+    def test_000_cached(self):
+        info = qubes.api.internal.get_system_info(self.app)
+        self.assertEqual(info['domains']['vm'], {
+            'tags': [],
+            'type': 'TestDomain',
+            'template_for_dispvms': False,
+            'default_dispvm': None,
+            'icon': 'icon-vm',
+            'guivm': None,
+            'power_state': 'Halted',
+        })
+        self.assertIs(qubes.api.internal.get_system_info(self.app), info)
+        self.assertPowerStateCalls(1, 1)
+
+    def test_001_tag(self):
+        self.cache.get()
+        self.vm.tags.append('tag1')
+        self.vm.fire_event('domain-tag-add:tag1', tag='tag1')
+        info = self.cache.get()
+        self.assertEqual(info['domains']['vm']['tags'], ['tag1'])
+        self.assertPowerStateCalls(1, 2)
+
+    def test_002_power_state_transition(self):
+        self.cache.get()
+        self.vm.fire_event('domain-pre-start')
+        self.vm.get_power_state.return_value = 'Transient'
+        self.assertEqual(
+            self.cache.get()['domains']['vm']['power_state'], 'Transient')
+        self.cache.get()
+        self.assertPowerStateCalls(1, 3)
+        self.vm.get_power_state.return_value = 'Running'
+        self.vm.fire_event('domain-start')
+        self.assertEqual(
+            self.cache.get()['domains']['vm']['power_state'], 'Running')
+        self.cache.get()
+        self.assertPowerStateCalls(1, 4)
+
+    def test_003_unstable_power_state(self):
+        self.vm.get_power_state.return_value = 'Suspended'
+        self.cache.get()
+        self.cache.get()
+        self.assertPowerStateCalls(1, 2)
+        self.cache.invalidate()
+        self.vm.get_power_state.return_value = 'Running'
+        self.cache.get()
+        self.cache.get()
+        self.assertPowerStateCalls(2, 3)
+
+    def test_004_property(self):
+        self.cache.get()
+        self.vm.label.icon = 'icon-red'
+        self.vm.fire_event('property-set:label', name='label',
+            newvalue='red', oldvalue='green')
+        self.assertEqual(self.cache.get()['domains']['vm']['icon'],
+            'icon-red')
+        self.assertPowerStateCalls(1, 2)
+
+        self.dom0.name = 'dom0-renamed'
+        self.dom0.fire_event('property-set:name', name='name',
+            newvalue='dom0-renamed', oldvalue='dom0')
+        self.assertCountEqual(self.cache.get()['domains'],
+            ['dom0-renamed', 'vm'])
+        self.assertPowerStateCalls(2, 3)
+
+        self.app.fire_event('property-set:default_dispvm',
+            name='default_dispvm', newvalue=self.vm, oldvalue=None)
+        self.cache.get()
+        self.assertPowerStateCalls(3, 4)
+
+    def test_005_domain_add_delete(self):
+        self.cache.get()
+        new_vm = TestDomain('new-vm')
+        self.app.domains.append(new_vm)
+        self.app.fire_event('domain-add', vm=new_vm)
+        self.assertCountEqual(self.cache.get()['domains'],
+            ['dom0', 'vm', 'new-vm'])
+        new_vm.fire_event('domain-tag-add:tag1', tag='tag1')
+        self.cache.get()
+        self.assertEqual(new_vm.get_power_state.call_count, 2)
+
+        self.app.domains.remove(self.vm)
+        self.app.fire_event('domain-delete', vm=self.vm)
+        self.assertCountEqual(self.cache.get()['domains'],
+            ['dom0', 'new-vm'])
+        self.assertFalse(self.vm.__handlers__['domain-tag-add:*'])
+
+    def test_006_events_disabled(self):
+        self.app.events_enabled = False
+        self.cache.get()
+        self.cache.get()
+        self.assertPowerStateCalls(2, 2)
+
+    def test_007_generation(self):
+        generation = self.cache.generation
+        self.vm.fire_event('domain-pre-start')
+        self.vm.fire_event('domain-spawn')
+        self.vm.fire_event('domain-start')
+        self.vm.fire_event('property-set:qrexec_timeout',
+            name='qrexec_timeout', newvalue=10, oldvalue=60)
+        self.assertEqual(self.cache.generation, generation)
+        self.vm.fire_event('domain-tag-delete:tag1', tag='tag1')
+        self.assertNotEqual(self.cache.generation, generation)
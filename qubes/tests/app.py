@@ -20,6 +20,7 @@
 # License along with this library; if not, see <https://www.gnu.org/licenses/>.
 #
 
+import asyncio
 import os
 import unittest.mock as mock
 
@@ -144,7 +145,7 @@ class TC_20_QubesHost(qubes.tests.QubesTestCase):
             'xc.domain_getinfo.return_value': [self.sample_xc_domain_getinfo[1]]
         })
 
-        vm = mock.Mock
+        vm = mock.Mock()
         vm.xid = 1
         vm.name = 'somevm'
 
@@ -206,6 +207,39 @@ class TC_20_QubesHost(qubes.tests.QubesTestCase):
         self.assertEqual(self.qubes_host.is_iommu_supported(), False)
 
 
+class TC_21_VMStatsHistory(qubes.tests.QubesTestCase):
+    @staticmethod
+    def sample(i):
+        return {
+            'cpu_time': i * 1000000000,
+            'cpu_usage': i,
+            'cpu_usage_raw': 2 * i,
+            'memory_kb': 1000 + i,
+        }
+
+    def test_000_append(self):
+        history = qubes.app.VMStatsHistory(4)
+        self.assertEqual(len(history), 0)
+        self.assertEqual(history.get(), [])
+        history.append(10.0, self.sample(1))
+        history.append(13.0, self.sample(2))
+        self.assertEqual(len(history), 2)
+        self.assertEqual(history.get(), [
+            (10.0, 1000000000, 1, 2, 1001),
+            (13.0, 2000000000, 2, 4, 1002),
+        ])
+
+    def test_001_wrap(self):
+        history = qubes.app.VMStatsHistory(3)
+        for i in range(5):
+            history.append(float(i), self.sample(i))
+        self.assertEqual(len(history), 3)
+        self.assertEqual([sample[0] for sample in history.get()],
+            [2.0, 3.0, 4.0])
+        self.assertEqual([sample[0] for sample in history.get(since=2.5)],
+            [3.0, 4.0])
+
+
 class TC_30_VMCollection(qubes.tests.QubesTestCase):
     def setUp(self):
         super().setUp()
@@ -229,7 +263,7 @@ class TC_30_VMCollection(qubes.tests.QubesTestCase):
         del self.app
 
     def test_000_contains(self):
-        self.vms._dict = {1: self.testvm1}
+        self.vms.add(self.testvm1)
 
         self.assertIn(1, self.vms)
         self.assertIn('testvm1', self.vms)
@@ -240,7 +274,7 @@ class TC_30_VMCollection(qubes.tests.QubesTestCase):
         self.assertNotIn(self.testvm2, self.vms)
 
     def test_001_getitem(self):
-        self.vms._dict = {1: self.testvm1}
+        self.vms.add(self.testvm1)
 
         self.assertIs(self.vms[1], self.testvm1)
         self.assertIs(self.vms['testvm1'], self.testvm1)
@@ -309,6 +343,34 @@ class TC_30_VMCollection(qubes.tests.QubesTestCase):
         self.assertEventFired(self.app, 'domain-delete',
                               kwargs={'vm': self.testvm2})
 
+    def test_009_rename(self):
+        self.vms.add(self.testvm1)
+        self.vms.add(self.testvm2)
+
+        self.testvm1.name = 'testvm3'
+
+        self.assertIs(self.vms['testvm3'], self.testvm1)
+        self.assertIn('testvm3', self.vms)
+        self.assertNotIn('testvm1', self.vms)
+        with self.assertRaises(KeyError):
+            self.vms['testvm1']
+        self.assertEqual(list(self.vms.names()), ['testvm2', 'testvm3'])
+        self.assertEqual(list(self.vms), [self.testvm2, self.testvm1])
+
+        del self.vms['testvm3']
+        self.assertNotIn('testvm3', self.vms)
+        self.assertNotIn(self.testvm1, self.vms)
+
+    def test_010_iterate_while_modifying(self):
+        self.vms.add(self.testvm1)
+        self.vms.add(self.testvm2)
+
+        for vm in self.vms:
+            del self.vms[vm.name]
+
+        self.assertEqual(len(self.vms), 0)
+        self.assertEqual(list(self.vms), [])
+
     def test_100_get_new_unused_qid(self):
         self.vms.add(self.testvm1)
         self.vms.add(self.testvm2)
@@ -801,9 +863,249 @@ class TC_90_Qubes(qubes.tests.QubesTestCase):
         with self.assertRaises(qubes.exc.QubesVMInUseError):
             del self.app.domains[vm]
 
+    def test_300_dependencies(self):
+        netvm = self.app.add_new_vm('AppVM', name='test-netvm',
+                                    template=self.template,
+                                    provides_network=True,
+                                    label='red')
+        netvm2 = self.app.add_new_vm('AppVM', name='test-netvm2',
+                                     template=self.template,
+                                     provides_network=True,
+                                     label='red')
+        appvm = self.app.add_new_vm('AppVM', name='test-vm',
+                                    template=self.template,
+                                    label='red')
+        netvm.netvm = None
+        self.app.default_netvm = netvm
+        self.assertEqual(list(netvm.connected_vms), [netvm2, appvm])
+        self.assertEqual(self.app.domains.get_vms_connected_to(netvm),
+                         {netvm2, appvm})
+        self.assertEqual(self.app.domains.get_vms_based_on(self.template),
+                         {netvm, netvm2, appvm})
+
+        appvm.netvm = netvm2
+        self.assertEqual(list(netvm.connected_vms), [netvm2])
+        self.assertEqual(list(netvm2.connected_vms), [appvm])
+        self.assertEqual(self.app.domains.get_vms_connected_to(netvm),
+                         {netvm2, appvm})
+
+        del appvm.netvm
+        self.assertEqual(list(netvm2.connected_vms), [])
+        self.app.default_netvm = None
+        self.assertEqual(list(netvm.connected_vms), [])
+
+    def test_301_dependencies_template_default(self):
+        appvm = self.app.add_new_vm('AppVM', name='test-vm',
+                                    template=self.template,
+                                    label='red')
+        self.template.management_dispvm = appvm
+        # default value inherited from the template
+        self.assertEqual(
+            self.app.domains.get_vms_referring_to(appvm, 'management_dispvm'),
+            {self.template, appvm})
+        del self.template.management_dispvm
+        self.assertEqual(
+            self.app.domains.get_vms_referring_to(appvm, 'management_dispvm'),
+            set())
+
+    def test_302_dependencies_removed_vm(self):
+        appvm = self.app.add_new_vm('AppVM', name='test-vm',
+                                    template=self.template,
+                                    label='red')
+        with mock.patch.object(self.app, 'vmm'):
+            del self.app.domains[appvm]
+        self.assertEqual(self.app.domains.get_vms_based_on(self.template),
+                         set())
+
     @qubes.tests.skipUnlessGit
     def test_900_example_xml_in_doc(self):
         self.assertXMLIsValid(
             lxml.etree.parse(open(
                 os.path.join(qubes.tests.in_git, 'doc/example.xml'), 'rb')),
             'qubes.rng')
+
+
+class TC_91_QubesJournal(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.app = qubes.Qubes('/tmp/qubestest.xml', load=False,
+                               offline_mode=True)
+        self.addCleanup(self.cleanup_qubes)
+        self.app.load_initial_values()
+        self.app.default_kernel = None
+        self.template = self.app.add_new_vm('TemplateVM', name='test-template',
+                                            label='green')
+        self.app.save(lock=False)
+        self.app.use_journal = True
+        self.store_mtime = os.path.getmtime('/tmp/qubestest.xml')
+
+    def cleanup_qubes(self):
+        self.app.close()
+        del self.app
+        del self.template
+        for path in ('/tmp/qubestest.xml', '/tmp/qubestest.xml.journal'):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    def reload(self):
+        app = qubes.Qubes('/tmp/qubestest.xml', offline_mode=True)
+        self.addCleanup(app.close)
+        return app
+
+    def test_000_save_journal(self):
+        self.app.add_new_vm('AppVM', name='test-vm', template=self.template,
+                            label='red')
+        self.app.save(lock=False)
+        self.template.features['test-feature'] = 'test-value'
+        self.template.tags.add('test-tag')
+        self.app.default_template = self.template
+        self.app.save(lock=False)
+        self.assertEqual(os.path.getmtime('/tmp/qubestest.xml'),
+                         self.store_mtime)
+        self.assertEqual(self.app.journal.records, 2)
+
+        app = self.reload()
+        self.assertIn('test-vm', app.domains)
+        self.assertEqual(app.domains['test-vm'].template.name,
+                         'test-template')
+        template = app.domains['test-template']
+        self.assertEqual(template.features['test-feature'], 'test-value')
+        self.assertIn('test-tag', template.tags)
+        self.assertEqual(app.default_template, template)
+        self.assertEqual(app.journal.records, 2)
+
+    def test_001_remove_domain(self):
+        vm = self.app.add_new_vm('AppVM', name='test-vm',
+                                 template=self.template, label='red')
+        self.app.save(lock=False)
+        del self.app.domains[vm]
+        self.app.save(lock=False)
+
+        app = self.reload()
+        self.assertNotIn('test-vm', app.domains)
+        self.assertIn('test-template', app.domains)
+
+    def test_002_save_nothing_changed(self):
+        self.app.save(lock=False)
+        self.assertFalse(os.path.exists('/tmp/qubestest.xml.journal'))
+
+    def test_003_compaction(self):
+        with mock.patch('qubes.config.journal_max_records', 2):
+            for label in ('red', 'orange', 'yellow'):
+                self.template.label = label
+                self.app.save(lock=False)
+        self.assertFalse(os.path.exists('/tmp/qubestest.xml.journal'))
+        self.assertNotEqual(os.path.getmtime('/tmp/qubestest.xml'),
+                            self.store_mtime)
+
+        app = self.reload()
+        self.assertEqual(app.domains['test-template'].label.name, 'yellow')
+
+    def test_004_stale_journal(self):
+        self.template.label = 'red'
+        self.app.save(lock=False)
+        with open('/tmp/qubestest.xml.journal', 'rb') as journal:
+            journal_data = journal.read()
+        self.app.use_journal = False
+        self.template.label = 'blue'
+        self.app.save(lock=False)
+        # leftover from a crash after writing new qubes.xml
+        with open('/tmp/qubestest.xml.journal', 'wb') as journal:
+            journal.write(journal_data)
+
+        app = self.reload()
+        self.assertEqual(app.domains['test-template'].label.name, 'blue')
+        self.assertEqual(app.journal.records, 0)
+
+    def test_005_incomplete_record(self):
+        self.template.label = 'red'
+        self.app.save(lock=False)
+        with open('/tmp/qubestest.xml.journal', 'ab') as journal:
+            journal.write(b'<commit><domain id="domain-1"')
+
+        app = self.reload()
+        self.assertEqual(app.domains['test-template'].label.name, 'red')
+        self.assertTrue(app.journal.needs_compaction)
+        app.domains['test-template'].label = 'blue'
+        app.use_journal = True
+        app.save(lock=False)
+        self.assertFalse(os.path.exists('/tmp/qubestest.xml.journal'))
+
+    def test_006_modified_by_someone_else(self):
+        self.template.label = 'red'
+        self.app.save(lock=False)
+        app = self.reload()
+        app.use_journal = True
+        app.domains['test-template'].label = 'blue'
+        app.save(lock=False)
+        self.template.label = 'yellow'
+        with self.assertRaises(qubes.exc.QubesException):
+            self.app.save(lock=False)
+
+    def test_007_load_snapshot(self):
+        self.app.add_new_vm('AppVM', name='test-vm', template=self.template,
+                            label='red')
+        self.template.features['test-feature'] = 'test-value'
+        # not saved at all
+        snapshot = lxml.etree.tostring(self.app.__xml__())
+        app = qubes.Qubes('/tmp/qubestest.xml', load=False, offline_mode=True)
+        self.addCleanup(app.close)
+        app.load(xml=lxml.etree.ElementTree(lxml.etree.fromstring(snapshot)))
+        self.assertIn('test-vm', app.domains)
+        self.assertEqual(app.domains['test-vm'].template.name,
+                         'test-template')
+        self.assertEqual(
+            app.domains['test-template'].features['test-feature'],
+            'test-value')
+        self.assertNotIn('test-vm', self.reload().domains)
+
+
+class TC_92_QubesDelayedSave(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.app = qubes.Qubes('/tmp/qubestest.xml', load=False,
+                               offline_mode=True)
+        self.addCleanup(self.cleanup_qubes)
+        self.app.load_initial_values()
+        self.app.default_kernel = None
+        self.app.save_delay = 0.05
+
+    def cleanup_qubes(self):
+        self.app.close()
+        del self.app
+        try:
+            os.unlink('/tmp/qubestest.xml')
+        except FileNotFoundError:
+            pass
+
+    def test_000_save_together(self):
+        with mock.patch.object(self.app, '_save',
+                wraps=self.app._save) as mock_save:
+            self.app.save()
+            self.app.add_new_vm('TemplateVM', name='test-template',
+                                label='green')
+            self.app.save()
+            self.assertFalse(os.path.exists('/tmp/qubestest.xml'))
+            self.loop.run_until_complete(self.app.wait_saved())
+            mock_save.assert_called_once_with(lock=True)
+
+        app = qubes.Qubes('/tmp/qubestest.xml', offline_mode=True)
+        self.addCleanup(app.close)
+        self.assertIn('test-template', app.domains)
+
+    def test_001_flush_now(self):
+        self.app.save()
+        self.app.flush_save()
+        self.assertTrue(os.path.exists('/tmp/qubestest.xml'))
+        # nothing pending anymore
+        self.loop.run_until_complete(
+            asyncio.wait_for(self.app.wait_saved(), 0.01))
+
+    def test_002_save_error(self):
+        with mock.patch.object(self.app, '_save',
+                side_effect=OSError('No space left on device')):
+            self.app.save()
+            with self.assertRaises(OSError):
+                self.loop.run_until_complete(self.app.wait_saved())
@@ -191,3 +191,75 @@ class TC_00_Emitter(qubes.tests.QubesTestCase):
         self.assertEqual(testevent_fired[0], 4)
         emitter.fire_event('testevent')
         self.assertEqual(testevent_fired[0], 4)
+
+    def test_007_dispatch_cache(self):
+        class TestEmitter(qubes.events.Emitter):
+            @qubes.events.handler('testevent')
+            def on_testevent_1(self, event):
+                yield 'testevent_1'
+
+        def on_testevent_2(subject, event):
+            yield 'testevent_2'
+
+        def on_testevent_3(subject, event):
+            yield 'testevent_3'
+
+        emitter = TestEmitter()
+        emitter.events_enabled = True
+        self.assertEqual(emitter.fire_event('testevent'), ['testevent_1'])
+
+        with self.subTest('instance_handler'):
+            emitter.add_handler('test*', on_testevent_2)
+            self.assertEqual(emitter.fire_event('testevent'),
+                ['testevent_1', 'testevent_2'])
+            emitter.remove_handler('test*', on_testevent_2)
+            self.assertEqual(emitter.fire_event('testevent'),
+                ['testevent_1'])
+
+        with self.subTest('class_handler'):
+            # this is how extensions register their handlers
+            TestEmitter.__handlers__['testevent'].add(on_testevent_3)
+            qubes.events.invalidate_dispatch_cache()
+            self.assertEqual(emitter.fire_event('testevent'),
+                ['testevent_1', 'testevent_3'])
+
+    def test_008_dispatch_cache_order(self):
+        def on_testevent_1(subject, event):
+            yield 'testevent_1'
+
+        def on_testevent_2(subject, event):
+            yield 'testevent_2'
+
+        emitter = qubes.events.Emitter()
+        emitter.events_enabled = True
+        # wildcard registered before exact event name is called first
+        emitter.add_handler('test*', on_testevent_1)
+        emitter.add_handler('testevent', on_testevent_2)
+        self.assertEqual(emitter.fire_event('testevent'),
+            ['testevent_1', 'testevent_2'])
+
+        emitter = qubes.events.Emitter()
+        emitter.events_enabled = True
+        emitter.add_handler('testevent', on_testevent_2)
+        emitter.add_handler('test*', on_testevent_1)
+        self.assertEqual(emitter.fire_event('testevent'),
+            ['testevent_2', 'testevent_1'])
+
+    def test_009_subclass_order(self):
+        class TestEmitter(qubes.events.Emitter):
+            @qubes.events.handler('test*')
+            def on_testevent_1(self, event):
+                yield 'testevent_1'
+
+        class TestEmitter2(TestEmitter):
+            @qubes.events.handler('testevent')
+            def on_testevent_2(self, event):
+                yield 'testevent_2'
+
+        emitter = TestEmitter2()
+        emitter.events_enabled = True
+        self.assertEqual(emitter.fire_event('testevent'),
+            ['testevent_1', 'testevent_2'])
+        self.assertEqual(emitter.fire_event('testevent', pre_event=True),
+            ['testevent_2', 'testevent_1'])
+        self.assertEqual(emitter.fire_event('test-other'), ['testevent_1'])
@@ -375,7 +375,7 @@ class TC_30_VMCollection(qubes.tests.QubesTestCase):
         del self.app
 
     def test_000_contains(self):
-        self.vms._dict = {1: self.testvm1}
+        self.vms.add(self.testvm1)
 
         self.assertIn(1, self.vms)
         self.assertIn('testvm1', self.vms)
@@ -386,7 +386,7 @@ class TC_30_VMCollection(qubes.tests.QubesTestCase):
         self.assertNotIn(self.testvm2, self.vms)
 
     def test_001_getitem(self):
-        self.vms._dict = {1: self.testvm1}
+        self.vms.add(self.testvm1)
 
         self.assertIs(self.vms[1], self.testvm1)
         self.assertIs(self.vms['testvm1'], self.testvm1)
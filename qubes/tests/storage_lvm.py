@@ -1198,3 +1198,44 @@ class TC_02_StorageHelpers(ThinPoolBase):
         pool = qubes.storage.search_pool_containing_dir(
             self.app.pools.values(), self.thin_dir.name)
         self.assertEqual(pool, self.pool)
+
+
+class TC_03_SizeCache(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super().setUp()
+        for name, value in (('size_cache', {'old': {}}),
+                ('size_cache_time', 0), ('_refresh_cache_task', None)):
+            patch = unittest.mock.patch.object(qubes.storage.lvm, name, value)
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_000_background_refresh_outdated(self):
+        background_lvs = self.loop.create_future()
+        results = [background_lvs]
+
+        @asyncio.coroutine
+        def init_cache_coro():
+            result = results.pop(0)
+            if asyncio.isfuture(result):
+                result = yield from result
+            return result
+
+        @asyncio.coroutine
+        def volume_operation():
+            # like resize(), done while the background refresh runs
+            yield from qubes.storage.lvm.reset_cache_coro()
+            background_lvs.set_result({'background': {}})
+
+        @asyncio.coroutine
+        def poll():
+            qubes.storage.lvm.refresh_cache()
+            # let the background refresh call lvs first
+            yield from asyncio.sleep(0)
+            yield from volume_operation()
+            yield from qubes.storage.lvm._refresh_cache_task
+
+        results.append({'operation': {}})
+        with unittest.mock.patch('qubes.storage.lvm.init_cache_coro',
+                init_cache_coro):
+            self.loop.run_until_complete(poll())
+        self.assertEqual(qubes.storage.lvm.size_cache, {'operation': {}})
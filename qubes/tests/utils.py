@@ -0,0 +1,116 @@
+# -*- encoding: utf8 -*-
+#
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import threading
+
+import qubes.tests
+import qubes.utils
+
+
+class TC_00_BlockingExecutor(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.executor = qubes.utils.BlockingExecutor(4)
+        self.calls = []
+
+    def tearDown(self):
+        self.executor.shutdown()
+        super().tearDown()
+
+    def record(self, name, wait_for=None):
+        if wait_for is not None:
+            self.assertTrue(wait_for.wait(5))
+        self.calls.append(name)
+        return name
+
+    def test_000_result(self):
+        result = self.loop.run_until_complete(
+            self.executor.run('vm1', self.record, 'call'))
+        self.assertEqual(result, 'call')
+        self.assertEqual(self.executor._tails, {})
+
+    def test_001_exception(self):
+        def fail():
+            raise ValueError('failed')
+        with self.assertRaises(ValueError):
+            self.loop.run_until_complete(self.executor.run('vm1', fail))
+        self.assertEqual(self.executor._tails, {})
+
+    def test_010_same_key_ordered(self):
+        unblock = threading.Event()
+        first = asyncio.ensure_future(
+            self.executor.run('vm1', self.record, 'first', unblock),
+            loop=self.loop)
+        second = asyncio.ensure_future(
+            self.executor.run('vm1', self.record, 'second'),
+            loop=self.loop)
+        self.loop.run_until_complete(asyncio.sleep(0.05))
+        self.assertEqual(self.calls, [])
+        unblock.set()
+        self.loop.run_until_complete(asyncio.wait([first, second]))
+        self.assertEqual(self.calls, ['first', 'second'])
+
+    def test_011_other_key_parallel(self):
+        unblock = threading.Event()
+        first = asyncio.ensure_future(
+            self.executor.run('vm1', self.record, 'first', unblock),
+            loop=self.loop)
+        self.loop.run_until_complete(
+            self.executor.run('vm2', self.record, 'second'))
+        self.loop.run_until_complete(
+            self.executor.run(None, self.record, 'third'))
+        self.assertEqual(self.calls, ['second', 'third'])
+        unblock.set()
+        self.loop.run_until_complete(first)
+        self.assertEqual(self.calls, ['second', 'third', 'first'])
+
+    def test_012_cancel_keeps_order(self):
+        unblock = threading.Event()
+        first = asyncio.ensure_future(
+            self.executor.run('vm1', self.record, 'first', unblock),
+            loop=self.loop)
+        self.loop.run_until_complete(asyncio.sleep(0.01))
+        first.cancel()
+        self.loop.run_until_complete(asyncio.sleep(0.01))
+        second = asyncio.ensure_future(
+            self.executor.run('vm1', self.record, 'second'),
+            loop=self.loop)
+        self.loop.run_until_complete(asyncio.sleep(0.05))
+        self.assertEqual(self.calls, [])
+        unblock.set()
+        self.loop.run_until_complete(second)
+        self.assertEqual(self.calls, ['first', 'second'])
+        self.assertEqual(self.executor._tails, {})
+
+    def test_020_call_in_loop_thread(self):
+        loop_thread = threading.get_ident()
+        called = []
+
+        def callback():
+            called.append(threading.get_ident())
+
+        def func():
+            self.assertNotEqual(threading.get_ident(), loop_thread)
+            qubes.utils.call_in_loop_thread(callback)
+
+        self.loop.run_until_complete(self.executor.run(None, func))
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.assertEqual(called, [loop_thread])
+
+        qubes.utils.call_in_loop_thread(callback)
+        self.assertEqual(called, [loop_thread, loop_thread])
@@ -52,6 +52,16 @@ class TestVMsCollection(dict):
     def get_vms_connected_to(self, vm):
         return set()
 
+    def get_vms_referring_to(self, vm, name):
+        return set(domain for domain in self
+                   if getattr(domain, name, None) is vm)
+
+    def get_vms_with_devices_of(self, backend):
+        return set(domain for domain in self
+                   if any(device.backend_domain is backend
+                          for collection in domain.devices.values()
+                          for device in collection.persistent()))
+
     def close(self):
         self.clear()
 
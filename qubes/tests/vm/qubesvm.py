@@ -23,6 +23,8 @@ import base64
 import os
 import subprocess
 import tempfile
+import threading
+import time
 
 import unittest
 import uuid
@@ -31,6 +33,9 @@ import datetime
 import asyncio
 
 import functools
+import itertools
+import json
+import libvirt
 import lxml.etree
 import unittest.mock
 
@@ -42,6 +47,7 @@ import qubes.config
 import qubes.devices
 import qubes.vm
 import qubes.vm.qubesvm
+import qubes.vm.startup
 
 import qubes.tests
 import qubes.tests.vm
@@ -2220,3 +2226,401 @@ class TC_90_QubesVM(QubesVMTestsMixin, qubes.tests.QubesTestCase):
             fully_usable = vm.is_fully_usable()
             mock_os_path_exists.assert_not_called()
             self.assertEqual(fully_usable, True)
+
+    def test_730_libvirt_state_cache(self):
+        vm = self.get_vm(cls=qubes.vm.appvm.AppVM, name='workvm')
+        libvirt_domain = unittest.mock.Mock()
+        libvirt_domain.isActive.return_value = True
+        libvirt_domain.state.return_value = [libvirt.VIR_DOMAIN_PAUSED, 0]
+        libvirt_domain.ID.return_value = 10
+        vm._libvirt_domain = libvirt_domain
+        self.app.vmm.offline_mode = False
+        self.app.libvirt_events_registered = True
+
+        self.assertEqual(vm.get_power_state(), 'Paused')
+        self.assertTrue(vm.is_paused())
+        self.assertTrue(vm.is_running())
+        self.assertEqual(vm.xid, 10)
+        self.assertEqual(vm.xid, 10)
+        self.assertEqual(libvirt_domain.isActive.call_count, 1)
+        self.assertEqual(libvirt_domain.state.call_count, 1)
+        self.assertEqual(libvirt_domain.ID.call_count, 1)
+
+        # libvirt event, or an operation changing the state
+        libvirt_domain.isActive.return_value = False
+        vm.invalidate_libvirt_state()
+        self.assertEqual(vm.get_power_state(), 'Halted')
+        self.assertFalse(vm.is_running())
+        self.assertEqual(vm.xid, -1)
+        self.assertEqual(libvirt_domain.isActive.call_count, 2)
+
+    def test_731_libvirt_state_no_events(self):
+        vm = self.get_vm(cls=qubes.vm.appvm.AppVM, name='workvm')
+        libvirt_domain = unittest.mock.Mock()
+        libvirt_domain.isActive.return_value = True
+        libvirt_domain.state.return_value = [libvirt.VIR_DOMAIN_PAUSED, 0]
+        vm._libvirt_domain = libvirt_domain
+        self.app.vmm.offline_mode = False
+        self.app.libvirt_events_registered = False
+
+        self.assertEqual(vm.get_power_state(), 'Paused')
+        libvirt_domain.isActive.return_value = False
+        # nothing would invalidate the cache, so don't cache
+        self.assertEqual(vm.get_power_state(), 'Halted')
+        self.assertEqual(libvirt_domain.isActive.call_count, 2)
+
+    def test_732_libvirt_state_dying(self):
+        vm = self.get_vm(cls=qubes.vm.appvm.AppVM, name='workvm')
+        libvirt_domain = unittest.mock.Mock()
+        # shut off, but not yet destroyed - no more lifecycle events will
+        # come when it's gone
+        libvirt_domain.isActive.side_effect = itertools.chain(
+            [True, True], itertools.repeat(False))
+        libvirt_domain.state.return_value = [libvirt.VIR_DOMAIN_SHUTOFF, 0]
+        vm._libvirt_domain = libvirt_domain
+        vm._domain_stopped_event_received = False
+        vm._domain_stopped_event_handled = False
+        self.app.vmm.offline_mode = False
+        self.app.libvirt_events_registered = True
+        events = []
+
+        @asyncio.coroutine
+        def fire_event_async(event, **kwargs):
+            events.append(event)
+        vm.fire_event_async = fire_event_async
+
+        vm.invalidate_libvirt_state()
+        vm.on_libvirt_domain_stopped()
+        self.loop.run_until_complete(
+            asyncio.wait_for(vm._domain_stopped_future, 2))
+        self.assertEqual(events, ['domain-stopped', 'domain-shutdown'])
+        self.assertEqual(vm.get_power_state(), 'Halted')
+
+    def test_733_fetch_libvirt_state(self):
+        vm = self.get_vm(cls=qubes.vm.appvm.AppVM, name='workvm')
+        libvirt_domain = unittest.mock.Mock()
+        threads = []
+
+        def is_active():
+            threads.append(threading.get_ident())
+            return True
+        libvirt_domain.isActive.side_effect = is_active
+        libvirt_domain.state.return_value = [libvirt.VIR_DOMAIN_RUNNING, 0]
+        vm._libvirt_domain = libvirt_domain
+        vm.is_fully_usable = lambda: True
+        self.app.vmm.offline_mode = False
+        self.app.libvirt_events_registered = True
+
+        self.loop.run_until_complete(vm.fetch_libvirt_state())
+        self.assertNotIn(threading.get_ident(), threads)
+        self.assertEqual(vm.get_power_state(), 'Running')
+        self.assertEqual(libvirt_domain.isActive.call_count, 1)
+
+        # state changed while querying it
+        def is_active_changed():
+            vm.invalidate_libvirt_state()
+            return True
+        libvirt_domain.isActive.side_effect = is_active_changed
+        vm.invalidate_libvirt_state()
+        self.loop.run_until_complete(vm.fetch_libvirt_state())
+        self.assertIsNone(vm._libvirt_state)
+
+    def test_734_is_running_uncached(self):
+        vm = self.get_vm(cls=qubes.vm.appvm.AppVM, name='workvm')
+        libvirt_domain = unittest.mock.Mock()
+        libvirt_domain.isActive.return_value = True
+        vm._libvirt_domain = libvirt_domain
+        self.app.vmm.offline_mode = False
+        self.app.libvirt_events_registered = False
+
+        # a single libvirt call, as without the cache
+        self.assertTrue(vm.is_running())
+        self.assertEqual(libvirt_domain.isActive.call_count, 1)
+        self.assertFalse(libvirt_domain.state.called)
+
+    def setup_shutdown_vm(self):
+        vm = self.get_vm(cls=qubes.vm.appvm.AppVM, name='workvm')
+        libvirt_domain = unittest.mock.Mock()
+        libvirt_domain.isActive.return_value = True
+        libvirt_domain.state.return_value = [libvirt.VIR_DOMAIN_RUNNING, 0]
+        vm._libvirt_domain = libvirt_domain
+        vm.shutdown_timeout = 5
+        # as if started
+        vm._domain_stopped_event_received = False
+        vm._domain_stopped_event_handled = False
+        self.app.vmm.offline_mode = False
+        self.app.libvirt_events_registered = True
+        events = []
+
+        @asyncio.coroutine
+        def fire_event_async(event, **kwargs):
+            events.append(event)
+        vm.fire_event_async = fire_event_async
+        return vm, events
+
+    def test_740_shutdown_wait_event(self):
+        vm, events = self.setup_shutdown_vm()
+        libvirt_domain = vm._libvirt_domain
+        shutdown = asyncio.ensure_future(vm.shutdown(wait=True),
+            loop=self.loop)
+        self.loop.run_until_complete(asyncio.sleep(0.6))
+        self.assertFalse(shutdown.done())
+        libvirt_domain.shutdown.assert_called_once_with()
+        # state checked only once, before requesting the shutdown - no polling
+        self.assertEqual(libvirt_domain.isActive.call_count, 1)
+
+        # libvirt event
+        libvirt_domain.isActive.return_value = False
+        vm.invalidate_libvirt_state()
+        vm.on_libvirt_domain_stopped()
+        self.loop.run_until_complete(asyncio.wait_for(shutdown, 1))
+        self.assertEqual(shutdown.result(), vm)
+        self.assertEqual(events,
+            ['domain-pre-shutdown', 'domain-stopped', 'domain-shutdown'])
+        self.assertIsNone(vm._shutdown_waiter)
+
+    def test_741_shutdown_wait_timeout(self):
+        vm, events = self.setup_shutdown_vm()
+        vm.shutdown_timeout = 1
+        with self.assertRaises(qubes.exc.QubesVMShutdownTimeoutError):
+            self.loop.run_until_complete(vm.shutdown(wait=True))
+        self.assertEqual(events,
+            ['domain-pre-shutdown', 'domain-shutdown-failed'])
+        self.assertEqual(vm._libvirt_domain.isActive.call_count, 2)
+
+    def test_742_shutdown_wait_shared(self):
+        vm, events = self.setup_shutdown_vm()
+        libvirt_domain = vm._libvirt_domain
+        shutdown1 = asyncio.ensure_future(vm.shutdown(wait=True),
+            loop=self.loop)
+        shutdown2 = asyncio.ensure_future(vm.shutdown(wait=True, timeout=3),
+            loop=self.loop)
+        self.loop.run_until_complete(asyncio.sleep(0.1))
+        self.assertEqual(libvirt_domain.shutdown.call_count, 2)
+
+        libvirt_domain.isActive.return_value = False
+        vm.invalidate_libvirt_state()
+        vm.on_libvirt_domain_stopped()
+        self.loop.run_until_complete(
+            asyncio.wait_for(asyncio.gather(shutdown1, shutdown2), 1))
+        self.assertEqual(events.count('domain-shutdown'), 1)
+
+    def test_743_shutdown_wait_stopped_before_request(self):
+        vm, events = self.setup_shutdown_vm()
+        libvirt_domain = vm._libvirt_domain
+
+        @asyncio.coroutine
+        def fire_event_async(event, **kwargs):
+            events.append(event)
+            if event == 'domain-pre-shutdown':
+                # stopped and handled before the waiter is taken
+                libvirt_domain.isActive.return_value = False
+                vm.invalidate_libvirt_state()
+                vm.on_libvirt_domain_stopped()
+                yield from vm._domain_stopped_future
+        vm.fire_event_async = fire_event_async
+
+        self.loop.run_until_complete(
+            asyncio.wait_for(vm.shutdown(wait=True), 1))
+        self.assertFalse(libvirt_domain.shutdown.called)
+        self.assertEqual(events,
+            ['domain-pre-shutdown', 'domain-stopped', 'domain-shutdown'])
+        self.assertIsNone(vm._shutdown_waiter)
+
+    def setup_start_vm(self):
+        vm = self.get_vm(cls=qubes.vm.appvm.AppVM, name='workvm')
+        vm.netvm = None
+        vm.virt_mode = 'hvm'
+        vm.kernel = None
+
+        @asyncio.coroutine
+        def coroutine_mock(*args, **kwargs):
+            pass
+        vm.storage = unittest.mock.Mock(verify=coroutine_mock,
+            start=coroutine_mock, stop=coroutine_mock)
+        vm.request_memory = unittest.mock.Mock(return_value=None)
+        vm._update_libvirt_domain_async = coroutine_mock
+        vm._libvirt_domain = unittest.mock.Mock()
+        vm.start_qubesdb = coroutine_mock
+        vm.create_qdb_entries = unittest.mock.Mock()
+        vm.start_qdb_watch = unittest.mock.Mock()
+        vm.start_qrexec_daemon = coroutine_mock
+        vm.fire_event_async = coroutine_mock
+        vm.log = unittest.mock.Mock()
+
+        timings = []
+        vm.add_handler('domain-start-timings',
+            lambda vm, event, **kwargs: timings.append(kwargs))
+        return vm, timings
+
+    def test_750_start_timings(self):
+        vm, timings = self.setup_start_vm()
+        self.loop.run_until_complete(vm.start())
+        self.assertEqual(len(timings), 1)
+        self.assertTrue(timings[0]['success'])
+        phases = [phase for phase, _ in timings[0]['timings']]
+        # the middle ones are executed concurrently
+        self.assertEqual(phases[:2], ['pre-start', 'check-devices'])
+        self.assertCountEqual(phases[2:6], ['storage-verify',
+            'storage-start', 'request-memory', 'define-domain'])
+        self.assertEqual(phases[6:], ['create-domain', 'spawn',
+            'qubesdb-start', 'qubesdb-entries', 'resume', 'qrexec-start',
+            'domain-start'])
+        self.assertLess(phases.index('storage-verify'),
+            phases.index('storage-start'))
+        self.assertLess(phases.index('storage-start'),
+            phases.index('define-domain'))
+        vm.log.info.assert_any_call('Start %s in %.3fs: %s', 'finished',
+            timings[0]['total'], unittest.mock.ANY)
+
+    def test_751_start_timings_failed(self):
+        vm, timings = self.setup_start_vm()
+        vm._libvirt_domain.createWithFlags.side_effect = \
+            libvirt.libvirtError('failed')
+        with self.assertRaises(libvirt.libvirtError):
+            self.loop.run_until_complete(vm.start())
+        self.assertEqual(len(timings), 1)
+        self.assertFalse(timings[0]['success'])
+        # the failed phase is included
+        self.assertEqual(timings[0]['timings'][-1][0], 'create-domain')
+
+    def test_752_start_trace(self):
+        vm, _ = self.setup_start_vm()
+        with tempfile.TemporaryDirectory() as trace_dir:
+            with unittest.mock.patch.dict(os.environ,
+                    {qubes.vm.startup.TRACE_DIR_ENV: trace_dir}):
+                self.loop.run_until_complete(vm.start())
+            files = os.listdir(trace_dir)
+            self.assertEqual(len(files), 1)
+            with open(os.path.join(trace_dir, files[0])) as trace_file:
+                trace = json.load(trace_file)
+        events = trace['traceEvents']
+        self.assertEqual(events[0]['name'], 'start ' + vm.name)
+        self.assertEqual(events[1]['name'], 'pre-start')
+        for event in events:
+            self.assertEqual(event['ph'], 'X')
+            self.assertTrue(event['tid'].startswith(vm.name))
+            self.assertGreaterEqual(event['ts'], events[0]['ts'])
+        # phases on the same track don't overlap
+        tracks = {}
+        for event in sorted(events[1:], key=lambda event: event['ts']):
+            self.assertGreaterEqual(event['ts'], tracks.get(event['tid'], 0))
+            tracks[event['tid']] = event['ts'] + event['dur']
+
+    def setup_start_phases(self, vm, delays, failing=()):
+        '''Make startup phases of *vm* take given time, record their order
+        and fail ones in *failing*'''
+        calls = []
+
+        def phase(name, result=None):
+            @asyncio.coroutine
+            def func(*args, **kwargs):
+                calls.append(name)
+                yield from asyncio.sleep(delays.get(name, 0))
+                if name in failing:
+                    raise qubes.exc.QubesException(name + ' failed')
+                calls.append(name + ' done')
+                return result
+            return func
+
+        vm.storage.verify = phase('storage-verify')
+        vm.storage.start = phase('storage-start')
+        vm.storage.stop = phase('storage-stop')
+        vm._update_libvirt_domain_async = phase('define-domain')
+        qmemman_client = unittest.mock.Mock()
+
+        def request_memory(mem_required):
+            calls.append('request-memory')
+            time.sleep(delays.get('request-memory', 0))
+            if 'request-memory' in failing:
+                raise qubes.exc.QubesException('request-memory failed')
+            calls.append('request-memory done')
+            return qmemman_client
+        vm.request_memory = request_memory
+
+        netvm = self.get_vm(qid=2, name='netvm', provides_network=True)
+        netvm.is_running = lambda: False
+        netvm.start = phase('netvm-start')
+        vm.netvm = netvm
+        return calls, qmemman_client
+
+    def test_753_start_concurrent_phases(self):
+        vm, timings = self.setup_start_vm()
+        delays = {
+            'storage-verify': 0.05,
+            'storage-start': 0.2,
+            'netvm-start': 0.2,
+            'request-memory': 0.3,
+            'define-domain': 0.1,
+        }
+        calls, qmemman_client = self.setup_start_phases(vm, delays)
+        self.loop.run_until_complete(vm.start())
+        qmemman_client.close.assert_called_once_with()
+        # netvm needs to get its memory first
+        self.assertLess(calls.index('netvm-start done'),
+            calls.index('request-memory'))
+        self.assertLess(calls.index('storage-start done'),
+            calls.index('define-domain'))
+        self.assertLess(calls.index('netvm-start done'),
+            calls.index('define-domain'))
+        # netvm only for a qube with valid storage, then storage in parallel
+        # to the netvm
+        self.assertLess(calls.index('storage-verify done'),
+            calls.index('netvm-start'))
+        self.assertLess(calls.index('netvm-start'),
+            calls.index('storage-start done'))
+
+        durations = dict(timings[0]['timings'])
+        sequential = sum(durations[phase] for phase in delays)
+        self.assertGreaterEqual(sequential, sum(delays.values()))
+        # about 0.55s: storage verify + netvm start + request memory,
+        # starting storage and defining the domain overlap with it
+        self.assertLess(timings[0]['total'], sequential - 0.2)
+
+    def test_754_start_rollback(self):
+        vm, timings = self.setup_start_vm()
+        calls, qmemman_client = self.setup_start_phases(vm,
+            {'request-memory': 0.1}, failing=('storage-start',))
+        with self.assertRaisesRegex(qubes.exc.QubesException,
+                'storage-start failed'):
+            self.loop.run_until_complete(vm.start())
+        # running phases were finished, the domain not defined
+        self.assertIn('request-memory done', calls)
+        self.assertNotIn('define-domain', calls)
+        self.assertNotIn('storage-stop', calls)
+        qmemman_client.close.assert_called_once_with()
+        vm._libvirt_domain.createWithFlags.assert_not_called()
+        self.assertFalse(timings[0]['success'])
+
+    def test_754_start_storage_verify_failed(self):
+        vm, _ = self.setup_start_vm()
+        calls, qmemman_client = self.setup_start_phases(vm, {},
+            failing=('storage-verify',))
+        with self.assertRaisesRegex(qubes.exc.QubesException,
+                'storage-verify failed'):
+            self.loop.run_until_complete(vm.start())
+        self.assertNotIn('netvm-start', calls)
+        self.assertNotIn('storage-start', calls)
+        # memory would be requested after starting the netvm
+        self.assertNotIn('request-memory', calls)
+        qmemman_client.close.assert_not_called()
+
+    def test_755_start_rollback_storage(self):
+        vm, _ = self.setup_start_vm()
+        calls, qmemman_client = self.setup_start_phases(vm,
+            {'request-memory': 0.1}, failing=('define-domain',))
+        with self.assertRaisesRegex(qubes.exc.QubesException,
+                'define-domain failed'):
+            self.loop.run_until_complete(vm.start())
+        self.assertIn('storage-stop done', calls)
+        qmemman_client.close.assert_called_once_with()
+
+    def test_756_start_rollback_create(self):
+        vm, _ = self.setup_start_vm()
+        calls, qmemman_client = self.setup_start_phases(vm, {})
+        vm._libvirt_domain.createWithFlags.side_effect = \
+            libvirt.libvirtError('failed')
+        with self.assertRaises(libvirt.libvirtError):
+            self.loop.run_until_complete(vm.start())
+        self.assertEqual(calls.count('storage-stop done'), 1)
+        qmemman_client.close.assert_called_once_with()
@@ -10,7 +10,9 @@ import qubes
 import qubes.api
 import qubes.api.admin
 import qubes.api.internal
+import qubes.api.metrics
 import qubes.api.misc
+import qubes.api.workers
 import qubes.log
 import qubes.utils
 import qubes.vm.qubesvm
@@ -35,16 +37,54 @@ def main(args=None):
         loop.close()
         raise
 
-    args.app.register_event_handlers()
-
     if args.debug:
         qubes.log.enable_debug()
 
+    # fork the workers' fork server while qubesd has a single thread
+    read_workers = None
+    if qubes.config.api_read_workers:
+        read_workers = qubes.api.workers.ReadWorkerPool(args.app,
+            qubes.api.admin.QubesAdminAPI, qubes.config.api_read_workers,
+            debug=args.debug)
+        read_workers.start()
+
+    args.app.register_event_handlers()
+    # save only changes on each Admin API call, instead of the whole qubes.xml
+    args.app.use_journal = True
+    # and share a single write between concurrent calls
+    args.app.save_delay = qubes.config.save_delay
+    # avoid querying libvirt about all domains on each policy evaluation
+    args.app.system_info_cache = qubes.api.internal.SystemInfoCache(args.app)
+    # and repeating the same work for read-only Admin API calls
+    args.app.api_response_cache = qubes.api.admin.ResponseCache(args.app)
+    # collect statistics of API calls
+    args.app.api_metrics = qubes.api.metrics.CallMetrics(
+        slow_call_threshold=qubes.config.api_slow_call_threshold)
+    # and find what blocks the event loop
+    loop_watchdog = None
+    if qubes.config.loop_watchdog_interval:
+        loop_watchdog = qubes.api.metrics.LoopWatchdog(
+            qubes.config.loop_watchdog_interval,
+            qubes.config.loop_stall_threshold, loop=loop)
+        loop_watchdog.start()
+        args.app.api_metrics.loop_watchdog = loop_watchdog
+    # and what qube startup is spending time on
+    args.app.startup_metrics = qubes.api.metrics.StartupMetrics(args.app,
+        qubes.config.startup_metrics_samples)
+    args.app.api_metrics.startup_metrics = args.app.startup_metrics
+    args.app.api_metrics.response_cache = args.app.api_response_cache
+    # keep recent VM stats for admin.vm.StatsHistory
+    args.app.stats_sampler.enable_history(qubes.config.stats_history_size)
+
     servers = loop.run_until_complete(qubes.api.create_servers(
         qubes.api.admin.QubesAdminAPI,
         qubes.api.internal.QubesInternalAPI,
         qubes.api.misc.QubesMiscAPI,
-        app=args.app, debug=args.debug))
+        app=args.app, debug=args.debug, read_workers=read_workers))
+    if qubes.config.api_metrics_socket:
+        servers.append(loop.run_until_complete(
+            qubes.api.metrics.create_server(args.app.api_metrics,
+                qubes.config.api_metrics_socket)))
 
     socknames = []
     for server in servers:
@@ -63,6 +103,12 @@ def main(args=None):
         loop.run_forever()
         loop.run_until_complete(asyncio.wait([
             server.wait_closed() for server in servers]))
+        if read_workers is not None:
+            read_workers.close()
+        if loop_watchdog is not None:
+            loop_watchdog.stop()
+        qubes.utils.get_blocking_executor().shutdown()
+        args.app.flush_save()
         for sockname in socknames:
             try:
                 os.unlink(sockname)
@@ -2,11 +2,17 @@
 
 import argparse
 import asyncio
+import shlex
 import signal
+import struct
 import sys
 
 QUBESD_SOCK = '/var/run/qubesd.sock'
 
+# see qubes.api.QubesDaemonProtocol
+FRAMED_MAGIC = b'\0framed\0'
+FRAME_HEADER = struct.Struct('!II')
+
 parser = argparse.ArgumentParser(
     description='low-level qubesd interrogation tool')
 
@@ -25,11 +31,22 @@ parser.add_argument('--fail',
     action='store_true',
     help='Should non-OK qubesd response result in non-zero exit code')
 
+parser.add_argument('--batch', '-b',
+    dest='batch',
+    action='store_true',
+    help='read requests from stdin, one per line in the form of '
+         '"SRC METHOD DEST [ARGUMENT]" (each with empty payload), send them '
+         'over a single connection and print responses in the same order, '
+         'each followed by a newline')
+
 parser.add_argument('src', metavar='SRC',
+    nargs='?',
     help='source qube')
 parser.add_argument('method', metavar='METHOD',
+    nargs='?',
     help='method name')
 parser.add_argument('dest', metavar='DEST',
+    nargs='?',
     help='destination qube')
 parser.add_argument('arg', metavar='ARGUMENT',
     nargs='?', default='',
@@ -75,17 +92,106 @@ def qubesd_client(socket, payload, *args):
     finally:
         writer.close()
 
+def parse_batch(lines):
+    '''Parse requests for :py:func:`qubesd_batch_client`
+
+    :param lines: iterable of "SRC METHOD DEST [ARGUMENT]" lines
+    :return: list of requests, as sent to qubesd
+    '''
+    requests = []
+    for lineno, line in enumerate(lines, 1):
+        words = shlex.split(line)
+        if not words:
+            continue
+        if len(words) not in (3, 4):
+            raise ValueError(
+                'line {}: expected SRC METHOD DEST [ARGUMENT]'.format(lineno))
+        src, method, dest = words[:3]
+        arg = words[3] if len(words) == 4 else ''
+        requests.append(
+            f'{method}+{arg} {src} name {dest}'.encode('ascii') + b'\0')
+    return requests
+
+@asyncio.coroutine
+def qubesd_batch_client(socket, requests):
+    '''
+    Connect to qubesd, send all requests pipelined over a single connection
+    and write responses to stdout, in order of requests
+
+    :param socket: path to qubesd socket
+    :param requests: list of requests (including payload)
+    :return: 0 if all the requests succeeded, 1 otherwise
+    '''
+    try:
+        reader, writer = yield from asyncio.open_unix_connection(socket)
+    except asyncio.CancelledError:
+        return 1
+
+    writer.write(FRAMED_MAGIC)
+    for request_id, request in enumerate(requests):
+        writer.write(FRAME_HEADER.pack(request_id, len(request)) + request)
+    writer.write_eof()
+
+    # responses (including events) received so far, by request id
+    responses = [[] for _ in requests]
+    finished = [False] * len(requests)
+    returncode = 0
+    next_to_print = 0
+    try:
+        while next_to_print < len(requests):
+            try:
+                header = yield from reader.readexactly(FRAME_HEADER.size)
+                request_id, length = FRAME_HEADER.unpack(header)
+                message = yield from reader.readexactly(length)
+            except asyncio.IncompleteReadError:
+                return 1
+            if request_id >= len(requests) or finished[request_id]:
+                return 1
+            responses[request_id].append(message)
+            # response or exception ends the reply; empty message means
+            # the request failed
+            if not message.startswith(b'1'):
+                finished[request_id] = True
+                if not message.startswith(b'0'):
+                    returncode = 1
+            while next_to_print < len(requests) \
+                    and finished[next_to_print]:
+                # pylint: disable=no-member
+                sys.stdout.buffer.write(
+                    b''.join(responses[next_to_print]) + b'\n')
+                sys.stdout.flush()
+                responses[next_to_print] = None
+                next_to_print += 1
+        return returncode
+    except asyncio.CancelledError:
+        return 1
+    finally:
+        writer.close()
+
 def main(args=None):
     args = parser.parse_args(args)
     loop = asyncio.get_event_loop()
 
-    # pylint: disable=no-member
-    payload = sys.stdin.buffer.read() if args.payload else b''
-    # pylint: enable=no-member
-
-    coro = asyncio.ensure_future(qubesd_client(
-        args.socket, payload,
-        f'{args.method}+{args.arg} {args.src} name {args.dest}'))
+    if args.batch:
+        try:
+            # pylint: disable=no-member
+            requests = parse_batch(
+                sys.stdin.buffer.read().decode('ascii').splitlines())
+        except ValueError as err:
+            parser.error(str(err))
+        coro = asyncio.ensure_future(qubesd_batch_client(
+            args.socket, requests))
+    else:
+        if args.dest is None:
+            parser.error('SRC, METHOD and DEST are required')
+
+        # pylint: disable=no-member
+        payload = sys.stdin.buffer.read() if args.payload else b''
+        # pylint: enable=no-member
+
+        coro = asyncio.ensure_future(qubesd_client(
+            args.socket, payload,
+            f'{args.method}+{args.arg} {args.src} name {args.dest}'))
 
     for signame in ('SIGINT', 'SIGTERM'):
         loop.add_signal_handler(getattr(signal, signame),
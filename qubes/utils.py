@@ -21,6 +21,8 @@
 #
 
 import asyncio
+import concurrent.futures
+import functools
 import hashlib
 import random
 import string
@@ -28,12 +30,14 @@ import os
 import re
 import socket
 import subprocess
+import threading
 
 import pkg_resources
 
 import docutils
 import docutils.core
 import docutils.io
+import qubes.config
 import qubes.exc
 
 
@@ -204,3 +208,121 @@ def void_coros_maybe(values):
         done, _ = yield from asyncio.wait(coros)
         for task in done:
             task.result()  # re-raises exception if task failed
+
+
+_thread_state = threading.local()
+
+
+def _run_in_thread(loop, func, args, kwargs):
+    _thread_state.loop = loop
+    try:
+        return func(*args, **kwargs)
+    finally:
+        _thread_state.loop = None
+
+
+def call_in_loop_thread(func, *args):
+    '''Call *func* in the event loop thread.
+
+    From a thread of :py:class:`BlockingExecutor`, the call is scheduled in
+    its event loop; otherwise *func* is called immediately.
+    '''
+    loop = getattr(_thread_state, 'loop', None)
+    if loop is None:
+        func(*args)
+    else:
+        loop.call_soon_threadsafe(func, *args)
+
+
+class BlockingExecutor:
+    '''Bounded pool of threads for blocking hypervisor and storage calls.
+
+    A slow libvirt or storage operation run here does not stop the event
+    loop, so other API calls are served in the meantime. Calls submitted
+    with the same *key* (usually a domain) are executed one at a time, in
+    the order of submission; calls with different keys (or with
+    :py:obj:`None` key) run in parallel, up to *max_workers* at once.
+
+    Functions run here must not touch objects used by the event loop
+    thread, other than through thread-safe libraries like libvirt; see
+    :py:func:`call_in_loop_thread`.
+
+    :param int max_workers: number of threads
+    '''
+
+    def __init__(self, max_workers):
+        self.max_workers = max_workers
+        self._executor = None
+        #: key -> future done when the last call submitted with it is done
+        self._tails = {}
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.max_workers)
+        return self._executor
+
+    @asyncio.coroutine
+    def run(self, key, func, *args, **kwargs):
+        '''Run *func* in a thread.
+
+        If the calling coroutine is cancelled, the function still runs to
+        the end, and calls submitted later with the same key wait for it.
+
+        :param key: ordering key, or :py:obj:`None`
+        :return: value returned by *func*
+        '''
+        loop = asyncio.get_event_loop()
+        previous = None
+        done = None
+        if key is not None:
+            previous = self._tails.get(key)
+            done = loop.create_future()
+            self._tails[key] = done
+
+        def release(_future=None):
+            if done is None:
+                return
+            if not done.done():
+                done.set_result(None)
+            if self._tails.get(key) is done:
+                del self._tails[key]
+
+        if previous is not None:
+            try:
+                yield from asyncio.shield(previous)
+            except asyncio.CancelledError:
+                previous.add_done_callback(release)
+                raise
+
+        future = loop.run_in_executor(self._get_executor(),
+            functools.partial(_run_in_thread, loop, func, args, kwargs))
+        future.add_done_callback(release)
+        return (yield from asyncio.shield(future))
+
+    def shutdown(self):
+        '''Stop the threads, after pending calls are done'''
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+
+_blocking_executor = None
+
+
+def get_blocking_executor():
+    '''Get the :py:class:`BlockingExecutor` shared by the whole process,
+    with :py:data:`qubes.config.blocking_executor_workers` threads'''
+    global _blocking_executor  # pylint: disable=global-statement
+    if _blocking_executor is None:
+        _blocking_executor = BlockingExecutor(
+            qubes.config.blocking_executor_workers)
+    return _blocking_executor
+
+
+@asyncio.coroutine
+def run_blocking(key, func, *args, **kwargs):
+    '''Run blocking *func* outside of the event loop thread, see
+    :py:meth:`BlockingExecutor.run`'''
+    return (yield from get_blocking_executor().run(key, func,
+        *args, **kwargs))
@@ -293,7 +293,7 @@ class BaseVM(qubes.PropertyHolder):
         '''List of persistent device assignments from this VM.'''
 
         assignments = []
-        for domain in self.app.domains:
+        for domain in sorted(self.app.domains.get_vms_with_devices_of(self)):
             if domain == self:
                 continue
             for device_collection in domain.devices.values():
@@ -302,6 +302,17 @@ class BaseVM(qubes.PropertyHolder):
                         assignments.append(assignment)
         return assignments
 
+    @qubes.events.handler('property-set:*', 'property-reset:*',
+        'domain-feature-set:*', 'domain-feature-delete:*',
+        'domain-tag-add:*', 'domain-tag-delete:*',
+        'device-attach:*', 'device-detach:*')
+    def on_config_changed(self, event, *args, **kwargs):
+        '''Schedule this domain for writing on the next save.'''
+        # pylint: disable=unused-argument
+        mark_dirty = getattr(self.app, 'mark_dirty', None)
+        if mark_dirty is not None and hasattr(self, 'qid'):
+            mark_dirty(vm=self)
+
     def init_log(self):
         '''Initialise logger for this domain.'''
         self.log = qubes.log.get_vm_logger(self.name)
@@ -116,6 +116,23 @@ class AdminVM(qubes.vm.BaseVM):
             self._libvirt_domain = self.app.vmm.libvirt_conn.lookupByID(0)
         return self._libvirt_domain
 
+    @staticmethod
+    def invalidate_libvirt_state():
+        '''Does nothing, state of dom0 is not cached.
+
+        .. seealso:
+           :py:meth:`qubes.vm.qubesvm.QubesVM.invalidate_libvirt_state`
+        '''
+
+    @staticmethod
+    @asyncio.coroutine
+    def fetch_libvirt_state():
+        '''Does nothing, state of dom0 is not queried.
+
+        .. seealso:
+           :py:meth:`qubes.vm.qubesvm.QubesVM.fetch_libvirt_state`
+        '''
+
     @staticmethod
     def is_running():
         '''Always :py:obj:`True`.
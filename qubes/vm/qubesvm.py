@@ -22,6 +22,7 @@
 
 import asyncio
 import base64
+import functools
 import grp
 import re
 import os
@@ -42,6 +43,7 @@ import qubes.storage.file
 import qubes.utils
 import qubes.vm
 import qubes.vm.mix.net
+import qubes.vm.startup
 
 qmemman_present = False
 try:
@@ -282,6 +284,20 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
             :param subject: Event emitter (the qube object)
             :param event: Event name (``'domain-start-failed'``)
 
+        .. event:: domain-start-timings (subject, event, success, total, \
+                timings)
+
+            Fired at the end of each :py:meth:`start` attempt, successful or
+            not, with durations of its phases (see
+            :py:class:`qubes.vm.startup.StartupTimings`).
+
+            :param subject: Event emitter (the qube object)
+            :param event: Event name (``'domain-start-timings'``)
+            :param success: whether the qube was started
+            :param total: duration of the whole startup, in seconds
+            :param timings: tuple of (phase, duration in seconds) pairs, \
+                in the order phases finished
+
         .. event:: domain-paused (subject, event)
 
             Fired when the domain has been paused.
@@ -748,10 +764,14 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
         if self.libvirt_domain is None:
             return -1
         try:
-            if self.is_running():
-                return self.libvirt_domain.ID()
-
-            return -1
+            if not self.is_running():
+                return -1
+            if self._libvirt_xid is not None:
+                return self._libvirt_xid
+            xid = self.libvirt_domain.ID()
+            if self._can_cache_libvirt_state():
+                self._libvirt_xid = xid
+            return xid
         except libvirt.libvirtError as e:
             if e.get_error_code() == libvirt.VIR_ERR_NO_DOMAIN:
                 return -1
@@ -901,6 +921,14 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
         self._libvirt_domain = None
         self._qdb_connection = None
 
+        #: cached tuple(is active, libvirt state) of :py:attr:`libvirt_domain`
+        #: and its ID, see :py:meth:`invalidate_libvirt_state`
+        self._libvirt_state = None
+        self._libvirt_xid = None
+        #: number of :py:meth:`invalidate_libvirt_state` calls, to not cache
+        #: state queried before the last one
+        self._libvirt_state_invalidations = 0
+
         # We assume a fully halted VM here. The 'domain-init' handler will
         # check if the VM is already running.
         self._domain_stopped_event_received = True
@@ -908,6 +936,10 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
 
         self._domain_stopped_future = None
 
+        #: future done when the shutdown of this domain is fully handled,
+        #: see :py:meth:`_get_shutdown_waiter`
+        self._shutdown_waiter = None
+
         # Internal lock to ensure ordering between _domain_stopped_coro() and
         # start(). This should not be accessed anywhere else.
         self._domain_stopped_lock = asyncio.Lock()
@@ -940,6 +972,7 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
             self._qdb_connection = None
         if self._libvirt_domain is not None:
             self._libvirt_domain = None
+        self.invalidate_libvirt_state()
         super().close()
 
     def __hash__(self):
@@ -1041,20 +1074,24 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
                     'Failed to reset autostart for VM in systemd')
 
     @qubes.events.handler('domain-remove-from-disk')
+    @asyncio.coroutine
     def on_remove_from_disk(self, event, **kwargs):
         # pylint: disable=unused-argument
         if self.autostart:
-            subprocess.call(
-                ['sudo', 'systemctl', 'disable',
-                 'qubes-vm@{}.service'.format(self.name)])
+            proc = yield from asyncio.create_subprocess_exec(
+                'sudo', 'systemctl', 'disable',
+                'qubes-vm@{}.service'.format(self.name))
+            yield from proc.wait()
 
     @qubes.events.handler('domain-create-on-disk')
+    @asyncio.coroutine
     def on_create_on_disk(self, event, **kwargs):
         # pylint: disable=unused-argument
         if self.autostart:
-            subprocess.call(
-                ['sudo', 'systemctl', 'enable',
-                 'qubes-vm@{}.service'.format(self.name)])
+            proc = yield from asyncio.create_subprocess_exec(
+                'sudo', 'systemctl', 'enable',
+                'qubes-vm@{}.service'.format(self.name))
+            yield from proc.wait()
 
     #
     # methods for changing domain state
@@ -1086,14 +1123,39 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
                 # twice if an exception gets thrown.
                 self._domain_stopped_event_handled = True
 
-                yield from self.fire_event_async('domain-stopped')
-                yield from self.fire_event_async('domain-shutdown')
+                try:
+                    yield from self.fire_event_async('domain-stopped')
+                    yield from self.fire_event_async('domain-shutdown')
+                finally:
+                    self._wake_shutdown_waiter()
+
+    def _get_shutdown_waiter(self):
+        """Get a future done when the domain stops and its shutdown is
+        handled (after ``domain-shutdown`` event), shared by everyone waiting
+        for it.
+
+        It's driven by libvirt lifecycle events, so it must be taken before
+        requesting the shutdown. After it's done, check the domain state -
+        it may be running again.
+        """
+        if self._shutdown_waiter is None:
+            self._shutdown_waiter = asyncio.get_event_loop().create_future()
+        return self._shutdown_waiter
+
+    def _wake_shutdown_waiter(self):
+        if self._shutdown_waiter is not None:
+            if not self._shutdown_waiter.done():
+                self._shutdown_waiter.set_result(None)
+            self._shutdown_waiter = None
 
     @asyncio.coroutine
     def start(self, start_guid=True, notify_function=None,
               mem_required=None):
         """Start domain
 
+        Durations of startup phases are logged and reported with
+        ``domain-start-timings`` event.
+
         :param bool start_guid: FIXME
         :param collections.abc.Callable notify_function: FIXME
         :param int mem_required: FIXME
@@ -1103,6 +1165,7 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
             # check if domain wasn't removed in the meantime
             if self not in self.app.domains:
                 raise qubes.exc.QubesVMNotFoundError(self.name)
+            yield from self.fetch_libvirt_state()
             # Intentionally not used is_running(): eliminate also "Paused",
             # "Crashed", "Halting"
             if self.get_power_state() != 'Halted':
@@ -1112,19 +1175,41 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
 
             self.log.info('Starting {}'.format(self.name))
 
+            timings = qubes.vm.startup.StartupTimings(self.name)
+            success = False
             try:
+                yield from self._start_locked(timings, start_guid,
+                    notify_function, mem_required)
+                success = True
+            finally:
+                self._report_start_timings(timings, success)
+
+        return self
+
+    @asyncio.coroutine
+    def _start_locked(self, timings, start_guid, notify_function,
+            mem_required):
+        """Do the actual startup, with :py:attr:`startup_lock` held.
+
+        :param qubes.vm.startup.StartupTimings timings: where to record \
+            durations of the phases
+        """
+
+        try:
+            with timings.phase('pre-start'):
                 yield from self.fire_event_async('domain-pre-start',
                                                  pre_event=True,
                                                  start_guid=start_guid,
                                                  mem_required=mem_required)
-            except Exception as exc:
-                self.log.error('Start failed: %s', str(exc))
-                yield from self.fire_event_async('domain-start-failed',
-                                                 reason=str(exc))
-                raise
+        except Exception as exc:
+            self.log.error('Start failed: %s', str(exc))
+            yield from self.fire_event_async('domain-start-failed',
+                                             reason=str(exc))
+            raise
 
-            qmemman_client = None
-            try:
+        qmemman_client = None
+        try:
+            with timings.phase('check-devices'):
                 for devclass in self.devices:
                     for dev in self.devices[devclass].persistent():
                         if isinstance(dev, qubes.devices.UnknownDevice):
@@ -1132,105 +1217,157 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
                                 '{} device {} not available'.format(
                                     devclass, dev))
 
-                if self.virt_mode == 'pvh' and not self.kernel:
-                    raise qubes.exc.QubesException(
-                        'virt_mode PVH require kernel to be set')
-                yield from self.storage.verify()
-
-                if self.netvm is not None:
-                    # pylint: disable = no-member
-                    if self.netvm.qid != 0:
-                        if not self.netvm.is_running():
-                            yield from self.netvm.start(
-                                start_guid=start_guid,
-                                notify_function=notify_function)
-
-                qmemman_client = yield from asyncio.get_event_loop(). \
-                    run_in_executor(None, self.request_memory, mem_required)
-
-                yield from self.storage.start()
-
-            except Exception as exc:
-                self.log.error('Start failed: %s', str(exc))
-                # let anyone receiving domain-pre-start know that startup failed
-                yield from self.fire_event_async('domain-start-failed',
-                                                 reason=str(exc))
-                if qmemman_client:
-                    qmemman_client.close()
-                raise
+            if self.virt_mode == 'pvh' and not self.kernel:
+                raise qubes.exc.QubesException(
+                    'virt_mode PVH require kernel to be set')
 
-            try:
-                self._update_libvirt_domain()
+            pipeline = self._startup_pipeline(timings, start_guid,
+                notify_function, mem_required)
+            qmemman_client = (yield from pipeline.run())['request-memory']
 
-                self.libvirt_domain.createWithFlags(
-                    libvirt.VIR_DOMAIN_START_PAUSED)
+        except Exception as exc:
+            self.log.error('Start failed: %s', str(exc))
+            # let anyone receiving domain-pre-start know that startup failed
+            yield from self.fire_event_async('domain-start-failed',
+                                             reason=str(exc))
+            raise
 
-                # the above allocates xid, lets announce that
-                self.fire_event('property-reset:xid', name='xid')
-                self.fire_event('property-reset:stubdom_xid',
-                                name='stubdom_xid')
-                self.fire_event('property-reset:start_time', name='start_time')
-            except libvirt.libvirtError as exc:
-                # missing IOMMU?
-                if self.virt_mode == 'hvm' and \
-                        list(self.devices['pci'].persistent()) and \
-                        not self.app.host.is_iommu_supported():
-                    exc = qubes.exc.QubesException(
-                        'Failed to start an HVM qube with PCI devices assigned '
-                        '- hardware does not support IOMMU/VT-d/AMD-Vi')
-                self.log.error('Start failed: %s', str(exc))
-                yield from self.fire_event_async('domain-start-failed',
-                                                 reason=str(exc))
-                yield from self.storage.stop()
-                raise exc
-            except Exception as exc:
-                self.log.error('Start failed: %s', str(exc))
-                # let anyone receiving domain-pre-start know that startup failed
-                yield from self.fire_event_async('domain-start-failed',
-                                                 reason=str(exc))
-                yield from self.storage.stop()
-                raise
+        try:
+            with timings.phase('create-domain'):
+                yield from self._run_blocking(
+                    self.libvirt_domain.createWithFlags,
+                    libvirt.VIR_DOMAIN_START_PAUSED)
+            self.invalidate_libvirt_state()
+
+            # the above allocates xid, lets announce that
+            self.fire_event('property-reset:xid', name='xid')
+            self.fire_event('property-reset:stubdom_xid',
+                            name='stubdom_xid')
+            self.fire_event('property-reset:start_time', name='start_time')
+        except libvirt.libvirtError as exc:
+            # missing IOMMU?
+            if self.virt_mode == 'hvm' and \
+                    list(self.devices['pci'].persistent()) and \
+                    not self.app.host.is_iommu_supported():
+                exc = qubes.exc.QubesException(
+                    'Failed to start an HVM qube with PCI devices assigned '
+                    '- hardware does not support IOMMU/VT-d/AMD-Vi')
+            self.log.error('Start failed: %s', str(exc))
+            yield from self.fire_event_async('domain-start-failed',
+                                             reason=str(exc))
+            yield from self.storage.stop()
+            raise exc
+        except Exception as exc:
+            self.log.error('Start failed: %s', str(exc))
+            # let anyone receiving domain-pre-start know that startup failed
+            yield from self.fire_event_async('domain-start-failed',
+                                             reason=str(exc))
+            yield from self.storage.stop()
+            raise
 
-            finally:
-                if qmemman_client:
-                    qmemman_client.close()
+        finally:
+            if qmemman_client:
+                qmemman_client.close()
 
-            self._domain_stopped_event_received = False
-            self._domain_stopped_event_handled = False
+        self._domain_stopped_event_received = False
+        self._domain_stopped_event_handled = False
 
-            try:
+        try:
+            with timings.phase('spawn'):
                 yield from self.fire_event_async('domain-spawn',
                                                  start_guid=start_guid)
 
-                self.log.info('Setting Qubes DB info for the VM')
+            self.log.info('Setting Qubes DB info for the VM')
+            with timings.phase('qubesdb-start'):
                 yield from self.start_qubesdb()
+            with timings.phase('qubesdb-entries'):
                 self.create_qdb_entries()
                 self.start_qdb_watch()
 
-                self.log.warning('Activating the {} VM'.format(self.name))
-                self.libvirt_domain.resume()
+            self.log.warning('Activating the {} VM'.format(self.name))
+            with timings.phase('resume'):
+                yield from self._run_blocking(self.libvirt_domain.resume)
+            self.invalidate_libvirt_state()
 
+            with timings.phase('qrexec-start'):
                 yield from self.start_qrexec_daemon()
 
+            with timings.phase('domain-start'):
                 yield from self.fire_event_async('domain-start',
                                                  start_guid=start_guid)
 
-            except Exception as exc:  # pylint: disable=bare-except
-                self.log.error('Start failed: %s', str(exc))
-                # This avoids losing the exception if an exception is
-                # raised in self._kill_locked(), because the vm is not
-                # running or paused
-                try:
-                    yield from self._kill_locked()
-                except qubes.exc.QubesVMNotStartedError:
-                    pass
+        except Exception as exc:  # pylint: disable=bare-except
+            self.log.error('Start failed: %s', str(exc))
+            # This avoids losing the exception if an exception is
+            # raised in self._kill_locked(), because the vm is not
+            # running or paused
+            try:
+                yield from self._kill_locked()
+            except qubes.exc.QubesVMNotStartedError:
+                pass
 
-                # let anyone receiving domain-pre-start know that startup failed
-                yield from self.fire_event_async('domain-start-failed',
-                                                 reason=str(exc))
-                raise
+            # let anyone receiving domain-pre-start know that startup failed
+            yield from self.fire_event_async('domain-start-failed',
+                                             reason=str(exc))
+            raise
 
-        return self
+    def _startup_pipeline(self, timings, start_guid, notify_function,
+            mem_required):
+        """Prepare phases of the startup before creating the domain.
+
+        The netvm is started only after the qube's storage is verified, not
+        to start it for a qube which can't start anyway. Then storage is
+        started concurrently with starting the netvm and requesting memory.
+        Libvirt domain is defined as soon as storage and the netvm are ready
+        (its XML refers to both).
+
+        :rtype: qubes.vm.startup.StartupPipeline
+        """
+        pipeline = qubes.vm.startup.StartupPipeline(timings, self.log)
+        pipeline.add('storage-verify', self.storage.verify)
+        pipeline.add('storage-start', self.storage.start,
+            after=('storage-verify',),
+            rollback=lambda _: self.storage.stop())
+
+        netvm_start = ()
+        # pylint: disable=no-member
+        if self.netvm is not None and self.netvm.qid != 0 \
+                and not self.netvm.is_running():
+            pipeline.add('netvm-start', functools.partial(self.netvm.start,
+                start_guid=start_guid, notify_function=notify_function),
+                after=('storage-verify',))
+            netvm_start = ('netvm-start',)
+
+        def close_qmemman_client(qmemman_client):
+            if qmemman_client:
+                qmemman_client.close()
+
+        # qmemman handles one client at a time, until it disconnects -
+        # memory for the netvm needs to be requested first
+        pipeline.add('request-memory', functools.partial(
+                asyncio.get_event_loop().run_in_executor,
+                None, self.request_memory, mem_required),
+            after=netvm_start, rollback=close_qmemman_client)
+
+        pipeline.add('define-domain', self._update_libvirt_domain_async,
+            after=('storage-start',) + netvm_start)
+        return pipeline
+
+    def _report_start_timings(self, timings, success):
+        """Log durations of startup phases, fire ``domain-start-timings``
+        event and dump the trace, if enabled"""
+        timings.finish()
+        self.log.info('Start %s in %.3fs: %s',
+            'finished' if success else 'failed', timings.total,
+            timings.format())
+        self.fire_event('domain-start-timings', success=success,
+            total=timings.total, timings=timings.durations())
+        trace_dir = qubes.vm.startup.get_trace_dir()
+        if trace_dir is not None:
+            try:
+                timings.dump_trace(trace_dir)
+            except OSError as exc:
+                self.log.warning('Failed to write startup trace: %s', exc)
 
     def on_libvirt_domain_stopped(self):
         """ Handle VIR_DOMAIN_EVENT_STOPPED events from libvirt.
@@ -1264,10 +1401,13 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
             # an exception gets thrown.
             self._domain_stopped_event_handled = True
 
-            while self.get_power_state() == 'Dying':
-                yield from asyncio.sleep(0.25)
-            yield from self.fire_event_async('domain-stopped')
-            yield from self.fire_event_async('domain-shutdown')
+            try:
+                while self.get_power_state() == 'Dying':
+                    yield from asyncio.sleep(0.25)
+                yield from self.fire_event_async('domain-stopped')
+                yield from self.fire_event_async('domain-shutdown')
+            finally:
+                self._wake_shutdown_waiter()
 
     @qubes.events.handler('domain-stopped')
     @asyncio.coroutine
@@ -1294,6 +1434,7 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
             when domain is already shut down.
         """
 
+        yield from self.fetch_libvirt_state()
         if self.is_halted():
             raise qubes.exc.QubesVMNotStartedError(self)
 
@@ -1301,14 +1442,33 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
             yield from self.fire_event_async('domain-pre-shutdown',
                                              pre_event=True, force=force)
 
-            self.libvirt_domain.shutdown()
+            if wait and self._can_cache_libvirt_state():
+                # libvirt lifecycle events are delivered
+                halted = self._get_shutdown_waiter()
+                if self._domain_stopped_event_handled:
+                    # stopped while handling domain-pre-shutdown - no event
+                    # would wake the waiter
+                    self._wake_shutdown_waiter()
+            else:
+                halted = None
+
+            if halted is None or not halted.done():
+                yield from self._run_blocking(self.libvirt_domain.shutdown)
+                self.invalidate_libvirt_state()
 
             if wait:
                 if timeout is None:
                     timeout = self.shutdown_timeout
-                while timeout > 0 and not self.is_halted():
-                    yield from asyncio.sleep(0.25)
-                    timeout -= 0.25
+                if halted is not None:
+                    try:
+                        yield from asyncio.wait_for(asyncio.shield(halted),
+                            timeout)
+                    except asyncio.TimeoutError:
+                        pass
+                else:
+                    while timeout > 0 and not self.is_halted():
+                        yield from asyncio.sleep(0.25)
+                        timeout -= 0.25
                 with (yield from self.startup_lock):
                     if self.is_halted():
                         # make sure all shutdown tasks are completed
@@ -1330,6 +1490,7 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
             when domain is already shut down.
         """
 
+        yield from self.fetch_libvirt_state()
         if not self.is_running() and not self.is_paused():
             raise qubes.exc.QubesVMNotStartedError(self)
 
@@ -1344,11 +1505,13 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
 
         This function needs to be called with self.startup_lock held."""
         try:
-            self.libvirt_domain.destroy()
+            yield from self._run_blocking(self.libvirt_domain.destroy)
         except libvirt.libvirtError as e:
             if e.get_error_code() == libvirt.VIR_ERR_OPERATION_INVALID:
                 raise qubes.exc.QubesVMNotStartedError(self)
             raise
+        finally:
+            self.invalidate_libvirt_state()
 
         # make sure all shutdown tasks are completed
         yield from self._ensure_shutdown_handled()
@@ -1368,10 +1531,12 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
             if self.features.check_with_template('qrexec', False):
                 yield from self.run_service_for_stdio('qubes.SuspendPre',
                                                       user='root')
-            self.libvirt_domain.pMSuspendForDuration(
+            yield from self._run_blocking(
+                self.libvirt_domain.pMSuspendForDuration,
                 libvirt.VIR_NODE_SUSPEND_TARGET_MEM, 0, 0)
         else:
-            self.libvirt_domain.suspend()
+            yield from self._run_blocking(self.libvirt_domain.suspend)
+        self.invalidate_libvirt_state()
 
         return self
 
@@ -1382,7 +1547,8 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
         if not self.is_running():
             raise qubes.exc.QubesVMNotRunningError(self)
 
-        self.libvirt_domain.suspend()
+        yield from self._run_blocking(self.libvirt_domain.suspend)
+        self.invalidate_libvirt_state()
 
         return self
 
@@ -1396,7 +1562,8 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
 
         # pylint: disable=not-an-iterable
         if self.get_power_state() == "Suspended":
-            self.libvirt_domain.pMWakeup()
+            yield from self._run_blocking(self.libvirt_domain.pMWakeup)
+            self.invalidate_libvirt_state()
             if self.features.check_with_template('qrexec', False):
                 yield from self.run_service_for_stdio('qubes.SuspendPost',
                                                       user='root')
@@ -1411,7 +1578,8 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
         if not self.is_paused():
             raise qubes.exc.QubesVMNotPausedError(self)
 
-        self.libvirt_domain.resume()
+        yield from self._run_blocking(self.libvirt_domain.resume)
+        self.invalidate_libvirt_state()
 
         return self
 
@@ -1890,23 +2058,21 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
                     return 'Halted'
                 raise
 
-        libvirt_domain = self.libvirt_domain
-        if libvirt_domain is None:
+        if self.libvirt_domain is None:
             return 'Halted'
 
         try:
-            if libvirt_domain.isActive():
-                # pylint: disable=line-too-long
-                if libvirt_domain.state()[0] == libvirt.VIR_DOMAIN_PAUSED:
+            active, state = self._get_libvirt_state()
+            if active:
+                if state == libvirt.VIR_DOMAIN_PAUSED:
                     return "Paused"
-                if libvirt_domain.state()[0] == libvirt.VIR_DOMAIN_CRASHED:
+                if state == libvirt.VIR_DOMAIN_CRASHED:
                     return "Crashed"
-                if libvirt_domain.state()[0] == libvirt.VIR_DOMAIN_SHUTDOWN:
+                if state == libvirt.VIR_DOMAIN_SHUTDOWN:
                     return "Halting"
-                if libvirt_domain.state()[0] == libvirt.VIR_DOMAIN_SHUTOFF:
+                if state == libvirt.VIR_DOMAIN_SHUTOFF:
                     return "Dying"
-                if libvirt_domain.state()[
-                    0] == libvirt.VIR_DOMAIN_PMSUSPENDED:  # nopep8
+                if state == libvirt.VIR_DOMAIN_PMSUSPENDED:
                     return "Suspended"
                 if not self.is_fully_usable():
                     return "Transient"
@@ -1920,6 +2086,100 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
 
         assert False
 
+    def _can_cache_libvirt_state(self):
+        # only libvirt lifecycle events keep the cache up to date
+        return getattr(self.app, 'libvirt_events_registered', False)
+
+    #: libvirt states of an active domain, that can't change without
+    #: a lifecycle event; transitional ones (like shutting down, or already
+    #: shut off but not yet destroyed) are not cached
+    _stable_libvirt_states = (libvirt.VIR_DOMAIN_RUNNING,
+        libvirt.VIR_DOMAIN_BLOCKED, libvirt.VIR_DOMAIN_PAUSED,
+        libvirt.VIR_DOMAIN_PMSUSPENDED)
+
+    def _get_libvirt_state(self):
+        """Get tuple(is active, libvirt state) of :py:attr:`libvirt_domain`.
+
+        The result is cached while libvirt lifecycle events are delivered
+        (see :py:meth:`invalidate_libvirt_state`), unless the domain is in
+        a transitional state. The state is :py:obj:`None` for inactive
+        domain.
+
+        :raises libvirt.libvirtError: when libvirt call fails
+        """
+        if self._libvirt_state is not None:
+            return self._libvirt_state
+        active, state = self._query_libvirt_state(self.libvirt_domain)
+        self._cache_libvirt_state(active, state)
+        return active, state
+
+    def _is_libvirt_active(self):
+        """Check whether :py:attr:`libvirt_domain` is active, like
+        :py:meth:`_get_libvirt_state`, but with a single libvirt call when the
+        state is not cached.
+        """
+        if self._libvirt_state is not None:
+            return self._libvirt_state[0]
+        active = bool(self.libvirt_domain.isActive())
+        if not active:
+            self._cache_libvirt_state(active, None)
+        return active
+
+    @staticmethod
+    def _query_libvirt_state(libvirt_domain):
+        # may be called in a thread, don't touch anything but libvirt here
+        active = bool(libvirt_domain.isActive())
+        state = libvirt_domain.state()[0] if active else None
+        return active, state
+
+    def _cache_libvirt_state(self, active, state):
+        if self._can_cache_libvirt_state() and (
+                not active or state in self._stable_libvirt_states):
+            self._libvirt_state = (active, state)
+
+    @asyncio.coroutine
+    def fetch_libvirt_state(self):
+        """Get libvirt state of this domain into the cache, without blocking
+        the event loop on libvirt.
+
+        Then :py:meth:`get_power_state`, :py:meth:`is_running` and similar
+        synchronous methods use the cached state. They still query libvirt
+        (blocking the event loop) if the state can't be cached - without
+        libvirt events, in a transitional state, or for a domain not defined
+        in libvirt.
+        """
+        if self._libvirt_state is not None or self.app.vmm.offline_mode \
+                or not self._can_cache_libvirt_state():
+            return
+        invalidations = self._libvirt_state_invalidations
+        libvirt_domain = self._libvirt_domain
+        if libvirt_domain is None:
+            try:
+                libvirt_domain = yield from self._run_blocking(
+                    self.app.vmm.libvirt_conn.lookupByUUID, self.uuid.bytes)
+            except libvirt.libvirtError as e:
+                if e.get_error_code() == libvirt.VIR_ERR_NO_DOMAIN:
+                    return
+                raise
+            if self._libvirt_domain is None:
+                self._libvirt_domain = libvirt_domain
+        active, state = yield from self._run_blocking(
+            self._query_libvirt_state, libvirt_domain)
+        # an event could have changed the state in the meantime
+        if invalidations == self._libvirt_state_invalidations:
+            self._cache_libvirt_state(active, state)
+
+    def invalidate_libvirt_state(self):
+        """Drop cached libvirt state of this domain.
+
+        Called on each libvirt lifecycle event about this domain, after each
+        operation changing its state, and when libvirt connection is
+        re-established.
+        """
+        self._libvirt_state = None
+        self._libvirt_xid = None
+        self._libvirt_state_invalidations += 1
+
     def is_halted(self):
         """ Check whether this domain's state is 'Halted'
             :returns: :py:obj:`True` if this domain is halted, \
@@ -1952,7 +2212,7 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
                     return False
                 raise
 
-        return bool(self.libvirt_domain.isActive())
+        return self._is_libvirt_active()
 
     def is_paused(self):
         """Check whether this domain is paused.
@@ -1962,8 +2222,10 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
         :rtype: bool
         """
 
-        return self.libvirt_domain \
-               and self.libvirt_domain.state()[0] == libvirt.VIR_DOMAIN_PAUSED
+        if not self.libvirt_domain:
+            return False
+        _, state = self._get_libvirt_state()
+        return state == libvirt.VIR_DOMAIN_PAUSED
 
     def is_qrexec_running(self):
         """Check whether qrexec for this domain is available.
@@ -2005,8 +2267,9 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
             return 0
 
         try:
-            if not self.libvirt_domain.isActive():
+            if not self._is_libvirt_active():
                 return 0
+            # memory is changed by qmemman without any event, don't cache it
             return self.libvirt_domain.info()[1]
 
         except libvirt.libvirtError as e:
@@ -2217,13 +2480,37 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
 
         self.fire_event('domain-qdb-create')
 
-    # TODO async; update this in constructor
+    @asyncio.coroutine
+    def _run_blocking(self, func, *args):
+        """Run blocking *func* (usually a libvirt call) outside of the event
+        loop thread, after other such calls for this domain are done.
+
+        See :py:class:`qubes.utils.BlockingExecutor`.
+        """
+        return (yield from qubes.utils.run_blocking(self, func, *args))
+
+    # TODO: update this in constructor
     def _update_libvirt_domain(self):
         """Re-initialise :py:attr:`libvirt_domain`."""
+        self.invalidate_libvirt_state()
+        domain_config = self.create_config_file()
+        self._libvirt_domain = self._define_libvirt_domain(
+            self.app.vmm.libvirt_conn, domain_config)
+
+    @asyncio.coroutine
+    def _update_libvirt_domain_async(self):
+        """Re-initialise :py:attr:`libvirt_domain`, without blocking the
+        event loop on libvirt."""
+        self.invalidate_libvirt_state()
         domain_config = self.create_config_file()
+        self._libvirt_domain = yield from self._run_blocking(
+            self._define_libvirt_domain, self.app.vmm.libvirt_conn,
+            domain_config)
+
+    def _define_libvirt_domain(self, libvirt_conn, domain_config):
+        # called in a thread, don't touch anything but libvirt_conn here
         try:
-            self._libvirt_domain = self.app.vmm.libvirt_conn.defineXML(
-                domain_config)
+            return libvirt_conn.defineXML(domain_config)
         except libvirt.libvirtError as e:
             if e.get_error_code() == libvirt.VIR_ERR_OS_TYPE \
                     and e.get_str2() == 'hvm':
@@ -0,0 +1,227 @@
+# -*- encoding: utf8 -*-
+#
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# Copyright (C) 2017 Marek Marczykowski-Górecki
+#                               <marmarek@invisiblethingslab.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, see <https://www.gnu.org/licenses/>.
+
+''' Instrumentation and scheduling of qube startup phases. '''
+
+import asyncio
+import contextlib
+import inspect
+import json
+import os
+import time
+
+import qubes.config
+
+#: environment variable overriding :py:data:`qubes.config.startup_trace_dir`
+TRACE_DIR_ENV = 'QUBES_STARTUP_TRACE_DIR'
+
+
+def get_trace_dir():
+    '''Directory to write startup traces to, or :py:obj:`None` if disabled'''
+    return os.environ.get(TRACE_DIR_ENV, qubes.config.startup_trace_dir) \
+        or None
+
+
+class StartupTimings:
+    '''Durations of phases of a single qube startup.
+
+    Phases are measured with :py:meth:`phase` and recorded in the order they
+    finish.
+
+    :param str name: name of the qube
+    '''
+
+    def __init__(self, name):
+        self.name = name
+        #: :py:func:`time.time` of the startup beginning
+        self.start_time = time.time()
+        self._start = time.monotonic()
+        #: list of (phase, offset from the beginning, duration), in seconds
+        self.phases = []
+        #: duration of the whole startup, set by :py:meth:`finish`
+        self.total = None
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        '''Measure a phase executed in the ``with`` block (also if it fails)
+
+        :param str name: name of the phase
+        '''
+        begin = time.monotonic()
+        try:
+            yield
+        finally:
+            end = time.monotonic()
+            self.phases.append((name, begin - self._start, end - begin))
+
+    def finish(self):
+        '''Mark the end of the startup'''
+        self.total = time.monotonic() - self._start
+
+    def durations(self):
+        '''Durations of the phases, as a tuple of (phase, seconds) pairs'''
+        return tuple((name, duration) for name, _, duration in self.phases)
+
+    def format(self):
+        '''Format the durations as a single line, for logging'''
+        return ' '.join('{}={:.3f}s'.format(name, duration)
+            for name, duration in self.durations())
+
+    def chrome_trace(self):
+        '''Get a trace in Chrome trace event format, which can be loaded
+        into ``chrome://tracing`` or Perfetto.
+
+        Timestamps are absolute, so traces of multiple startups can be merged.
+        Phases executed concurrently are put on separate tracks.
+        '''
+        def event(name, offset, duration, track=0):
+            return {
+                'name': name,
+                'ph': 'X',
+                'pid': 'qubesd',
+                'tid': self.name if not track else '{} ({})'.format(
+                    self.name, track + 1),
+                'ts': int((self.start_time + offset) * 1e6),
+                'dur': int(duration * 1e6),
+            }
+        events = [event('start ' + self.name, 0, self.total or 0)]
+        #: end offsets of the last phase on each track
+        tracks = []
+        for name, offset, duration in sorted(self.phases,
+                key=lambda phase: phase[1]):
+            for track, end in enumerate(tracks):
+                if end <= offset:
+                    break
+            else:
+                track = len(tracks)
+                tracks.append(None)
+            tracks[track] = offset + duration
+            events.append(event(name, offset, duration, track))
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def dump_trace(self, directory):
+        '''Write the trace (see :py:meth:`chrome_trace`) to a file in
+        *directory*
+
+        :returns: path of the file
+        '''
+        path = os.path.join(directory, 'start-{}-{}.{:03d}.json'.format(
+            self.name,
+            time.strftime('%Y%m%d-%H%M%S', time.localtime(self.start_time)),
+            int(self.start_time * 1000) % 1000))
+        with open(path, 'w') as trace_file:
+            json.dump(self.chrome_trace(), trace_file)
+        return path
+
+
+class _DependencyFailed(Exception):
+    '''A phase was not started, because a phase it depends on failed'''
+
+
+@asyncio.coroutine
+def _await_maybe(value):
+    if inspect.isawaitable(value):
+        value = yield from value
+    return value
+
+
+class StartupPipeline:
+    '''Startup phases executed concurrently, as soon as the phases they
+    depend on are done.
+
+    If any phase fails, phases depending on it are not started, but already
+    running ones are allowed to finish - interrupting (for example) start of
+    another qube in the middle is worse than waiting for it. Then phases that
+    succeeded are rolled back, in reverse order of adding them, and the
+    exception of the first failed phase is raised.
+
+    :param StartupTimings timings: where to record durations of the phases
+    :param logging.Logger log: logger for rollback failures
+    '''
+
+    def __init__(self, timings, log):
+        self.timings = timings
+        self.log = log
+        #: list of (name, func, dependencies, rollback)
+        self.phases = []
+
+    def add(self, name, func, after=(), rollback=None):
+        '''Add a phase
+
+        :param str name: name of the phase
+        :param func: function executing the phase, called without \
+            arguments; if it returns an awaitable, it's awaited
+        :param after: names of phases that need to be done before this one; \
+            they must be already added
+        :param rollback: function reverting the phase, called with its \
+            result if the pipeline fails; if it returns an awaitable, it's \
+            awaited
+        '''
+        names = [phase[0] for phase in self.phases]
+        assert name not in names
+        assert all(dep in names for dep in after)
+        self.phases.append((name, func, tuple(after), rollback))
+
+    @asyncio.coroutine
+    def _run_phase(self, name, func, dependencies, failures):
+        for dep in dependencies:
+            yield from asyncio.wait([dep])
+            if dep.cancelled() or dep.exception() is not None:
+                raise _DependencyFailed(name)
+        try:
+            with self.timings.phase(name):
+                return (yield from _await_maybe(func()))
+        except Exception as exc:
+            failures.append(exc)
+            raise
+
+    @asyncio.coroutine
+    def run(self):
+        '''Run all the phases
+
+        :returns: dict of phase name -> its result
+        '''
+        tasks = {}
+        #: exceptions of failed phases, in order of failing
+        failures = []
+        for name, func, after, _ in self.phases:
+            tasks[name] = asyncio.ensure_future(self._run_phase(name, func,
+                [tasks[dep] for dep in after], failures))
+        try:
+            yield from asyncio.wait(tasks.values())
+        except asyncio.CancelledError:
+            for task in tasks.values():
+                task.cancel()
+            raise
+
+        if not failures:
+            return {name: task.result() for name, task in tasks.items()}
+
+        for name, _, _, rollback in reversed(self.phases):
+            task = tasks[name]
+            if rollback is None or task.cancelled() \
+                    or task.exception() is not None:
+                continue
+            try:
+                yield from _await_maybe(rollback(task.result()))
+            except Exception:  # pylint: disable=broad-except
+                self.log.exception(
+                    'Failed to roll back startup phase %s', name)
+        raise failures[0]
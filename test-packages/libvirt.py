@@ -32,4 +32,6 @@ VIR_DOMAIN_SHUTOFF = 5
 VIR_DOMAIN_CRASHED = 6
 VIR_DOMAIN_PMSUSPENDED = 7
 
+VIR_DOMAIN_START_PAUSED = 1
+
 VIR_ERR_NO_DOMAIN = 0